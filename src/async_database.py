@@ -0,0 +1,285 @@
+"""
+Асинхронный вариант API database.py для бота и generate_recommendations на asyncpg: свой пул соединений
+в event loop, без переключения в потоки. Функции повторяют одноименные из database.py (те же аргументы,
+результаты и значения по умолчанию при ошибках). asyncpg подготавливает запросы на сервере и кэширует
+подготовленные выражения на каждом соединении, поэтому повторные вызовы не разбирают SQL заново.
+Синхронный database.py остается для скриптов (populate_db.py, import_ratings.py и др.) и кэшей, работающих в потоках.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+import asyncpg
+
+from authorization import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+from metrics import timed_db
+
+logger = logging.getLogger(__name__)
+
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', '1'))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', '10'))
+ASYNC_DB_TIMEOUT = float(os.getenv('ASYNC_DB_TIMEOUT', '10')) # секунд на подключение и ожидание соединения из пула
+# Подготовленных выражений в кэше одного соединения; 0 - отключить (нужно для pgbouncer в режиме transaction)
+ASYNC_DB_STATEMENT_CACHE_SIZE = int(os.getenv('ASYNC_DB_STATEMENT_CACHE_SIZE', '100'))
+
+# Ошибки, после которых функция логирует и возвращает значение по умолчанию (как psycopg2.Error в database.py)
+_DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock: Optional[asyncio.Lock] = None
+
+async def get_async_pool() -> asyncpg.Pool:
+    """Общий для event loop пул asyncpg, создается при первом обращении."""
+    global _pool, _pool_lock
+    if _pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    host=DB_HOST, port=int(DB_PORT), database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                    min_size=ASYNC_DB_POOL_MIN_SIZE, max_size=ASYNC_DB_POOL_MAX_SIZE, timeout=ASYNC_DB_TIMEOUT,
+                    statement_cache_size=ASYNC_DB_STATEMENT_CACHE_SIZE,
+                )
+                logger.info(f"Создан асинхронный пул соединений PostgreSQL (min={ASYNC_DB_POOL_MIN_SIZE}, max={ASYNC_DB_POOL_MAX_SIZE}).")
+    return _pool
+
+@asynccontextmanager
+async def _acquire() -> AsyncIterator[asyncpg.Connection]:
+    """Соединение из пула; ожидание свободного ограничено ASYNC_DB_TIMEOUT, как у синхронного пула."""
+    pool = await get_async_pool()
+    async with pool.acquire(timeout=ASYNC_DB_TIMEOUT) as conn:
+        yield conn
+
+def get_async_pool_stats() -> dict:
+    if _pool is None:
+        return {'max_size': ASYNC_DB_POOL_MAX_SIZE, 'in_use': 0, 'idle': 0}
+    size, idle = _pool.get_size(), _pool.get_idle_size()
+    return {'max_size': _pool.get_max_size(), 'in_use': size - idle, 'idle': idle}
+
+async def close_async_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+        logger.info("Асинхронный пул соединений PostgreSQL закрыт.")
+
+
+# --- Оценки и прослушивания ---
+
+@timed_db
+async def save_interactions_batch(ratings: list, listens: list) -> bool:
+    """
+    Пачка оценок [(user_id, track_spotify_id, rating)] и прослушиваний [(user_id, track_spotify_id)] в одной транзакции.
+    Каждая таблица пишется одним многострочным upsert'ом (unnest массивов). Повторы пар должны быть уже схлопнуты.
+    """
+    if not ratings and not listens:
+        return True
+    try:
+        async with _acquire() as conn:
+            async with conn.transaction():
+                if ratings:
+                    user_ids, track_ids, values = zip(*ratings)
+                    await conn.execute('''
+                        INSERT INTO track_ratings (user_id, track_id, rating, rated_at)
+                        SELECT user_id, track_id, rating, CURRENT_TIMESTAMP
+                        FROM unnest($1::BIGINT[], $2::TEXT[], $3::INTEGER[]) AS r(user_id, track_id, rating)
+                        ON CONFLICT (user_id, track_id) DO UPDATE SET
+                            rating = EXCLUDED.rating,
+                            rated_at = CURRENT_TIMESTAMP
+                    ''', list(user_ids), list(track_ids), list(values))
+                if listens:
+                    user_ids, track_ids = zip(*listens)
+                    await conn.execute('''
+                        INSERT INTO listened_tracks (user_id, track_id)
+                        SELECT * FROM unnest($1::BIGINT[], $2::TEXT[])
+                        ON CONFLICT (user_id, track_id) DO NOTHING
+                    ''', list(user_ids), list(track_ids))
+        logger.info(f"Сохранено оценок: {len(ratings)}, прослушиваний: {len(listens)} (одна транзакция).")
+        return True
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка пакетного сохранения оценок/прослушиваний в PostgreSQL: {e}")
+        return False
+
+@timed_db
+async def get_top_rated_tracks(user_id: int, min_rating: int = 4) -> list:
+    logger.info(f"Запрос высоко оцененных треков (Spotify ID) для user_id={user_id} (min_rating={min_rating}) из PostgreSQL.")
+    try:
+        async with _acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT track_id FROM track_ratings
+                WHERE user_id = $1 AND rating >= $2
+                ORDER BY rated_at DESC
+            ''', user_id, min_rating)
+        track_spotify_ids = [row['track_id'] for row in rows]
+        logger.info(f"Найдено {len(track_spotify_ids)} высоко оцененных треков (Spotify ID) в PostgreSQL.")
+        return track_spotify_ids
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при запросе высоко оцененных треков (Spotify ID) из PostgreSQL: {e}")
+        return []
+
+@timed_db
+async def check_user_has_ratings(user_id: int) -> bool:
+    logger.info(f"Проверка наличия оценок у user_id={user_id} в PostgreSQL.")
+    try:
+        async with _acquire() as conn:
+            has_ratings = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM track_ratings WHERE user_id = $1)", user_id)
+        logger.info(f"Пользователь {user_id} {'имеет' if has_ratings else 'не имеет'} оценок в PostgreSQL.")
+        return bool(has_ratings)
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при проверке наличия оценок в PostgreSQL: {e}")
+        return False
+
+
+# --- Коллаборативный этап ---
+
+@timed_db
+async def get_item_based_recommendations(user_id: int, min_rating: int = 4, limit: int = 10) -> list:
+    """Соседи высоко оцененных пользователем треков из track_neighbors, без уже оцененных (как в database.py)."""
+    logger.info(f"Запрос item-based рекомендаций для user_id={user_id} (min_rating={min_rating}, limit={limit}) из PostgreSQL.")
+    try:
+        async with _acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT tn.neighbor_track_id, SUM(tn.similarity) AS score
+                FROM track_ratings seed
+                JOIN track_neighbors tn ON tn.track_id = seed.track_id
+                WHERE seed.user_id = $1 AND seed.rating >= $2
+                  AND NOT EXISTS (
+                      SELECT 1 FROM track_ratings rated
+                      WHERE rated.user_id = seed.user_id AND rated.track_id = tn.neighbor_track_id
+                  )
+                GROUP BY tn.neighbor_track_id
+                ORDER BY score DESC, tn.neighbor_track_id
+                LIMIT $3
+            ''', user_id, min_rating, limit)
+        track_spotify_ids = [row['neighbor_track_id'] for row in rows]
+        logger.info(f"Найдено {len(track_spotify_ids)} item-based рекомендаций (Spotify ID) в PostgreSQL.")
+        return track_spotify_ids
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при запросе item-based рекомендаций из PostgreSQL: {e}")
+        return []
+
+@timed_db
+async def get_precomputed_recommendations(user_id: int, engine: str, max_age_seconds: float) -> Optional[List[str]]:
+    """Предрасчитанные рекомендации движка engine не старше max_age_seconds, если после расчета не было оценок. Иначе None."""
+    try:
+        async with _acquire() as conn:
+            track_ids = await conn.fetchval('''
+                SELECT p.track_ids FROM precomputed_recommendations p
+                WHERE p.user_id = $1 AND p.engine = $2
+                  AND p.generated_at > CURRENT_TIMESTAMP - make_interval(secs => $3)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM track_ratings tr WHERE tr.user_id = p.user_id AND tr.rated_at > p.generated_at
+                  )
+            ''', user_id, engine, float(max_age_seconds))
+        return list(track_ids) if track_ids is not None else None
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при запросе предрасчитанных рекомендаций из PostgreSQL: {e}")
+        return None
+
+
+# --- Аудио и кэши внешних API ---
+
+@timed_db
+async def get_track_audio(track_spotify_id: str) -> Optional[Dict[str, Optional[str]]]:
+    """{'telegram_file_id': ..., 'youtube_video_id': ...} для трека или None, если аудио еще не загружалось."""
+    try:
+        async with _acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT telegram_file_id, youtube_video_id FROM track_audio WHERE track_id = $1", track_spotify_id
+            )
+        return dict(row) if row else None
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при запросе track_audio из PostgreSQL: {e}")
+        return None
+
+@timed_db
+async def save_track_audio(track_spotify_id: str, telegram_file_id, youtube_video_id):
+    """Сохраняет file_id загруженного в Telegram аудио (None сбрасывает недействительный file_id) и videoId."""
+    logger.info(f"Сохранение track_audio: track_spotify_id='{track_spotify_id}', youtube_video_id='{youtube_video_id}'")
+    try:
+        async with _acquire() as conn:
+            await conn.execute('''
+                INSERT INTO track_audio (track_id, telegram_file_id, youtube_video_id, updated_at)
+                VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+                ON CONFLICT (track_id) DO UPDATE SET
+                    telegram_file_id = EXCLUDED.telegram_file_id,
+                    youtube_video_id = COALESCE(EXCLUDED.youtube_video_id, track_audio.youtube_video_id),
+                    updated_at = CURRENT_TIMESTAMP
+            ''', track_spotify_id, telegram_file_id, youtube_video_id)
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка сохранения track_audio в PostgreSQL: {e}")
+
+@timed_db
+async def prune_external_api_cache(max_age_seconds: float):
+    """Удаляет из lastfm_similar_cache и spotify_resolve_cache записи старше max_age_seconds."""
+    try:
+        async with _acquire() as conn:
+            async with conn.transaction():
+                deleted = 0
+                for query in (
+                    "DELETE FROM lastfm_similar_cache WHERE fetched_at < CURRENT_TIMESTAMP - make_interval(secs => $1)",
+                    "DELETE FROM spotify_resolve_cache WHERE resolved_at < CURRENT_TIMESTAMP - make_interval(secs => $1)",
+                ):
+                    status = await conn.execute(query, float(max_age_seconds)) # "DELETE <n>"
+                    deleted += int(status.split()[-1])
+        logger.info(f"Удалено {deleted} устаревших записей кэша внешних API.")
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка очистки кэша внешних API в PostgreSQL: {e}")
+
+
+# --- Сопоставление пользователей ---
+
+@timed_db
+async def add_user_mapping(user_id: int) -> int:
+    logger.info(f"Добавление/получение user_mapping для user_id={user_id} в PostgreSQL.")
+    try:
+        async with _acquire() as conn:
+            user_num = await conn.fetchval("SELECT user_num FROM user_mapping WHERE user_id = $1", user_id)
+            if user_num is not None:
+                logger.info(f"Пользователь {user_id} уже существует с user_num={user_num}.")
+                return user_num
+            user_num = await conn.fetchval('''
+                INSERT INTO user_mapping (user_id) VALUES ($1)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_num
+            ''', user_id)
+            if user_num is None: # параллельный /start уже вставил строку
+                user_num = await conn.fetchval("SELECT user_num FROM user_mapping WHERE user_id = $1", user_id)
+        if user_num is None:
+            logger.error(f"Не удалось вставить нового пользователя {user_id} и получить user_num.")
+            return -1
+        logger.info(f"Новый пользователь {user_id} добавлен с user_num={user_num}.")
+        return user_num
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при добавлении/получении user_mapping для user_id={user_id}: {e}")
+        return -1
+
+@timed_db
+async def get_user_to_idx_map() -> dict:
+    logger.info("Запрос сопоставления user_id -> user_num из PostgreSQL.")
+    try:
+        async with _acquire() as conn:
+            rows = await conn.fetch("SELECT user_id, user_num FROM user_mapping")
+        user_map = {row['user_id']: row['user_num'] for row in rows}
+        logger.info(f"Загружено {len(user_map)} сопоставлений user_id -> user_num из PostgreSQL.")
+        return user_map
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при запросе сопоставления user_id -> user_num из PostgreSQL: {e}")
+        return {}
+
+@timed_db
+async def get_internal_user_id(telegram_user_id: int) -> int:
+    logger.info(f"Запрос внутреннего user_num для telegram_user_id={telegram_user_id} из PostgreSQL.")
+    try:
+        async with _acquire() as conn:
+            user_num = await conn.fetchval("SELECT user_num FROM user_mapping WHERE user_id = $1", telegram_user_id)
+        if user_num is None:
+            logger.warning(f"Внутренний user_num не найден для telegram_user_id={telegram_user_id}.")
+            return -1
+        return user_num
+    except _DB_ERRORS as e:
+        logger.error(f"Ошибка при запросе внутреннего user_num: {e}")
+        return -1
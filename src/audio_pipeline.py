@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import yt_dlp
+from yt_dlp.networking import Request
+
+logger = logging.getLogger(__name__)
+
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS', '2')) # процессов для скачивания + перекодирования
+AUDIO_QUEUE_SIZE = int(os.getenv('AUDIO_QUEUE_SIZE', '20')) # максимум заданий в очереди
+# transcode - перекодирование в MP3 через ffmpeg; native - исходная m4a-дорожка в памяти без перекодирования
+AUDIO_DELIVERY_MODE = os.getenv('AUDIO_DELIVERY_MODE', 'transcode').lower()
+AUDIO_INMEMORY_MAX_BYTES = int(os.getenv('AUDIO_INMEMORY_MAX_BYTES', str(20 * 1024 * 1024))) # больше - через перекодирование
+AUDIO_NATIVE_WORKERS = int(os.getenv('AUDIO_NATIVE_WORKERS', str(AUDIO_WORKERS))) # одновременных чтений m4a в память
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Приоритеты заданий: меньше - раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 1
+
+
+def _safe_filename(title: str, default: str) -> str:
+    return "".join(c if c.isalnum() or c in (' ', '.', '_', '-') else '_' for c in title).strip() or default
+
+
+def _download_job(video_url: str, work_dir: str) -> Optional[str]:
+    """
+    Скачивает аудио и перекодирует его в MP3 внутри отдельного каталога work_dir.
+    Выполняется в дочернем процессе, поэтому одновременные задания не мешают друг другу.
+    """
+    ydl_opts = {
+        'format': 'bestaudio/best', 'outtmpl': os.path.join(work_dir, 'audio.%(ext)s'),
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}],
+        'noplaylist': True, 'quiet': True, 'noprogress': True, 'ffmpeg_location': os.getenv('FFMPEG_PATH')
+    }
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info_dict = ydl.extract_info(video_url, download=True)
+
+        converted_path = os.path.join(work_dir, 'audio.mp3')
+        if not os.path.exists(converted_path):
+            original_ext = info_dict.get('ext') if info_dict else 'bin'
+            logger.error(f"AudioPipeline: Файл '{converted_path}' не найден после yt-dlp (исходное расширение: {original_ext}).")
+            return None
+        safe_title = _safe_filename(info_dict.get('title', 'unknown_track'), "downloaded_audio")
+        final_path = os.path.join(work_dir, f"{safe_title}.mp3")
+        os.rename(converted_path, final_path)
+        return final_path
+    except yt_dlp.utils.DownloadError as e:
+        logger.error(f"AudioPipeline: yt-dlp ошибка скачивания {video_url}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"AudioPipeline: Общая ошибка при скачивании аудио с {video_url}: {e}", exc_info=True)
+        return None
+
+
+def _fetch_native_job(video_url: str, max_bytes: int) -> Optional[Tuple[bytes, str]]:
+    """
+    Выбирает исходную m4a-дорожку (ее принимает sendAudio в Telegram) и читает ее в память без записи на диск.
+    Возвращает (содержимое, имя файла) или None, если подходящей дорожки нет или она больше max_bytes.
+    """
+    ydl_opts = {'format': 'bestaudio[ext=m4a]', 'noplaylist': True, 'quiet': True, 'noprogress': True}
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info_dict = ydl.extract_info(video_url, download=False)
+            if not info_dict or not info_dict.get('url'):
+                return None
+            expected_size = info_dict.get('filesize') or info_dict.get('filesize_approx')
+            if expected_size and expected_size > max_bytes:
+                logger.info(f"AudioPipeline: m4a-дорожка {video_url} слишком большая ({expected_size} байт).")
+                return None
+            buffer = bytearray()
+            response = ydl.urlopen(Request(info_dict['url'], headers=info_dict.get('http_headers') or {}))
+            try:
+                while True:
+                    chunk = response.read(_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    buffer.extend(chunk)
+                    if len(buffer) > max_bytes:
+                        logger.info(f"AudioPipeline: m4a-дорожка {video_url} превысила лимит {max_bytes} байт при чтении.")
+                        return None
+            finally:
+                response.close()
+        safe_title = _safe_filename(info_dict.get('title', 'unknown_track'), "audio")
+        return bytes(buffer), f"{safe_title}.m4a"
+    except yt_dlp.utils.DownloadError as e:
+        logger.info(f"AudioPipeline: m4a-дорожка недоступна для {video_url}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"AudioPipeline: Ошибка чтения аудио в память с {video_url}: {e}", exc_info=True)
+        return None
+
+
+class _Job:
+    def __init__(self, video_url: str, future: asyncio.Future, priority: int):
+        self.video_url = video_url
+        self.future = future
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.waiters = 1
+        self.queued = False
+        self.started = False
+        self.generation = 0 # актуальная запись в очереди; более старые (до promote) пропускаются
+
+
+class AudioDownloadPipeline:
+    """
+    Подсистема скачивания аудио: ограниченная очередь с приоритетами, пул процессов для yt-dlp/ffmpeg,
+    отдельный временный каталог на каждое задание и объединение одновременных заданий на одно видео.
+    Файл, полученный из download(), нужно вернуть через release(), после этого каталог задания удаляется.
+    """
+    def __init__(self, workers: int = AUDIO_WORKERS, queue_size: int = AUDIO_QUEUE_SIZE, native_workers: int = AUDIO_NATIVE_WORKERS):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.native_workers = max(1, native_workers)
+        self._native_slots: Optional[asyncio.Semaphore] = None
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = 0 # порядок постановки внутри одного приоритета
+        self._stale_entries = 0 # записи в очереди, замененные promote(); не считаются в queue_depth
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._worker_tasks = []
+        self._in_flight: Dict[str, _Job] = {}
+        self._refs: Dict[str, int] = {} # путь к файлу -> сколько вызывающих еще не вызвали release()
+        self._native_in_flight: Dict[str, asyncio.Future] = {}
+        # Статистика
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.native_completed = 0
+        self.native_fallbacks = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _ensure_started(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue(maxsize=self.queue_size)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"AudioPipeline: запущено {self.workers} обработчиков, размер очереди {self.queue_size}.")
+
+    def _entry(self, job: _Job) -> tuple:
+        self._seq += 1
+        return job.priority, self._seq, job.generation, job
+
+    async def download(self, video_url: str, priority: int = PRIORITY_INTERACTIVE, wait_for_slot: bool = True) -> Optional[str]:
+        """
+        Скачивает аудио и возвращает путь к MP3. При wait_for_slot=False и заполненной очереди
+        сразу возвращает None (так работает фоновая предзагрузка, чтобы не вытеснять запросы пользователей).
+        """
+        self._ensure_started()
+        job = self._in_flight.get(video_url)
+        if job is not None:
+            job.waiters += 1
+            self.deduplicated += 1
+            logger.info(f"AudioPipeline: {video_url} уже скачивается, ждем существующее задание.")
+            if priority < job.priority:
+                self.promote(video_url)
+        else:
+            if not wait_for_slot and self._queue.full():
+                logger.info(f"AudioPipeline: очередь заполнена, задание {video_url} пропущено.")
+                return None
+            job = _Job(video_url, asyncio.get_running_loop().create_future(), priority)
+            self._in_flight[video_url] = job
+            try:
+                await self._queue.put(self._entry(job))
+                job.queued = True
+            except asyncio.CancelledError:
+                # Задание не попало в очередь - присоединившимся за это время ожидающим отдаем None
+                self._in_flight.pop(video_url, None)
+                if not job.future.done():
+                    job.future.set_result(None)
+                raise
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            self._abandon(job)
+            raise
+
+    def _abandon(self, job: _Job):
+        """Ожидающий download() отменен: его ссылку на файл освобождаем, задание без ожидающих не выполняем."""
+        if not job.future.done():
+            job.waiters -= 1
+        elif not job.future.cancelled() and job.future.result():
+            self.release(job.future.result())
+
+    def promote(self, video_url: str):
+        """Поднимает ждущее в очереди задание до интерактивного приоритета (пользователь ждет этот трек)."""
+        job = self._in_flight.get(video_url)
+        if job is None or not job.queued or job.started or job.priority <= PRIORITY_INTERACTIVE:
+            return
+        previous = job.priority, job.generation
+        job.priority, job.generation = PRIORITY_INTERACTIVE, job.generation + 1
+        try:
+            self._queue.put_nowait(self._entry(job))
+        except asyncio.QueueFull:
+            job.priority, job.generation = previous
+            logger.debug(f"AudioPipeline: очередь заполнена, задание {video_url} остается с прежним приоритетом.")
+            return
+        self._stale_entries += 1 # старая запись остается в очереди и будет пропущена обработчиком
+
+    async def _worker(self, worker_id: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, generation, job = await self._queue.get()
+            if job.started or generation != job.generation:
+                self._stale_entries -= 1
+                self._queue.task_done()
+                continue
+            if job.waiters <= 0:
+                logger.info(f"AudioPipeline: все ожидающие {job.video_url} отменены, задание пропущено.")
+                self._in_flight.pop(job.video_url, None)
+                job.future.set_result(None)
+                self._queue.task_done()
+                continue
+            job.started = True
+            work_dir = tempfile.mkdtemp(prefix='mrs_audio_')
+            path = None
+            try:
+                path = await loop.run_in_executor(self._executor, _download_job, job.video_url, work_dir)
+            except Exception as e:
+                logger.error(f"AudioPipeline: обработчик {worker_id} - ошибка задания {job.video_url}: {e}", exc_info=True)
+            finally:
+                self._in_flight.pop(job.video_url, None)
+                latency = time.monotonic() - job.enqueued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                if path and job.waiters > 0:
+                    self.completed += 1
+                    self._refs[path] = job.waiters
+                    logger.info(f"AudioPipeline: {job.video_url} готово за {latency:.1f} с -> '{path}'")
+                elif path:
+                    self.completed += 1
+                    path = None # результат никому не нужен - ожидающие отменены во время скачивания
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                else:
+                    self.failed += 1
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                if not job.future.done():
+                    job.future.set_result(path)
+                self._queue.task_done()
+
+    async def fetch_native(self, video_url: str, max_bytes: int = AUDIO_INMEMORY_MAX_BYTES) -> Optional[Tuple[bytes, str]]:
+        """
+        Исходная m4a-дорожка целиком в памяти, без перекодирования и временных файлов.
+        Чтение - сетевой ввод-вывод, поэтому выполняется в потоке, а не в пуле процессов; одновременно
+        идет не больше native_workers чтений (каждое держит в памяти до max_bytes), остальные ждут слота.
+        None означает, что нужно использовать download() (перекодирование).
+        """
+        future = self._native_in_flight.get(video_url)
+        if future is not None:
+            self.deduplicated += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._native_in_flight[video_url] = future
+        if self._native_slots is None:
+            self._native_slots = asyncio.Semaphore(self.native_workers)
+        result = None
+        try:
+            await self._native_slots.acquire()
+            # Слот освобождается по завершении потока, а не вызывающего: отмененное чтение продолжает держать буфер
+            thread_job = asyncio.ensure_future(asyncio.to_thread(_fetch_native_job, video_url, max_bytes))
+            thread_job.add_done_callback(lambda _: self._native_slots.release())
+            result = await asyncio.shield(thread_job)
+        finally:
+            self._native_in_flight.pop(video_url, None)
+            if result:
+                self.native_completed += 1
+            else:
+                self.native_fallbacks += 1
+            future.set_result(result)
+        return result
+
+    def release(self, path: str):
+        """Освобождает файл, полученный из download(); каталог удаляется, когда его освободили все получатели."""
+        remaining = self._refs.get(path, 1) - 1
+        if remaining > 0:
+            self._refs[path] = remaining
+            return
+        self._refs.pop(path, None)
+        work_dir = os.path.dirname(path)
+        logger.debug(f"AudioPipeline: удаление каталога задания {work_dir}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            'workers': self.workers,
+            'queue_depth': self._queue.qsize() - self._stale_entries if self._queue else 0,
+            'in_flight': len(self._in_flight),
+            'native_in_flight': len(self._native_in_flight),
+            'completed': self.completed,
+            'failed': self.failed,
+            'deduplicated': self.deduplicated,
+            'native_completed': self.native_completed,
+            'native_fallbacks': self.native_fallbacks,
+            'latency_avg': self.latency_total / finished if finished else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    async def shutdown(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        for path in list(self._refs):
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        self._refs.clear()
+        self._queue = None
+        self._stale_entries = 0
+        logger.info(f"AudioPipeline: остановлен. Статистика: {self.stats()}")
+
+
+audio_pipeline = AudioDownloadPipeline()
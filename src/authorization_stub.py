@@ -0,0 +1,18 @@
+"""
+Замена authorization.py для запусков без учетных данных (бенчмарк, тесты): authorization.py содержит ключи
+и не хранится в репозитории. Клиенты API пустые, параметры БД - фиктивные (пулы соединений создаются лениво,
+поэтому к PostgreSQL такие запуски не обращаются).
+"""
+import sys
+import types
+
+
+def install(db_name: str = 'offline'):
+    """Регистрирует модуль authorization с пустыми клиентами, если настоящий еще не импортирован."""
+    if 'authorization' in sys.modules:
+        return
+    stub = types.ModuleType('authorization')
+    stub.bot = stub.sp = stub.youtube = stub.lastfm_network = None
+    stub.DB_HOST, stub.DB_PORT = 'localhost', '5432'
+    stub.DB_NAME = stub.DB_USER = stub.DB_PASSWORD = db_name
+    sys.modules['authorization'] = stub
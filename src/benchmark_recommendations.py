@@ -0,0 +1,261 @@
+"""
+Бенчмарк конвейера рекомендаций на синтетических данных, без сети и без PostgreSQL.
+
+Генерирует пользователей и оценки со степенным (Zipf) распределением популярности треков
+и запускает Recommender (recommender.py) с синтетической БД в памяти и заглушками
+SpotifyAgent/LastFMAgent с детерминированными задержками; бот и клиенты API не импортируются. Замеряет время и пиковую память (tracemalloc) по этапам
+и печатает результат в JSON, чтобы сравнивать прогоны между релизами.
+
+Пример: python benchmark_recommendations.py --ratings 100000 --users 5000 --output bench.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import platform
+import statistics
+import time
+import tracemalloc
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+import authorization_stub
+
+authorization_stub.install('benchmark') # до импорта модулей, читающих authorization.py
+
+from cache import RecommendationCache
+from collaborative import NeighbourModel, SparseRatingMatrix
+from config import SPOTIFY_TRACKS_BATCH_SIZE
+from ratings_snapshot import RatingsSnapshot
+from recommender import Recommender
+from user_mapping import UserMappingCache
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_ID_OFFSET = 10_000_000 # Telegram ID синтетического пользователя = смещение + user_num
+
+
+# --- Синтетические данные ---
+
+def generate_ratings(n_ratings: int, n_users: int, n_tracks: int, zipf_exponent: float, seed: int) -> List[tuple]:
+    """
+    Строки (user_num, track_id, rating, rated_at) как из database.get_ratings_since.
+    Популярность треков и активность пользователей - степенные, повторные пары отбрасываются.
+    """
+    rng = np.random.default_rng(seed)
+    track_popularity = 1.0 / np.arange(1, n_tracks + 1) ** zipf_exponent
+    user_activity = 1.0 / np.arange(1, n_users + 1) ** 0.5
+    tracks = rng.choice(n_tracks, size=n_ratings, p=track_popularity / track_popularity.sum())
+    users = rng.permutation(n_users)[rng.choice(n_users, size=n_ratings, p=user_activity / user_activity.sum())] + 1
+    ratings = rng.integers(1, 6, size=n_ratings)
+    keys = users.astype(np.int64) * n_tracks + tracks
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    rated_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [(int(users[i]), f"trk{int(tracks[i]):019d}", int(ratings[i]), rated_at) for i in first]
+
+
+# --- Заглушки внешних API ---
+
+class StubSpotifyAgent:
+    """SpotifyAgent без сети: ответы детерминированы, каждый вызов ждет фиксированную задержку."""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sp = True
+        self.calls = 0
+
+    def _info(self, track_id: str) -> Dict[str, Any]:
+        return {'id': track_id, 'name': f"Track {track_id[-6:]}", 'artist_name': f"Artist {track_id[-2:]}",
+                'artist_names': [f"Artist {track_id[-2:]}"], 'artist_id': f"art{track_id[-2:]}",
+                'spotify_url': f"https://open.spotify.com/track/{track_id}"}
+
+    async def _call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def get_tracks_basic_info(self, track_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        track_ids = list(dict.fromkeys(t for t in track_ids if t))
+        for _ in range(0, len(track_ids), SPOTIFY_TRACKS_BATCH_SIZE):
+            await self._call()
+        return {track_id: self._info(track_id) for track_id in track_ids}
+
+    async def get_track_basic_info(self, track_id: str) -> Optional[Dict[str, Any]]:
+        await self._call()
+        return self._info(track_id)
+
+    async def resolve_track(self, track_title: str, artist_name: str) -> Optional[Dict[str, Any]]:
+        await self._call()
+        return self._info(f"res{zlib.crc32(f'{track_title}|{artist_name}'.encode()):019d}")
+
+    async def get_artist_top_tracks(self, artist_id: str, country: str = "US", limit: int = 2) -> List[Dict[str, Any]]:
+        await self._call()
+        return [self._info(f"top{artist_id}{i:014d}") for i in range(limit)]
+
+class StubLastFMAgent:
+    """LastFMAgent без сети: возвращает limit похожих треков после фиксированной задержки."""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lastfm = True
+        self.calls = 0
+
+    async def get_similar_tracks(self, track_title: str, artist_name: str, limit: int = 5) -> List[Dict[str, str]]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [{'name': f"{track_title} similar {i}", 'artist_name': artist_name} for i in range(limit)]
+
+class SyntheticDatabase:
+    """Асинхронные функции БД, нужные Recommender (как в async_database.py), над синтетическими оценками."""
+    def __init__(self, ratings_by_telegram_id: Dict[int, List[tuple]]):
+        self.ratings_by_telegram_id = ratings_by_telegram_id
+
+    async def get_precomputed_recommendations(self, telegram_user_id: int, engine: str, max_age: float) -> Optional[List[str]]:
+        return None
+
+    async def get_top_rated_tracks(self, telegram_user_id: int, min_rating: int = 4) -> List[str]:
+        return [track_id for track_id, rating in self.ratings_by_telegram_id.get(telegram_user_id, []) if rating >= min_rating]
+
+    async def get_item_based_recommendations(self, telegram_user_id: int, min_rating: int, limit: int) -> List[str]:
+        return []
+
+
+# --- Замеры ---
+
+def _measure(results: Dict[str, Any], stage: str, func: Callable, *args):
+    """Выполняет func(*args), записывает время и пиковую память этапа в results."""
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    value = func(*args)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    results[stage] = {'seconds': round(seconds, 6), 'peak_memory_bytes': peak - base}
+    return value
+
+def _latency_summary(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'mean': round(statistics.fmean(ordered), 6),
+        'p50': round(ordered[len(ordered) // 2], 6),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 6),
+        'max': round(ordered[-1], 6),
+    }
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    rows = generate_ratings(args.ratings, args.users, args.tracks, args.zipf, args.seed)
+    user_nums = sorted({row[0] for row in rows})
+    user_map = {TELEGRAM_ID_OFFSET + user_num: user_num for user_num in user_nums}
+    ratings_by_telegram_id: Dict[int, List[tuple]] = {}
+    for user_num, track_id, rating, _ in rows:
+        ratings_by_telegram_id.setdefault(TELEGRAM_ID_OFFSET + user_num, []).append((track_id, rating))
+
+    # Синтетические данные вместо БД: снимок оценок и модели соседей - собственные экземпляры бенчмарка
+    snapshot = RatingsSnapshot(loader=lambda since=None: rows if since is None else [])
+    user_mapping = UserMappingCache()
+    user_mapping.update(user_map)
+    spotify_stub = StubSpotifyAgent(args.spotify_latency)
+    lastfm_stub = StubLastFMAgent(args.lastfm_latency)
+    cache = RecommendationCache()
+
+    def make_recommender(neighbours: NeighbourModel) -> Recommender:
+        return Recommender(
+            spotify_stub, lastfm_stub, database=SyntheticDatabase(ratings_by_telegram_id), snapshot=snapshot,
+            neighbours=neighbours, user_mapping=user_mapping, cache=cache, engine='cosine',
+        )
+
+    async def _generate_all(recommender: Recommender, latencies: List[float]):
+        for user_num in sample_users:
+            telegram_user_id = TELEGRAM_ID_OFFSET + user_num
+            cache.invalidate(telegram_user_id)
+            started = time.perf_counter()
+            await recommender.generate(telegram_user_id, args.k, 5)
+            latencies.append(time.perf_counter() - started)
+
+    rng = np.random.default_rng(args.seed + 1)
+    sample_users = rng.choice(user_nums, size=min(args.sample_users, len(user_nums)), replace=False).tolist()
+    stages: Dict[str, Any] = {}
+
+    tracemalloc.start()
+    try:
+        _measure(stages, 'snapshot_load', snapshot.refresh) # загрузка строк в RatingsStore (строки уже в памяти, без БД)
+        store = snapshot.store
+        matrix = _measure(stages, 'pivot', SparseRatingMatrix.from_store, store)
+        _measure(stages, 'similarity', lambda: [matrix.similarity_row(u) for u in sample_users])
+        neighbours = _measure(stages, 'neighbour_selection', lambda: {u: matrix.similar_users(u, args.k) for u in sample_users})
+        _measure(stages, 'scoring', lambda: [matrix.recommend_tracks(u, neighbours[u], 10) for u in sample_users])
+        _measure(stages, 'batch_recommend_all_users', matrix.recommend_for_users, user_nums, args.k, 10)
+        model = NeighbourModel(args.k, snapshot, user_mapping)
+        _measure(stages, 'neighbour_model_rebuild', model.rebuild)
+        recommender = make_recommender(model)
+
+        # Полный Recommender.generate (CF + контентный этап на заглушках + объединение).
+        # Как в боте - по загруженной модели соседей; отдельно - запасной путь по снимку (модель не загружена)
+        latencies = []
+        _measure(stages, 'generate_recommendations', asyncio.run, _generate_all(recommender, latencies))
+        snapshot_latencies = []
+        _measure(stages, 'generate_recommendations_snapshot', asyncio.run,
+                 _generate_all(make_recommender(NeighbourModel(args.k, snapshot, user_mapping)), snapshot_latencies))
+
+        # Recommender.stream: время до первой рекомендации (то, что видит пользователь в боте)
+        first_result_latencies = []
+        async def _stream():
+            for user_num in sample_users:
+                telegram_user_id = TELEGRAM_ID_OFFSET + user_num
+                cache.invalidate(telegram_user_id)
+                started = time.perf_counter()
+                first_result = None
+                async for _ in recommender.stream(telegram_user_id, args.k, 5):
+                    if first_result is None:
+                        first_result = time.perf_counter() - started
+                if first_result is not None:
+                    first_result_latencies.append(first_result)
+        _measure(stages, 'stream_recommendations', asyncio.run, _stream())
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'benchmark': 'recommendation_pipeline',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'params': {
+            'ratings_requested': args.ratings, 'ratings': len(rows), 'users': len(user_nums), 'tracks': args.tracks,
+            'zipf_exponent': args.zipf, 'k': args.k, 'sample_users': len(sample_users), 'seed': args.seed,
+            'spotify_latency': args.spotify_latency, 'lastfm_latency': args.lastfm_latency,
+        },
+        'store_bytes': store.nbytes,
+        'stages': stages,
+        'generate_recommendations_latency': _latency_summary(latencies),
+        'generate_recommendations_snapshot_latency': _latency_summary(snapshot_latencies),
+        'stream_first_result_latency': _latency_summary(first_result_latencies),
+        'stub_calls': {'spotify': spotify_stub.calls, 'lastfm': lastfm_stub.calls},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера рекомендаций на синтетических данных.")
+    parser.add_argument('--ratings', type=int, default=100_000, help="число оценок (до удаления повторов), 10k-1M")
+    parser.add_argument('--users', type=int, default=5_000)
+    parser.add_argument('--tracks', type=int, default=50_000)
+    parser.add_argument('--zipf', type=float, default=1.1, help="показатель степенного распределения популярности треков")
+    parser.add_argument('--k', type=int, default=5, help="число соседей")
+    parser.add_argument('--sample-users', type=int, default=50, help="пользователей для поштучных замеров")
+    parser.add_argument('--spotify-latency', type=float, default=0.02, help="задержка заглушки Spotify, с")
+    parser.add_argument('--lastfm-latency', type=float, default=0.05, help="задержка заглушки Last.fm, с")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="файл для JSON-результата (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    result = json.dumps(run_benchmark(args), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
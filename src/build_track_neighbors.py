@@ -0,0 +1,37 @@
+import logging
+import os
+import time
+
+from database import get_ratings, replace_track_neighbors, create_tables_if_not_exists, close_db_pool
+from collaborative import SparseRatingMatrix
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+TRACK_NEIGHBORS_K = int(os.getenv('TRACK_NEIGHBORS_K', '20'))
+TRACK_NEIGHBORS_CHUNK_SIZE = int(os.getenv('TRACK_NEIGHBORS_CHUNK_SIZE', '1000'))
+
+def build():
+    logger.info("Запуск пакетного расчета похожих треков (track_neighbors)...")
+    create_tables_if_not_exists()
+    df_ratings = get_ratings()
+    if df_ratings.empty:
+        logger.error("Нет оценок для расчета похожих треков.")
+        return
+
+    started = time.perf_counter()
+    rating_matrix = SparseRatingMatrix.from_ratings(df_ratings)
+    rows = rating_matrix.item_neighbours(k=TRACK_NEIGHBORS_K, chunk_size=TRACK_NEIGHBORS_CHUNK_SIZE)
+    logger.info(f"Расчет занял {time.perf_counter() - started:.1f} с.")
+    replace_track_neighbors(rows)
+
+if __name__ == "__main__":
+    # Запускается по расписанию (например, cron) отдельно от бота.
+    # Бот использует таблицу track_neighbors, если RECS_ENGINE=item.
+    try:
+        build()
+    finally:
+        close_db_pool()
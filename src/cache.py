@@ -0,0 +1,296 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from database import (
+    add_rating_listener,
+    get_tracks_metadata,
+    save_tracks_metadata,
+    get_cached_lastfm_similar,
+    save_cached_lastfm_similar,
+    get_cached_spotify_resolution,
+    save_cached_spotify_resolution,
+)
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш в памяти с ограничением по размеру и временем жизни записей.
+    Если задан name, попадания и промахи попадают в метрики (см. metrics.record_cache).
+    """
+    def __init__(self, max_size: int, ttl: float, name: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self._data: 'OrderedDict[Hashable, tuple]' = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[1] < time.monotonic():
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                hit = False
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                hit = True
+        if self.name:
+            record_cache(self.name, 'memory', hits=int(hit), misses=int(not hit))
+        return entry[0] if hit else default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+# --- Кэш метаданных треков Spotify ---
+TRACK_CACHE_SIZE = int(os.getenv('TRACK_CACHE_SIZE', '50000'))
+TRACK_CACHE_TTL = float(os.getenv('TRACK_CACHE_TTL', str(24 * 3600))) # секунд в памяти
+TRACK_DB_TTL = float(os.getenv('TRACK_DB_TTL', str(30 * 24 * 3600))) # секунд в таблице tracks
+
+class TrackMetadataCache:
+    """
+    Двухуровневый кэш метаданных треков (название, исполнители, ссылка):
+    LRU с TTL в памяти перед таблицей tracks в PostgreSQL.
+    Методы синхронные - вызываются из потоков SpotifyAgent.
+    """
+    def __init__(self, max_size: int = TRACK_CACHE_SIZE, ttl: float = TRACK_CACHE_TTL, db_ttl: float = TRACK_DB_TTL):
+        self.memory = TTLCache(max_size, ttl, name='track_metadata')
+        self.db_ttl = db_ttl
+        self._lock = threading.Lock()
+        self.db_hits = 0
+        self.db_misses = 0
+
+    def get_many(self, track_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Возвращает найденные в кэше метаданные; отсутствующих ID в результате нет."""
+        found = {}
+        missing = []
+        for track_id in dict.fromkeys(track_ids):
+            info = self.memory.get(track_id)
+            if info is not None:
+                found[track_id] = info
+            else:
+                missing.append(track_id)
+        if missing:
+            from_db = get_tracks_metadata(missing, self.db_ttl)
+            with self._lock:
+                self.db_hits += len(from_db)
+                self.db_misses += len(missing) - len(from_db)
+            record_cache('track_metadata', 'db', hits=len(from_db), misses=len(missing) - len(from_db))
+            for track_id, info in from_db.items():
+                self.memory.set(track_id, info)
+            found.update(from_db)
+        return found
+
+    def get(self, track_id: str) -> Optional[Dict[str, Any]]:
+        return self.get_many([track_id]).get(track_id)
+
+    def put_many(self, tracks_info: List[Dict[str, Any]]):
+        """Кладет метаданные в память и в таблицу tracks (одним запросом)."""
+        tracks_info = [info for info in tracks_info if info and info.get('id')]
+        if not tracks_info:
+            return
+        for info in tracks_info:
+            self.memory.set(info['id'], info)
+        save_tracks_metadata(tracks_info)
+
+    def put(self, track_info: Dict[str, Any]):
+        self.put_many([track_info])
+
+    def stats(self) -> Dict[str, int]:
+        memory_stats = self.memory.stats()
+        with self._lock:
+            return {
+                'memory_size': memory_stats['size'],
+                'memory_hits': memory_stats['hits'],
+                'memory_misses': memory_stats['misses'],
+                'db_hits': self.db_hits,
+                'db_misses': self.db_misses,
+            }
+
+track_metadata_cache = TrackMetadataCache()
+
+
+# --- Кэш похожих треков Last.fm и сопоставления Last.fm -> Spotify ---
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', '20000'))
+LASTFM_SIMILAR_TTL = float(os.getenv('LASTFM_SIMILAR_TTL', str(7 * 24 * 3600))) # секунд в таблице
+LASTFM_SIMILAR_MEMORY_TTL = float(os.getenv('LASTFM_SIMILAR_MEMORY_TTL', str(24 * 3600))) # секунд в памяти
+SPOTIFY_RESOLVE_TTL = float(os.getenv('SPOTIFY_RESOLVE_TTL', str(30 * 24 * 3600))) # секунд в таблице
+SPOTIFY_RESOLVE_MEMORY_TTL = float(os.getenv('SPOTIFY_RESOLVE_MEMORY_TTL', str(24 * 3600))) # секунд в памяти
+NEGATIVE_LOOKUP_TTL = float(os.getenv('NEGATIVE_LOOKUP_TTL', str(24 * 3600))) # для результатов "не найдено"
+
+def normalize_track_key(track_title: str, artist_name: str) -> Tuple[str, str]:
+    return track_title.strip().lower(), artist_name.strip().lower()
+
+class _PersistentLookupCache:
+    """Общая часть кэшей внешних запросов: LRU в памяти перед таблицей PostgreSQL, отдельный TTL для "не найдено"."""
+    def __init__(self, name: str, max_size: int, ttl: float, memory_ttl: float, negative_ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = TTLCache(max_size, min(ttl, memory_ttl), name=name)
+        self._lock = threading.Lock()
+        self.db_hits = 0
+        self.db_misses = 0
+
+    def _memory_ttl(self, negative: bool) -> float:
+        return min(self.negative_ttl, self.memory.ttl) if negative else self.memory.ttl
+
+    def _count_db(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.db_hits += 1
+            else:
+                self.db_misses += 1
+        record_cache(self.name, 'db', hits=int(hit), misses=int(not hit))
+
+    def stats(self) -> Dict[str, int]:
+        memory_stats = self.memory.stats()
+        with self._lock:
+            return {
+                'memory_size': memory_stats['size'],
+                'memory_hits': memory_stats['hits'],
+                'memory_misses': memory_stats['misses'],
+                'db_hits': self.db_hits,
+                'db_misses': self.db_misses,
+            }
+
+class LastFMSimilarCache(_PersistentLookupCache):
+    """(название, исполнитель) -> список похожих треков Last.fm (пустой список тоже кэшируется)."""
+    def __init__(self, max_size: int = LOOKUP_CACHE_SIZE, ttl: float = LASTFM_SIMILAR_TTL,
+                 memory_ttl: float = LASTFM_SIMILAR_MEMORY_TTL, negative_ttl: float = NEGATIVE_LOOKUP_TTL):
+        super().__init__('lastfm_similar', max_size, ttl, memory_ttl, negative_ttl)
+
+    def get(self, track_title: str, artist_name: str, limit: int) -> Optional[List[Dict[str, str]]]:
+        key = normalize_track_key(track_title, artist_name)
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = get_cached_lastfm_similar(*key, self.ttl, self.negative_ttl)
+            self._count_db(entry is not None)
+            if entry is None:
+                return None
+            self.memory.set(key, entry, ttl=self._memory_ttl(not entry[1]))
+        similar_limit, similar_tracks = entry
+        if similar_limit < limit and len(similar_tracks) >= similar_limit:
+            return None # в кэше меньше результатов, чем нужно сейчас, и Last.fm мог бы вернуть больше
+        return similar_tracks[:limit]
+
+    def put(self, track_title: str, artist_name: str, limit: int, similar_tracks: List[Dict[str, str]]):
+        key = normalize_track_key(track_title, artist_name)
+        self.memory.set(key, (limit, similar_tracks), ttl=self._memory_ttl(not similar_tracks))
+        save_cached_lastfm_similar(*key, limit, similar_tracks)
+
+class SpotifyResolveCache(_PersistentLookupCache):
+    """(название, исполнитель) -> Spotify ID; None означает закэшированное "не найдено в Spotify"."""
+    def __init__(self, max_size: int = LOOKUP_CACHE_SIZE, ttl: float = SPOTIFY_RESOLVE_TTL,
+                 memory_ttl: float = SPOTIFY_RESOLVE_MEMORY_TTL, negative_ttl: float = NEGATIVE_LOOKUP_TTL):
+        super().__init__('spotify_resolve', max_size, ttl, memory_ttl, negative_ttl)
+
+    def get(self, track_title: str, artist_name: str) -> Tuple[bool, Optional[str]]:
+        key = normalize_track_key(track_title, artist_name)
+        track_id = self.memory.get(key, _MISSING)
+        if track_id is not _MISSING:
+            return True, track_id
+        found, track_id = get_cached_spotify_resolution(*key, self.ttl, self.negative_ttl)
+        self._count_db(found)
+        if found:
+            self.memory.set(key, track_id, ttl=self._memory_ttl(track_id is None))
+        return found, track_id
+
+    def put(self, track_title: str, artist_name: str, track_spotify_id: Optional[str]):
+        key = normalize_track_key(track_title, artist_name)
+        self.memory.set(key, track_spotify_id, ttl=self._memory_ttl(track_spotify_id is None))
+        save_cached_spotify_resolution(*key, track_spotify_id)
+
+lastfm_similar_cache = LastFMSimilarCache()
+spotify_resolve_cache = SpotifyResolveCache()
+
+
+# --- Кэш рассчитанных рекомендаций пользователя ---
+RECS_CACHE_SIZE = int(os.getenv('RECS_CACHE_SIZE', '10000'))
+RECS_CACHE_TTL = float(os.getenv('RECS_CACHE_TTL', str(30 * 60)))
+
+class RecommendationCache:
+    """
+    Telegram ID -> все рассчитанные кандидаты и сколько из них уже показано.
+    Сбрасывается, когда пользователь сохраняет новую оценку.
+    Расчет, начатый до сброса, в кэш не попадет: версия - номер последнего сброса (общий счетчик),
+    а последние сбросы помнятся не больше чем для max_size пользователей. Для забытых сбросов
+    проверка консервативная: отклоняется любой расчет, начатый до последнего забытого сброса.
+    """
+    def __init__(self, max_size: int = RECS_CACHE_SIZE, ttl: float = RECS_CACHE_TTL):
+        self.memory = TTLCache(max_size, ttl, name='recommendations')
+        self._lock = threading.Lock()
+        self._generation = 0 # число сбросов за все время
+        self._invalidated: 'OrderedDict[int, int]' = OrderedDict() # user_id -> номер последнего сброса
+        self._forgotten = 0 # номер последнего вытесненного из _invalidated сброса
+
+    def next_page(self, user_id: int, n: int) -> Optional[List[Dict[str, Any]]]:
+        """Следующие n непоказанных кандидатов или None, если кэша нет или кандидаты закончились."""
+        with self._lock:
+            entry = self.memory.get(user_id)
+            if entry is None:
+                return None
+            page = entry['candidates'][entry['shown']:entry['shown'] + n]
+            if not page:
+                self.memory.pop(user_id)
+                return None
+            entry['shown'] += len(page)
+            return page
+
+    def version(self, user_id: int) -> int:
+        with self._lock:
+            return self._generation
+
+    def put(self, user_id: int, candidates: List[Dict[str, Any]], shown: int, version: int):
+        with self._lock:
+            if version < self._invalidated.get(user_id, self._forgotten):
+                return # пока шел расчет, пользователь поставил новую оценку
+            self.memory.set(user_id, {'candidates': candidates, 'shown': shown})
+
+    def invalidate(self, user_id: int, *_):
+        with self._lock:
+            self._generation += 1
+            self._invalidated[user_id] = self._generation
+            self._invalidated.move_to_end(user_id)
+            while len(self._invalidated) > self.memory.max_size:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+            self.memory.pop(user_id)
+
+    def stats(self) -> Dict[str, int]:
+        return self.memory.stats()
+
+recommendation_cache = RecommendationCache()
+add_rating_listener(recommendation_cache.invalidate)
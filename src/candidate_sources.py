@@ -0,0 +1,122 @@
+import abc
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from metrics import registry, Histogram
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DURATION = registry.register(Histogram(
+    'mrs_candidate_source_duration_seconds', "Длительность источников кандидатов (outcome: ok, error, late, cancelled).", ('source', 'outcome')
+))
+
+
+class CandidateContext:
+    """
+    Входные данные одного запроса рекомендаций, общие для всех источников. Промежуточные результаты,
+    нужные нескольким источникам (например, сид-треки), считаются один раз через shared().
+    """
+    def __init__(self, telegram_user_id: int, user_num: int, k_similar_users: int, num_recs: int,
+                 rated_track_ids: set, **extra: Any):
+        self.telegram_user_id = telegram_user_id
+        self.user_num = user_num
+        self.k_similar_users = k_similar_users
+        self.num_recs = num_recs
+        self.rated_track_ids = rated_track_ids
+        self.extra = extra # данные для конкретных источников (агенты API, снимок оценок и т.п.)
+        self._shared: Dict[str, asyncio.Task] = {}
+
+    async def shared(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Результат factory(), вычисляемый один раз на запрос. Отмена одного ожидающего не отменяет расчет для остальных."""
+        task = self._shared.get(key)
+        if task is None:
+            task = self._shared[key] = asyncio.create_task(factory())
+        return await asyncio.shield(task)
+
+
+class CandidateSource(abc.ABC):
+    """
+    Источник кандидатов для рекомендаций. fetch() возвращает треки в формате рекомендаций
+    (track_id, track_name, artist_names, spotify_url, source) в порядке убывания предпочтения.
+    Уже оцененные треки фильтруются при объединении, источнику исключать их не обязательно.
+    Не успевший к дедлайну fetch() отменяется; работу, нужную и другим источникам, выносите в context.shared().
+    """
+    name = 'source'
+
+    @abc.abstractmethod
+    async def fetch(self, context: CandidateContext) -> List[Dict[str, Any]]:
+        ...
+
+
+async def _run_source(source: CandidateSource, context: CandidateContext) -> Tuple[List[Dict[str, Any]], str, float]:
+    started = time.perf_counter()
+    try:
+        candidates = await source.fetch(context)
+        return candidates or [], 'ok', time.perf_counter() - started
+    except Exception as e:
+        logger.error(f"CandidateSource[{source.name}]: ошибка: {e}", exc_info=True)
+        return [], 'error', time.perf_counter() - started
+
+async def iter_candidate_batches(sources: Sequence[CandidateSource], context: CandidateContext,
+                                 deadline: float) -> AsyncIterator[Tuple[CandidateSource, List[Dict[str, Any]]]]:
+    """
+    Запускает все источники параллельно и отдает (источник, кандидаты) по мере готовности, пока не наступит
+    deadline (time.monotonic()). Не успевшие источники (или оставшиеся, если перебор прервали раньше)
+    отменяются, и генератор дожидается их завершения, чтобы ошибки не терялись. Общие для источников
+    расчеты в context.shared() отмена не прерывает.
+    """
+    order = {source: index for index, source in enumerate(sources)}
+    started = time.perf_counter()
+    tasks = {asyncio.create_task(_run_source(source, context)): source for source in sources}
+    pending = set(tasks)
+    try:
+        while pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: order[tasks[t]]):
+                source = tasks[task]
+                candidates, outcome, duration = task.result()
+                SOURCE_DURATION.observe(duration, source=source.name, outcome=outcome)
+                yield source, candidates
+    finally:
+        pending = [task for task in pending if not task.done()]
+        outcome = 'late' if time.monotonic() >= deadline else 'cancelled'
+        for task in pending:
+            source = tasks[task]
+            if outcome == 'late':
+                logger.warning(f"CandidateSource[{source.name}]: не уложился в бюджет времени, отменен.")
+            SOURCE_DURATION.observe(time.perf_counter() - started, source=source.name, outcome=outcome)
+            task.cancel()
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        for task, result in zip(pending, results):
+            if isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError):
+                logger.error(f"CandidateSource[{tasks[task].name}]: ошибка при отмене: {result}", exc_info=result)
+
+async def collect_candidates(sources: Sequence[CandidateSource], context: CandidateContext,
+                             deadline: float) -> List[List[Dict[str, Any]]]:
+    """Кандидаты успевших источников, в порядке sources (пустой список - источник не успел или упал)."""
+    results: Dict[CandidateSource, List[Dict[str, Any]]] = {}
+    async for source, candidates in iter_candidate_batches(sources, context, deadline):
+        results[source] = candidates
+    return [results.get(source, []) for source in sources]
+
+def merge_candidates(batches: Sequence[List[Dict[str, Any]]], exclude: set, seen: Optional[set] = None) -> List[Dict[str, Any]]:
+    """
+    Объединяет списки кандидатов: первый попавшийся трек побеждает, оцененные (exclude) и уже
+    встречавшиеся (seen, дополняется) отбрасываются; коллаборативные - первыми.
+    """
+    seen = set() if seen is None else seen
+    merged = []
+    for candidates in batches:
+        for rec in candidates:
+            track_id = rec.get('track_id')
+            if track_id and track_id not in seen:
+                seen.add(track_id)
+                if track_id not in exclude:
+                    merged.append(rec)
+    merged.sort(key=lambda rec: rec['source'] != 'collaborative')
+    return merged
@@ -0,0 +1,464 @@
+import asyncio
+import heapq
+import logging
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+from database import add_rating_listener
+from ratings_snapshot import RatingsSnapshot, ratings_snapshot
+from ratings_store import RatingsStore
+from user_mapping import UserMappingCache, user_mapping_cache
+from write_buffer import write_buffer
+
+logger = logging.getLogger(__name__)
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Индексы k наибольших значений scores по убыванию (частичная сортировка через np.partition).
+    При равенстве значений раньше идет меньший индекс - так же, как в pandas nlargest(keep='first').
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, kind='stable')
+    kth_value = np.partition(scores, n - k)[n - k]
+    above = np.flatnonzero(scores > kth_value)
+    ties = np.flatnonzero(scores == kth_value)[:k - len(above)]
+    candidates = np.sort(np.concatenate([above, ties]))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def _normalize_rows(ratings: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Строки матрицы оценок, деленные на свою норму (скалярное произведение строк = косинусная схожесть)."""
+    row_norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=1)).ravel())
+    row_norms[row_norms == 0] = 1.0
+    return sparse.csr_matrix(sparse.diags(1.0 / row_norms) @ ratings)
+
+class SparseRatingMatrix:
+    """
+    Разреженная матрица оценок (CSR): строки - пользователи (user_num), столбцы - треки (Spotify ID).
+    Пользователи и треки индексируются целыми числами в отсортированном порядке,
+    как индекс и столбцы pivot_table, поэтому порядок при равных оценках совпадает с прежним.
+    """
+    def __init__(self, user_ids: np.ndarray, track_ids: np.ndarray, ratings: sparse.csr_matrix):
+        self.user_ids = user_ids
+        self.track_ids = track_ids
+        self.user_index = {user_id: idx for idx, user_id in enumerate(user_ids.tolist())}
+        self.ratings = ratings
+        # Нормированные по строкам оценки: скалярное произведение строк = косинусная схожесть
+        self._normalized = _normalize_rows(ratings)
+        # Транспонированная копия (треки x пользователи) для умножения на вектор весов соседей
+        self._ratings_t = ratings.T.tocsr()
+
+    @classmethod
+    def from_ratings(cls, df_ratings: pd.DataFrame) -> 'SparseRatingMatrix':
+        """Строит матрицу из DataFrame с колонками user_id, track_id, rating (результат get_ratings)."""
+        if df_ratings.empty:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=object), sparse.csr_matrix((0, 0)))
+        df = df_ratings.drop_duplicates(subset=['user_id', 'track_id'], keep='last')
+        user_ids, user_codes = np.unique(df['user_id'].to_numpy(), return_inverse=True)
+        track_ids, track_codes = np.unique(df['track_id'].to_numpy(dtype=object), return_inverse=True)
+        ratings = sparse.csr_matrix(
+            (df['rating'].to_numpy(dtype=np.float64), (user_codes, track_codes)),
+            shape=(len(user_ids), len(track_ids))
+        )
+        ratings.sort_indices()
+        logger.info(f"Построена разреженная матрица оценок: {len(user_ids)} пользователей x {len(track_ids)} треков, {ratings.nnz} оценок.")
+        return cls(user_ids, track_ids, ratings)
+
+    @classmethod
+    def from_store(cls, store: RatingsStore) -> 'SparseRatingMatrix':
+        """Строит матрицу напрямую из RatingsStore, без промежуточного DataFrame."""
+        user_ids, track_ids, ratings = store.to_csr()
+        return cls(user_ids, track_ids, ratings)
+
+    @property
+    def empty(self) -> bool:
+        return self.ratings.nnz == 0
+
+    def has_user(self, user_id: int) -> bool:
+        return user_id in self.user_index
+
+    def similarity_row(self, user_id: int) -> Optional[np.ndarray]:
+        """Косинусная схожесть пользователя со всеми пользователями матрицы (только одна строка)."""
+        row_idx = self.user_index.get(user_id)
+        if row_idx is None:
+            return None
+        target_vector = self._normalized[row_idx]
+        return np.asarray((self._normalized @ target_vector.T).todense()).ravel()
+
+    def similar_users(self, user_id: int, k: int = 5) -> List[int]:
+        """k наиболее похожих пользователей (user_num) без самого пользователя."""
+        similarities = self.similarity_row(user_id)
+        if similarities is None:
+            logger.warning(f"Пользователь {user_id} отсутствует в матрице оценок.")
+            return []
+        row_idx = self.user_index[user_id]
+        other_rows = np.delete(np.arange(len(similarities)), row_idx)
+        top_rows = other_rows[_top_k_indices(similarities[other_rows], k)]
+        similar_user_ids = self.user_ids[top_rows].tolist()
+        logger.debug(f"Найдены похожие пользователи: {similar_user_ids} для {user_id}")
+        return similar_user_ids
+
+    def recommend_tracks(self, user_id: int, neighbour_ids: List[int], n: int) -> List[str]:
+        """
+        n треков с наибольшей средней оценкой среди соседей (неоцененные треки считаются нулями),
+        исключая треки, уже оцененные пользователем.
+        """
+        neighbour_rows = [self.user_index[u] for u in neighbour_ids if u in self.user_index]
+        row_idx = self.user_index.get(user_id)
+        if not neighbour_rows or row_idx is None:
+            return []
+        weights = np.zeros(len(self.user_ids))
+        weights[neighbour_rows] = 1.0
+        mean_scores = self._ratings_t.dot(weights) / len(neighbour_rows)
+
+        rated_by_user = self.ratings.indices[self.ratings.indptr[row_idx]:self.ratings.indptr[row_idx + 1]]
+        candidate_cols = np.setdiff1d(np.arange(len(self.track_ids)), rated_by_user, assume_unique=True)
+        top_cols = candidate_cols[_top_k_indices(mean_scores[candidate_cols], n)]
+        return self.track_ids[top_cols].tolist()
+
+    def recommend_for_users(self, user_ids: List[int], k: int = 5, n: int = 10, chunk_size: int = 500) -> Dict[int, List[str]]:
+        """
+        Пакетный вариант recommend_tracks(similar_users()) сразу для многих пользователей: схожесть,
+        выбор соседей и скоры считаются матричными операциями по блокам из chunk_size пользователей.
+        Результаты совпадают с поштучным расчетом.
+        """
+        rows = np.array([self.user_index[u] for u in user_ids if u in self.user_index], dtype=np.int64)
+        n_users = len(self.user_ids)
+        k = min(k, n_users - 1)
+        results: Dict[int, List[str]] = {}
+        if k <= 0 or n <= 0 or len(rows) == 0:
+            return results
+        for block_start in range(0, len(rows), chunk_size):
+            block_rows = rows[block_start:block_start + chunk_size]
+            block_positions = np.arange(len(block_rows))
+            similarities = (self._normalized[block_rows] @ self._normalized.T).toarray()
+            similarities[block_positions, block_rows] = -np.inf # сам пользователь не сосед
+            # Устойчивая сортировка: при равной схожести раньше идет меньший индекс, как в _top_k_indices
+            neighbour_rows = np.argsort(-similarities, axis=1, kind='stable')[:, :k]
+            weights = sparse.csr_matrix(
+                (np.ones(neighbour_rows.size), (np.repeat(block_positions, k), neighbour_rows.ravel())),
+                shape=(len(block_rows), n_users)
+            )
+            mean_scores = (weights @ self.ratings).toarray() / k
+            rated = self.ratings[block_rows].tocoo()
+            mean_scores[rated.row, rated.col] = -np.inf # уже оцененные пользователем треки
+            top_cols = np.argsort(-mean_scores, axis=1, kind='stable')[:, :n]
+            for position, row_idx in enumerate(block_rows):
+                cols = top_cols[position]
+                cols = cols[np.isfinite(mean_scores[position, cols])]
+                results[int(self.user_ids[row_idx])] = self.track_ids[cols].tolist()
+        logger.info(f"Посчитаны рекомендации для {len(results)} пользователей.")
+        return results
+
+    def item_neighbours(self, k: int = 20, chunk_size: int = 1000) -> List[Tuple[str, str, float]]:
+        """
+        Для каждого трека - k наиболее похожих треков (косинусная схожесть столбцов матрицы оценок).
+        Считается блоками по chunk_size треков, чтобы не строить всю матрицу треки x треки.
+        """
+        col_norms = np.sqrt(np.asarray(self.ratings.multiply(self.ratings).sum(axis=0)).ravel())
+        col_norms[col_norms == 0] = 1.0
+        normalized_t = sparse.csr_matrix(self._ratings_t.multiply(1.0 / col_norms[:, None]))
+        normalized = normalized_t.T.tocsr()
+        neighbours = []
+        n_tracks = len(self.track_ids)
+        for block_start in range(0, n_tracks, chunk_size):
+            block = (normalized_t[block_start:block_start + chunk_size] @ normalized).tocsr()
+            for offset in range(block.shape[0]):
+                track_idx = block_start + offset
+                start, end = block.indptr[offset], block.indptr[offset + 1]
+                cols, sims = block.indices[start:end], block.data[start:end]
+                keep = cols != track_idx
+                cols, sims = cols[keep], sims[keep]
+                for pos in _top_k_indices(sims, k):
+                    neighbours.append((self.track_ids[track_idx], self.track_ids[cols[pos]], float(sims[pos])))
+        logger.info(f"Посчитаны соседи для {n_tracks} треков: {len(neighbours)} пар.")
+        return neighbours
+
+
+NEIGHBOUR_MODEL_MAX_DIRTY = int(os.getenv('NEIGHBOUR_MODEL_MAX_DIRTY', '256')) # измененных пользователей до пересборки матрицы схожести
+
+
+class _SimilarityIndex:
+    """Нормированная по строкам CSR-матрица оценок на момент сборки (пользователи и треки - по возрастанию)."""
+    def __init__(self, store: RatingsStore):
+        self.user_ids, self.track_ids, ratings = store.to_csr()
+        self.normalized = _normalize_rows(ratings)
+
+    @staticmethod
+    def position(ids: np.ndarray, value) -> int:
+        """Позиция value в отсортированном массиве ids или -1."""
+        pos = int(np.searchsorted(ids, value))
+        return pos if pos < len(ids) and ids[pos] == value else -1
+
+class _Neighbours:
+    __slots__ = ('users', 'threshold', 'has_fillers')
+
+    def __init__(self, users: List[int], threshold: float, has_fillers: bool):
+        self.users = users
+        self.threshold = threshold # схожесть последнего (k-го) соседа
+        self.has_fillers = has_fillers # не хватило соседей с ненулевой схожестью
+
+class NeighbourModel:
+    """
+    Долгоживущая in-process модель соседей для коллаборативной фильтрации. Оценки хранятся один раз -
+    в RatingsStore снимка (update_rating пишет в него же), модель добавляет к ним только нормированную
+    CSR-матрицу для схожести и кэш списков соседей: для уже посчитанного пользователя соседи - поиск в словаре,
+    для остальных - одна строка схожести по разреженной матрице.
+    Новая оценка не пересобирает матрицу: пользователи, изменившиеся после сборки, досчитываются точно поверх нее
+    (при NEIGHBOUR_MODEL_MAX_DIRTY таких пользователей матрица пересобирается из хранилища). Кэш соседей
+    сбрасывается только у тех, в чей список оценивший пользователь мог войти или из него выйти.
+    Результаты совпадают с SparseRatingMatrix по тем же оценкам (с точностью до округления при равной схожести).
+    Расчеты идут вне блокировки; она защищает только кэш и учет изменений.
+    """
+    def __init__(self, k: int = 5, snapshot: RatingsSnapshot = ratings_snapshot,
+                 user_mapping: UserMappingCache = user_mapping_cache, max_dirty: int = NEIGHBOUR_MODEL_MAX_DIRTY):
+        self.k = k
+        self.snapshot = snapshot
+        self.user_mapping = user_mapping
+        self.max_dirty = max_dirty
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._store: Optional[RatingsStore] = None
+        self._index: Optional[_SimilarityIndex] = None
+        self._version = 0 # увеличивается при каждой примененной оценке
+        self._dirty: Dict[int, int] = {} # user_num, изменившийся после сборки матрицы -> версия изменения
+        self._neighbours: Dict[int, _Neighbours] = {} # кэш соседей для self.k
+        self._with_fillers: Set[int] = set()
+        self._reindexing = False
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def empty(self) -> bool:
+        return self._store is None or self._store.empty
+
+    # --- Загрузка и обновление ---
+
+    def rebuild(self) -> bool:
+        """
+        Полная перестройка модели по всем оценкам (снимок оценок догружает из БД только новые строки).
+        Оценки, пришедшие во время перестройки, не теряются. Модель, как и снимок, содержит только записанные
+        в БД оценки: буфер записи уведомляет подписчиков после записи пачки (см. write_buffer.py).
+        """
+        ratings_store = self.snapshot.get_store()
+        if ratings_store is None:
+            logger.error("NeighbourModel: не удалось загрузить оценки, модель не перестроена.")
+            return False
+        with self._lock:
+            self._store = ratings_store
+        self._reindex(reset_neighbours=True)
+        self._loaded = True
+        logger.info(f"NeighbourModel: модель перестроена ({len(self._index.user_ids)} пользователей, "
+                    f"{len(self._index.track_ids)} треков).")
+        return True
+
+    def _reindex(self, reset_neighbours: bool = False):
+        """Пересобирает матрицу схожести из хранилища; изменения, пришедшие во время сборки, остаются досчитываемыми."""
+        with self._lock:
+            started_version = self._version
+        index = _SimilarityIndex(self._store)
+        with self._lock:
+            self._index = index
+            self._dirty = {user_num: version for user_num, version in self._dirty.items() if version > started_version}
+            if reset_neighbours:
+                self._neighbours = {}
+                self._with_fillers = set()
+
+    def update_rating(self, telegram_user_id: int, track_spotify_id: str, rating: int):
+        """Применяет новую оценку пользователя без полной перестройки модели."""
+        if not self._loaded:
+            return
+        user_num = self.user_mapping.get_user_num_sync(telegram_user_id)
+        if user_num == -1:
+            logger.warning(f"NeighbourModel: user_num не найден для telegram_user_id={telegram_user_id}, оценка не учтена в модели.")
+            return
+        with self._lock:
+            is_new_user = user_num not in self._dirty and self._index.position(self._index.user_ids, user_num) == -1
+            if not self._store.upsert(user_num, track_spotify_id, rating):
+                return
+            self._version += 1
+            self._dirty[user_num] = self._version
+            self._invalidate(user_num, is_new_user)
+            reindex = len(self._dirty) > self.max_dirty and not self._reindexing
+            self._reindexing = self._reindexing or reindex
+        if reindex:
+            try:
+                self._reindex()
+            finally:
+                self._reindexing = False
+
+    def _invalidate(self, user_num: int, is_new_user: bool):
+        """Сбрасывает кэш соседей, в который user_num с новым вектором мог войти или из которого мог выйти."""
+        self._neighbours.pop(user_num, None)
+        self._with_fillers.discard(user_num)
+        if not self._neighbours:
+            return
+        user_ids, similarities = self._similarity_row(user_num, self._index, self._dirty)
+        # Оценки положительны, поэтому схожесть с user_num могла измениться только у пользователей с общими треками
+        # (ненулевая схожесть); новый пользователь вдобавок может стать "нулевым" соседом у тех, кому их не хватило
+        affected = user_ids[np.flatnonzero(similarities > 0)].tolist()
+        if is_new_user:
+            affected.extend(self._with_fillers)
+        for other in affected:
+            cached = self._neighbours.get(other)
+            if cached is None:
+                continue
+            pos = _SimilarityIndex.position(user_ids, other)
+            similarity = similarities[pos] if pos != -1 else 0.0
+            if user_num in cached.users or similarity > cached.threshold or (
+                    similarity == cached.threshold and (similarity > 0 or is_new_user)):
+                del self._neighbours[other]
+                self._with_fillers.discard(other)
+
+    # --- Запросы ---
+
+    def rated_tracks(self, user_num: int) -> Set[str]:
+        return set(self._store.user_ratings(user_num)) if self._store is not None else set()
+
+    def _similarity_row(self, user_num: int, index: _SimilarityIndex, dirty: Dict[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (user_num всех пользователей модели по возрастанию, их косинусная схожесть с user_num).
+        Строки пользователей из dirty считаются по актуальным оценкам хранилища, остальные - по матрице.
+        """
+        target = self._store.user_ratings(user_num)
+        target_tracks = sorted(target)
+        target_scale = 1.0 / (math.sqrt(sum(r * r for r in target.values())) or 1.0)
+        n_tracks = len(index.track_ids)
+        cols = np.searchsorted(index.track_ids, np.array(target_tracks, dtype=object)) if target_tracks else np.empty(0, dtype=np.int64)
+        known = [pos for pos, col in enumerate(cols.tolist()) if col < n_tracks and index.track_ids[col] == target_tracks[pos]]
+        target_vector = sparse.csr_matrix(
+            ([target[target_tracks[pos]] * target_scale for pos in known], ([0] * len(known), cols[known])),
+            shape=(1, n_tracks)
+        )
+        similarities = np.asarray((index.normalized @ target_vector.T).todense()).ravel()
+        user_ids = index.user_ids
+        extra_ids, extra_similarities = [], []
+        for other in dirty:
+            other_ratings = self._store.user_ratings(other)
+            other_scale = 1.0 / (math.sqrt(sum(r * r for r in other_ratings.values())) or 1.0)
+            # Тот же порядок суммирования, что и у умножения разреженных матриц (треки по возрастанию)
+            similarity = 0.0
+            for track_id in target_tracks:
+                if track_id in other_ratings:
+                    similarity += other_ratings[track_id] * other_scale * (target[track_id] * target_scale)
+            pos = index.position(user_ids, other)
+            if pos != -1:
+                similarities[pos] = similarity
+            else:
+                extra_ids.append(other)
+                extra_similarities.append(similarity)
+        if extra_ids:
+            user_ids = np.concatenate([user_ids, np.array(extra_ids, dtype=user_ids.dtype)])
+            similarities = np.concatenate([similarities, extra_similarities])
+            order = np.argsort(user_ids, kind='stable')
+            user_ids, similarities = user_ids[order], similarities[order]
+        return user_ids, similarities
+
+    def _compute_neighbours(self, user_num: int, k: int, index: _SimilarityIndex, dirty: Dict[int, int]) -> _Neighbours:
+        user_ids, similarities = self._similarity_row(user_num, index, dirty)
+        others = user_ids != user_num
+        other_ids, other_similarities = user_ids[others], similarities[others]
+        # Как и в SparseRatingMatrix: недостающих соседей с ненулевой схожестью добирают нулевые по порядку user_num
+        top = _top_k_indices(other_similarities, k)
+        if not len(top):
+            return _Neighbours([], 0.0, False)
+        threshold = float(other_similarities[top[-1]])
+        return _Neighbours(other_ids[top].tolist(), threshold, threshold <= 0)
+
+    def similar_users(self, user_num: int, k: Optional[int] = None) -> List[int]:
+        k = self.k if k is None else k
+        with self._lock:
+            if self._store is None or not self._store.has_user(user_num):
+                return []
+            cached = self._neighbours.get(user_num) if k == self.k else None
+            if cached is not None:
+                return list(cached.users)
+            version, index, dirty = self._version, self._index, dict(self._dirty)
+        neighbours = self._compute_neighbours(user_num, k, index, dirty)
+        if k == self.k:
+            with self._lock:
+                # Пока шел расчет, пришла новая оценка - результат мог устареть, не кэшируем
+                if self._version == version and self._index is index:
+                    self._neighbours[user_num] = neighbours
+                    if neighbours.has_fillers:
+                        self._with_fillers.add(user_num)
+        return list(neighbours.users)
+
+    def recommend(self, user_num: int, k: Optional[int] = None, n: int = 10) -> List[str]:
+        """n треков с наибольшей средней оценкой среди соседей, исключая уже оцененные пользователем."""
+        neighbours = self.similar_users(user_num, k)
+        if not neighbours:
+            return []
+        rated_by_user = self._store.user_ratings(user_num)
+        sums: Dict[str, float] = {}
+        for neighbour in neighbours:
+            for track_id, rating in self._store.user_ratings(neighbour).items():
+                if track_id not in rated_by_user:
+                    sums[track_id] = sums.get(track_id, 0.0) + rating
+        scored = sorted((-(total / len(neighbours)), track_id) for track_id, total in sums.items())
+        recommended = [track_id for _, track_id in scored[:n]]
+        if len(recommended) < n:
+            # Треки с нулевой средней оценкой - по порядку Spotify ID, как в SparseRatingMatrix
+            with self._lock:
+                index, dirty = self._index, list(self._dirty)
+            new_tracks = sorted({
+                track_id for other in dirty for track_id in self._store.user_ratings(other)
+                if index.position(index.track_ids, track_id) == -1
+            })
+            for track_id in heapq.merge(iter(index.track_ids), new_tracks):
+                if len(recommended) >= n:
+                    break
+                if track_id not in rated_by_user and track_id not in sums:
+                    recommended.append(track_id)
+        return recommended
+
+
+_rating_matrix: Optional[SparseRatingMatrix] = None
+_rating_matrix_version = -1
+_rating_matrix_store: Optional[RatingsStore] = None # хранилище, из которого собрана _rating_matrix
+_rating_matrix_lock = threading.Lock()
+
+def get_rating_matrix(snapshot: RatingsSnapshot = ratings_snapshot) -> Optional[SparseRatingMatrix]:
+    """Матрица оценок по актуальному снимку; пересобирается, только если оценки изменились."""
+    global _rating_matrix, _rating_matrix_version, _rating_matrix_store
+    ratings_store = snapshot.get_store()
+    if ratings_store is None:
+        return None
+    with _rating_matrix_lock:
+        if (_rating_matrix is None or _rating_matrix_store is not ratings_store
+                or _rating_matrix_version != ratings_store.version):
+            _rating_matrix_store = ratings_store
+            _rating_matrix_version = ratings_store.version
+            _rating_matrix = SparseRatingMatrix.from_store(ratings_store)
+        return _rating_matrix
+
+
+neighbour_model = NeighbourModel()
+add_rating_listener(neighbour_model.update_rating)
+
+NEIGHBOUR_MODEL_REBUILD_INTERVAL = float(os.getenv('NEIGHBOUR_MODEL_REBUILD_INTERVAL', '3600')) # секунд
+
+async def run_periodic_rebuild(model: NeighbourModel = neighbour_model, interval: float = NEIGHBOUR_MODEL_REBUILD_INTERVAL):
+    """
+    Фоновая задача: периодически полностью перестраивает модель соседей. Перед перестройкой дописывает
+    буфер записи, чтобы только что принятые оценки попали в снимок, а не ждали следующей перестройки.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await write_buffer.flush()
+            await asyncio.to_thread(model.rebuild)
+        except Exception as e:
+            logger.error(f"NeighbourModel: ошибка фоновой перестройки: {e}", exc_info=True)
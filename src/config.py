@@ -0,0 +1,16 @@
+"""
+Настройки конвейера рекомендаций, общие для бота (app.py) и пакетных скриптов
+(precompute_recommendations.py и т.п.). Модуль не импортирует клиентов API и authorization.py,
+поэтому пакетные задания можно запускать без учетных данных бота.
+"""
+import os
+
+# Движок коллаборативного этапа: 'cosine' (схожесть пользователей), 'mf' (матричная факторизация, см. train_mf.py)
+# или 'item' (похожие треки из таблицы track_neighbors, см. build_track_neighbors.py)
+RECS_ENGINE = os.getenv('RECS_ENGINE', 'cosine').lower()
+# Сколько секунд годятся результаты precompute_recommendations.py (если пользователь не ставил новых оценок)
+PRECOMPUTED_RECS_MAX_AGE = float(os.getenv('PRECOMPUTED_RECS_MAX_AGE', str(24 * 3600)))
+CONTENT_STAGE_CONCURRENCY = int(os.getenv('CONTENT_STAGE_CONCURRENCY', '8')) # одновременных запросов к API у источников кандидатов
+# Бюджет времени на расчет рекомендаций (от начала расчета): источники, не успевшие к этому моменту, отбрасываются
+RECS_LATENCY_BUDGET = float(os.getenv('RECS_LATENCY_BUDGET', '4')) # секунд
+SPOTIFY_TRACKS_BATCH_SIZE = 50 # максимум ID в одном запросе GET /tracks (ограничение Spotify API)
@@ -1,10 +1,18 @@
 import psycopg2
 import psycopg2.extras 
+import psycopg2.extensions
+import psycopg2.pool
 import pandas as pd
 import logging
 import os
+import threading
+import time
+import collections
+import csv
+import io
 
 from authorization import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+from metrics import timed_db
 
 logger = logging.getLogger(__name__)
 
@@ -28,13 +36,199 @@ def get_db_connection():
         raise
     except Exception as e: 
         logger.error(f"Непредвиденная ошибка при подключении к PostgreSQL: {e}")
-        raise 
+        raise
+
+# --- Пул соединений ---
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10')) # секунд ожидания свободного соединения
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', '30')) # после скольких секунд простоя проверять соединение
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Свободное соединение не появилось в пуле за отведенное время."""
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений PostgreSQL.
+    Если все соединения заняты, вызывающий поток ждет освобождения (до timeout секунд).
+    Соединения, простоявшие дольше healthcheck_interval, проверяются запросом SELECT 1 при выдаче.
+    """
+    def __init__(self, min_size: int, max_size: int, timeout: float, healthcheck_interval: float):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = collections.deque() # (conn, время возврата в пул)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        # Статистика
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._discarded = 0
+
+    def prefill(self):
+        """Открывает min_size соединений заранее."""
+        opened = []
+        try:
+            with self._cond:
+                missing = self.min_size - (len(self._idle) + self._in_use)
+            for _ in range(max(0, missing)):
+                opened.append(get_db_connection())
+        except psycopg2.Error as e:
+            logger.warning(f"Не удалось заранее открыть соединения пула: {e}")
+        with self._cond:
+            now = time.monotonic()
+            for conn in opened:
+                self._idle.append((conn, now))
+            self._cond.notify_all()
+
+    def _is_healthy(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if idle_for < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Соединение из пула не прошло проверку и будет заменено: {e}")
+            return False
+
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            if not conn.closed:
+                conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("Пул соединений закрыт")
+                if self._idle:
+                    conn, returned_at = self._idle.pop() # LIFO: чаще используем "горячие" соединения
+                    break
+                if self._in_use + len(self._idle) < self.max_size:
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"Нет свободных соединений в пуле (max_size={self.max_size}) за {self.timeout} с")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            wait_time = time.monotonic() - started
+            self._checkouts += 1
+            self._wait_time_total += wait_time
+            self._wait_time_max = max(self._wait_time_max, wait_time)
+            if waited:
+                self._waits += 1
+
+        try:
+            if conn is not None and not self._is_healthy(conn, time.monotonic() - returned_at):
+                with self._cond:
+                    self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = get_db_connection()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        keep = not conn.closed and not self._closed
+        if keep and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Незавершенная транзакция (например, после SELECT без commit) не должна перейти к следующему потоку
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        with self._cond:
+            self._in_use -= 1
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_max': self._wait_time_max,
+                'wait_time_avg': self._wait_time_total / self._checkouts if self._checkouts else 0.0,
+                'discarded': self._discarded,
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_db_pool() -> ConnectionPool:
+    """Возвращает общий для процесса пул соединений, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL)
+                pool.prefill()
+                _pool = pool
+                logger.info(f"Создан пул соединений PostgreSQL (min={pool.min_size}, max={pool.max_size}).")
+    return _pool
+
+def acquire_db_connection():
+    """Берет соединение из пула. Вернуть его нужно через release_db_connection()."""
+    return get_db_pool().getconn()
+
+def release_db_connection(conn):
+    pool = _pool
+    if pool is None: # пул уже закрыт (остановка процесса)
+        conn.close()
+        return
+    pool.putconn(conn)
+
+def get_db_pool_stats() -> dict:
+    """Статистика пула: занятые/свободные соединения и время ожидания соединения."""
+    return get_db_pool().stats()
+
+def close_db_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            logger.info(f"Пул соединений PostgreSQL закрыт. Статистика: {_pool.stats()}")
+            _pool = None
 
 def create_tables_if_not_exists():
     """Создает таблицы в БД PostgreSQL, если они еще не существуют. track_id теперь Spotify ID."""
     conn = None
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS track_ratings (
@@ -46,6 +240,7 @@ def create_tables_if_not_exists():
                 )
             ''')
             logger.info("Таблица 'track_ratings' (с Spotify ID) проверена/создана.")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_track_ratings_rated_at ON track_ratings (rated_at)")
 
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS listened_tracks (
@@ -65,6 +260,71 @@ def create_tables_if_not_exists():
                 )
             ''')
             logger.info("Таблица 'user_mapping' проверена/создана.")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS track_neighbors (
+                    track_id TEXT NOT NULL, -- Spotify ID
+                    neighbor_track_id TEXT NOT NULL, -- Spotify ID похожего трека
+                    similarity REAL NOT NULL,
+                    PRIMARY KEY (track_id, neighbor_track_id)
+                )
+            ''')
+            logger.info("Таблица 'track_neighbors' проверена/создана.")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    track_id TEXT PRIMARY KEY, -- Spotify ID
+                    name TEXT NOT NULL,
+                    artist_names TEXT[] NOT NULL,
+                    artist_id TEXT, -- Spotify ID основного исполнителя
+                    spotify_url TEXT,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            logger.info("Таблица 'tracks' (метаданные треков Spotify) проверена/создана.")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lastfm_similar_cache (
+                    track_title TEXT NOT NULL, -- нормализованное (lower/strip) название сид-трека
+                    artist_name TEXT NOT NULL, -- нормализованное имя исполнителя
+                    similar_limit INTEGER NOT NULL, -- с каким limit запрашивались похожие
+                    similar_tracks JSONB NOT NULL, -- [{"name": ..., "artist_name": ...}], пустой список - не найдено
+                    fetched_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (track_title, artist_name)
+                )
+            ''')
+            logger.info("Таблица 'lastfm_similar_cache' проверена/создана.")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS spotify_resolve_cache (
+                    track_title TEXT NOT NULL, -- нормализованное название трека
+                    artist_name TEXT NOT NULL, -- нормализованное имя исполнителя
+                    track_id TEXT, -- Spotify ID, NULL - трек не найден в Spotify
+                    resolved_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (track_title, artist_name)
+                )
+            ''')
+            logger.info("Таблица 'spotify_resolve_cache' проверена/создана.")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS track_audio (
+                    track_id TEXT PRIMARY KEY, -- Spotify ID
+                    telegram_file_id TEXT, -- file_id загруженного в Telegram аудио
+                    youtube_video_id TEXT, -- videoId, из которого было скачано аудио
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            logger.info("Таблица 'track_audio' проверена/создана.")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS precomputed_recommendations (
+                    user_id BIGINT PRIMARY KEY, -- Telegram ID
+                    engine TEXT NOT NULL, -- движок коллаборативной фильтрации, которым посчитан список
+                    track_ids TEXT[] NOT NULL, -- Spotify ID в порядке убывания скора
+                    generated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            logger.info("Таблица 'precomputed_recommendations' проверена/создана.")
             conn.commit()
     except psycopg2.Error as e:
         logger.error(f"Ошибка при создании таблиц PostgreSQL (с Spotify ID): {e}")
@@ -72,13 +332,32 @@ def create_tables_if_not_exists():
             conn.rollback()
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
+
+# --- Подписчики на новые оценки ---
+_rating_listeners = []
+
+def add_rating_listener(callback):
+    """
+    Регистрирует callback(user_id, track_spotify_id, rating), вызываемый после сохранения оценки
+    (для буфера записи - после записи пачки в БД, см. write_buffer.py).
+    """
+    _rating_listeners.append(callback)
+
+def notify_rating_listeners(user_id: int, track_spotify_id: str, rating: int):
+    for callback in _rating_listeners:
+        try:
+            callback(user_id, track_spotify_id, rating)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике новой оценки {callback}: {e}", exc_info=True)
 
+@timed_db
 def save_track_rating(user_id: int, track_spotify_id: str, rating: int):
     logger.info(f"Сохранение оценки: user_id={user_id}, track_spotify_id='{track_spotify_id}', rating={rating}")
     conn = None
+    saved = False
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor() as cursor:
             cursor.execute('''
                 INSERT INTO track_ratings (user_id, track_id, rating, rated_at)
@@ -88,6 +367,7 @@ def save_track_rating(user_id: int, track_spotify_id: str, rating: int):
                     rated_at = CURRENT_TIMESTAMP
             ''', (user_id, track_spotify_id, rating))
             conn.commit()
+            saved = True
             logger.info("Оценка трека (Spotify ID) успешно сохранена.")
     except psycopg2.Error as e:
         logger.error(f"Ошибка сохранения оценки трека (Spotify ID) в PostgreSQL: {e}")
@@ -95,13 +375,16 @@ def save_track_rating(user_id: int, track_spotify_id: str, rating: int):
             conn.rollback()
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
+    if saved:
+        notify_rating_listeners(user_id, track_spotify_id, rating)
 
+@timed_db
 def save_listened_track(user_id: int, track_spotify_id: str):
     logger.info(f"Сохранение прослушанного трека: user_id={user_id}, track_spotify_id='{track_spotify_id}'")
     conn = None
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor() as cursor:
             cursor.execute('''
                 INSERT INTO listened_tracks (user_id, track_id)
@@ -116,13 +399,139 @@ def save_listened_track(user_id: int, track_spotify_id: str):
             conn.rollback()
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
+
+@timed_db
+def save_interactions_batch(ratings: list, listens: list) -> bool:
+    """
+    Записывает пачку оценок [(user_id, track_spotify_id, rating)] и прослушиваний [(user_id, track_spotify_id)]
+    многострочными upsert'ами в одной транзакции. Повторы пар внутри пачки должны быть уже схлопнуты
+    (ON CONFLICT не может обновить одну строку дважды за запрос). Подписчиков не уведомляет.
+    """
+    if not ratings and not listens:
+        return True
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            if ratings:
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO track_ratings (user_id, track_id, rating, rated_at)
+                    VALUES %s
+                    ON CONFLICT (user_id, track_id) DO UPDATE SET
+                        rating = EXCLUDED.rating,
+                        rated_at = CURRENT_TIMESTAMP
+                ''', ratings, template="(%s, %s, %s, CURRENT_TIMESTAMP)", page_size=1000)
+            if listens:
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO listened_tracks (user_id, track_id)
+                    VALUES %s
+                    ON CONFLICT (user_id, track_id) DO NOTHING
+                ''', listens, page_size=1000)
+            conn.commit()
+            logger.info(f"Сохранено оценок: {len(ratings)}, прослушиваний: {len(listens)} (одна транзакция).")
+            return True
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка пакетного сохранения оценок/прослушиваний в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            release_db_connection(conn)
 
+@timed_db
+def bulk_save_ratings(ratings: list) -> int:
+    """
+    Массовая запись оценок [(telegram_user_id, track_spotify_id, rating)] в одной транзакции:
+    строки загружаются через COPY во временную таблицу, затем одним INSERT ... SELECT добавляются
+    недостающие user_mapping и делается upsert в track_ratings. При повторах пары побеждает последняя.
+    Обработчики новых оценок не вызываются - бот подхватит оценки через снимок по rated_at.
+    Возвращает число записанных оценок (0 при ошибке).
+    """
+    deduplicated = {}
+    for user_id, track_spotify_id, rating in ratings:
+        deduplicated[(int(user_id), track_spotify_id)] = int(rating)
+    if not deduplicated:
+        return 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for (user_id, track_spotify_id), rating in deduplicated.items():
+        writer.writerow((user_id, track_spotify_id, rating))
+    buffer.seek(0)
+
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                CREATE TEMP TABLE bulk_ratings (
+                    user_id BIGINT NOT NULL, track_id TEXT NOT NULL, rating INTEGER NOT NULL
+                ) ON COMMIT DROP
+            ''')
+            cursor.copy_expert("COPY bulk_ratings (user_id, track_id, rating) FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute('''
+                INSERT INTO user_mapping (user_id)
+                SELECT DISTINCT b.user_id FROM bulk_ratings b
+                WHERE NOT EXISTS (SELECT 1 FROM user_mapping um WHERE um.user_id = b.user_id)
+                ORDER BY b.user_id
+                ON CONFLICT (user_id) DO NOTHING
+            ''')
+            new_users = cursor.rowcount
+            cursor.execute('''
+                INSERT INTO track_ratings (user_id, track_id, rating, rated_at)
+                SELECT user_id, track_id, rating, CURRENT_TIMESTAMP FROM bulk_ratings
+                ON CONFLICT (user_id, track_id) DO UPDATE SET
+                    rating = EXCLUDED.rating,
+                    rated_at = CURRENT_TIMESTAMP
+            ''')
+            conn.commit()
+            logger.info(f"Массово сохранено {len(deduplicated)} оценок, новых пользователей: {new_users}.")
+            return len(deduplicated)
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка массового сохранения оценок в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+        return 0
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def bulk_add_user_mappings(user_ids: list) -> dict:
+    """Добавляет недостающих пользователей одним запросом и возвращает {telegram_user_id: user_num} для всех user_ids."""
+    user_ids = sorted({int(user_id) for user_id in user_ids})
+    if not user_ids:
+        return {}
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO user_mapping (user_id) VALUES %s ON CONFLICT (user_id) DO NOTHING",
+                [(user_id,) for user_id in user_ids],
+                page_size=1000
+            )
+            cursor.execute("SELECT user_id, user_num FROM user_mapping WHERE user_id = ANY(%s)", (user_ids,))
+            mapping = dict(cursor.fetchall())
+            conn.commit()
+            return mapping
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка массового добавления user_mapping в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+        return {}
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
 def get_ratings() -> pd.DataFrame:
     logger.info("Запрос всех оценок (с Spotify ID) из БД PostgreSQL.")
     conn = None
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         query = '''
             SELECT um.user_num, tr.track_id, tr.rating
             FROM track_ratings tr
@@ -138,14 +547,46 @@ def get_ratings() -> pd.DataFrame:
         return pd.DataFrame()
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
+@timed_db
+def get_ratings_since(since=None):
+    """
+    Оценки, сохраненные после since (все, если since=None): список (user_num, track_id, rating, rated_at).
+    Выбирает строки по индексу idx_track_ratings_rated_at. None - ошибка запроса.
+    """
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            if since is None:
+                cursor.execute('''
+                    SELECT um.user_num, tr.track_id, tr.rating, tr.rated_at
+                    FROM track_ratings tr
+                    JOIN user_mapping um ON tr.user_id = um.user_id
+                ''')
+            else:
+                cursor.execute('''
+                    SELECT um.user_num, tr.track_id, tr.rating, tr.rated_at
+                    FROM track_ratings tr
+                    JOIN user_mapping um ON tr.user_id = um.user_id
+                    WHERE tr.rated_at > %s
+                ''', (since,))
+            return cursor.fetchall()
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при загрузке новых оценок из PostgreSQL: {e}")
+        return None
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
 def get_top_rated_tracks(user_id: int, min_rating: int = 4) -> list:
     logger.info(f"Запрос высоко оцененных треков (Spotify ID) для user_id={user_id} (min_rating={min_rating}) из PostgreSQL.")
     conn = None
     track_spotify_ids = []
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             cursor.execute('''
                 SELECT track_id FROM track_ratings
@@ -159,15 +600,382 @@ def get_top_rated_tracks(user_id: int, min_rating: int = 4) -> list:
         logger.error(f"Ошибка при запросе высоко оцененных треков (Spotify ID) из PostgreSQL: {e}")
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
+    return track_spotify_ids
+
+@timed_db
+def replace_track_neighbors(rows: list) -> bool:
+    """Полностью заменяет содержимое track_neighbors строками (track_id, neighbor_track_id, similarity) в одной транзакции."""
+    logger.info(f"Запись {len(rows)} пар похожих треков в track_neighbors.")
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM track_neighbors")
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO track_neighbors (track_id, neighbor_track_id, similarity) VALUES %s",
+                rows,
+                page_size=1000
+            )
+            conn.commit()
+            logger.info("Таблица track_neighbors обновлена.")
+            return True
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при записи track_neighbors в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def get_item_based_recommendations(user_id: int, min_rating: int = 4, limit: int = 10) -> list:
+    """
+    Рекомендации по таблице track_neighbors: соседи высоко оцененных пользователем треков,
+    агрегированные по сумме схожести, без уже оцененных треков. Один индексированный запрос.
+    """
+    logger.info(f"Запрос item-based рекомендаций для user_id={user_id} (min_rating={min_rating}, limit={limit}) из PostgreSQL.")
+    conn = None
+    track_spotify_ids = []
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute('''
+                SELECT tn.neighbor_track_id, SUM(tn.similarity) AS score
+                FROM track_ratings seed
+                JOIN track_neighbors tn ON tn.track_id = seed.track_id
+                WHERE seed.user_id = %s AND seed.rating >= %s
+                  AND NOT EXISTS (
+                      SELECT 1 FROM track_ratings rated
+                      WHERE rated.user_id = seed.user_id AND rated.track_id = tn.neighbor_track_id
+                  )
+                GROUP BY tn.neighbor_track_id
+                ORDER BY score DESC, tn.neighbor_track_id
+                LIMIT %s
+            ''', (user_id, min_rating, limit))
+            track_spotify_ids = [row['neighbor_track_id'] for row in cursor.fetchall()]
+            logger.info(f"Найдено {len(track_spotify_ids)} item-based рекомендаций (Spotify ID) в PostgreSQL.")
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при запросе item-based рекомендаций из PostgreSQL: {e}")
+    finally:
+        if conn:
+            release_db_connection(conn)
     return track_spotify_ids
 
+@timed_db
+def get_active_users(active_seconds: float) -> list:
+    """Пользователи, ставившие оценки за последние active_seconds: [(telegram_user_id, user_num)]."""
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT um.user_id, um.user_num FROM user_mapping um
+                WHERE EXISTS (
+                    SELECT 1 FROM track_ratings tr
+                    WHERE tr.user_id = um.user_id AND tr.rated_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+                )
+                ORDER BY um.user_num
+            ''', (active_seconds,))
+            return cursor.fetchall()
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при запросе активных пользователей из PostgreSQL: {e}")
+        return []
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def save_precomputed_recommendations(engine: str, rows: list) -> bool:
+    """Сохраняет предрасчитанные рекомендации [(telegram_user_id, [Spotify ID, ...])] одним запросом."""
+    if not rows:
+        return True
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor,
+                '''
+                INSERT INTO precomputed_recommendations (user_id, engine, track_ids) VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET
+                    engine = EXCLUDED.engine, track_ids = EXCLUDED.track_ids, generated_at = CURRENT_TIMESTAMP
+                ''',
+                [(user_id, engine, list(track_ids)) for user_id, track_ids in rows],
+                page_size=1000
+            )
+            conn.commit()
+            logger.info(f"Сохранены предрасчитанные рекомендации для {len(rows)} пользователей.")
+            return True
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при сохранении предрасчитанных рекомендаций в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def get_precomputed_recommendations(user_id: int, engine: str, max_age_seconds: float):
+    """
+    Предрасчитанные рекомендации пользователя, если они посчитаны движком engine, не старше max_age_seconds
+    и пользователь не ставил оценок после расчета. Иначе None.
+    """
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT p.track_ids FROM precomputed_recommendations p
+                WHERE p.user_id = %s AND p.engine = %s
+                  AND p.generated_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM track_ratings tr WHERE tr.user_id = p.user_id AND tr.rated_at > p.generated_at
+                  )
+            ''', (user_id, engine, max_age_seconds))
+            row = cursor.fetchone()
+            return list(row[0]) if row else None
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при запросе предрасчитанных рекомендаций из PostgreSQL: {e}")
+        return None
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def get_tracks_metadata(track_spotify_ids: list, max_age_seconds: float) -> dict:
+    """Метаданные треков из таблицы tracks не старше max_age_seconds: {Spotify ID: info}."""
+    conn = None
+    tracks_info = {}
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute('''
+                SELECT track_id, name, artist_names, artist_id, spotify_url FROM tracks
+                WHERE track_id = ANY(%s) AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+            ''', (list(track_spotify_ids), max_age_seconds))
+            for row in cursor.fetchall():
+                artist_names = list(row['artist_names'])
+                tracks_info[row['track_id']] = {
+                    'id': row['track_id'],
+                    'name': row['name'],
+                    'artist_name': artist_names[0] if artist_names else "Unknown Artist",
+                    'artist_names': artist_names,
+                    'artist_id': row['artist_id'],
+                    'spotify_url': row['spotify_url'] or "N/A",
+                }
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при запросе метаданных треков из PostgreSQL: {e}")
+    finally:
+        if conn:
+            release_db_connection(conn)
+    return tracks_info
+
+@timed_db
+def save_tracks_metadata(tracks_info: list):
+    """Сохраняет/обновляет метаданные треков (словари формата SpotifyAgent) в таблице tracks одним запросом."""
+    rows = {
+        info['id']: (info['id'], info['name'], info.get('artist_names') or [info.get('artist_name', "Unknown Artist")],
+                     info.get('artist_id'), info.get('spotify_url'))
+        for info in tracks_info
+    }
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO tracks (track_id, name, artist_names, artist_id, spotify_url)
+                VALUES %s
+                ON CONFLICT (track_id) DO UPDATE SET
+                    name = EXCLUDED.name,
+                    artist_names = EXCLUDED.artist_names,
+                    artist_id = COALESCE(EXCLUDED.artist_id, tracks.artist_id),
+                    spotify_url = EXCLUDED.spotify_url,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', list(rows.values()))
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка сохранения метаданных треков в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def get_cached_lastfm_similar(track_title: str, artist_name: str, max_age_seconds: float, negative_max_age_seconds: float):
+    """(similar_limit, similar_tracks) из lastfm_similar_cache или None, если записи нет или она устарела."""
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute('''
+                SELECT similar_limit, similar_tracks FROM lastfm_similar_cache
+                WHERE track_title = %s AND artist_name = %s
+                  AND fetched_at > CURRENT_TIMESTAMP - make_interval(secs => CASE
+                      WHEN jsonb_array_length(similar_tracks) = 0 THEN %s ELSE %s END)
+            ''', (track_title, artist_name, negative_max_age_seconds, max_age_seconds))
+            row = cursor.fetchone()
+            return (row['similar_limit'], row['similar_tracks']) if row else None
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при чтении lastfm_similar_cache из PostgreSQL: {e}")
+        return None
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def save_cached_lastfm_similar(track_title: str, artist_name: str, similar_limit: int, similar_tracks: list):
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO lastfm_similar_cache (track_title, artist_name, similar_limit, similar_tracks, fetched_at)
+                VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (track_title, artist_name) DO UPDATE SET
+                    similar_limit = EXCLUDED.similar_limit,
+                    similar_tracks = EXCLUDED.similar_tracks,
+                    fetched_at = CURRENT_TIMESTAMP
+            ''', (track_title, artist_name, similar_limit, psycopg2.extras.Json(similar_tracks)))
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка сохранения lastfm_similar_cache в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def get_cached_spotify_resolution(track_title: str, artist_name: str, max_age_seconds: float, negative_max_age_seconds: float):
+    """
+    Результат сопоставления (название, исполнитель) -> Spotify ID из spotify_resolve_cache:
+    (True, track_id), (True, None) для закэшированного "не найдено", (False, None) если записи нет.
+    """
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute('''
+                SELECT track_id FROM spotify_resolve_cache
+                WHERE track_title = %s AND artist_name = %s
+                  AND resolved_at > CURRENT_TIMESTAMP - make_interval(secs => CASE
+                      WHEN track_id IS NULL THEN %s ELSE %s END)
+            ''', (track_title, artist_name, negative_max_age_seconds, max_age_seconds))
+            row = cursor.fetchone()
+            return (True, row['track_id']) if row else (False, None)
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при чтении spotify_resolve_cache из PostgreSQL: {e}")
+        return (False, None)
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def save_cached_spotify_resolution(track_title: str, artist_name: str, track_spotify_id):
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO spotify_resolve_cache (track_title, artist_name, track_id, resolved_at)
+                VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (track_title, artist_name) DO UPDATE SET
+                    track_id = EXCLUDED.track_id,
+                    resolved_at = CURRENT_TIMESTAMP
+            ''', (track_title, artist_name, track_spotify_id))
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка сохранения spotify_resolve_cache в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def prune_external_api_cache(max_age_seconds: float):
+    """Удаляет из lastfm_similar_cache и spotify_resolve_cache записи старше max_age_seconds."""
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM lastfm_similar_cache WHERE fetched_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                (max_age_seconds,)
+            )
+            deleted = cursor.rowcount
+            cursor.execute(
+                "DELETE FROM spotify_resolve_cache WHERE resolved_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                (max_age_seconds,)
+            )
+            deleted += cursor.rowcount
+            conn.commit()
+            logger.info(f"Удалено {deleted} устаревших записей кэша внешних API.")
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка очистки кэша внешних API в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def get_track_audio(track_spotify_id: str):
+    """{'telegram_file_id': ..., 'youtube_video_id': ...} для трека или None, если аудио еще не загружалось."""
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(
+                "SELECT telegram_file_id, youtube_video_id FROM track_audio WHERE track_id = %s",
+                (track_spotify_id,)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка при запросе track_audio из PostgreSQL: {e}")
+        return None
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
+def save_track_audio(track_spotify_id: str, telegram_file_id, youtube_video_id):
+    """Сохраняет file_id загруженного в Telegram аудио (None сбрасывает недействительный file_id) и videoId."""
+    logger.info(f"Сохранение track_audio: track_spotify_id='{track_spotify_id}', youtube_video_id='{youtube_video_id}'")
+    conn = None
+    try:
+        conn = acquire_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO track_audio (track_id, telegram_file_id, youtube_video_id, updated_at)
+                VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (track_id) DO UPDATE SET
+                    telegram_file_id = EXCLUDED.telegram_file_id,
+                    youtube_video_id = COALESCE(EXCLUDED.youtube_video_id, track_audio.youtube_video_id),
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (track_spotify_id, telegram_file_id, youtube_video_id))
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Ошибка сохранения track_audio в PostgreSQL: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+@timed_db
 def check_user_has_ratings(user_id: int) -> bool:
     logger.info(f"Проверка наличия оценок у user_id={user_id} в PostgreSQL.")
     conn = None
     count = 0
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor() as cursor:
             cursor.execute("SELECT COUNT(*) FROM track_ratings WHERE user_id = %s", (user_id,))
             result = cursor.fetchone()
@@ -178,15 +986,16 @@ def check_user_has_ratings(user_id: int) -> bool:
         logger.error(f"Ошибка при проверке наличия оценок в PostgreSQL: {e}")
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
     return count > 0
 
+@timed_db
 def add_user_mapping(user_id: int) -> int:
     logger.info(f"Добавление/получение user_mapping для user_id={user_id} в PostgreSQL.")
     conn = None
     user_num = -1 
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             cursor.execute("SELECT user_num FROM user_mapping WHERE user_id = %s", (user_id,))
             row = cursor.fetchone()
@@ -213,15 +1022,16 @@ def add_user_mapping(user_id: int) -> int:
         user_num = -1 
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
     return user_num
 
+@timed_db
 def get_user_to_idx_map() -> dict:
     logger.info("Запрос сопоставления user_id -> user_num из PostgreSQL.")
     conn = None
     user_map = {}
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             cursor.execute("SELECT user_id, user_num FROM user_mapping")
             rows = cursor.fetchall()
@@ -231,14 +1041,15 @@ def get_user_to_idx_map() -> dict:
         logger.error(f"Ошибка при запросе сопоставления user_id -> user_num из PostgreSQL: {e}")
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
     return user_map
 
+@timed_db
 def get_internal_user_id(telegram_user_id: int) -> int:
     logger.info(f"Запрос внутреннего user_num для telegram_user_id={telegram_user_id} из PostgreSQL.")
     conn = None; user_num = -1
     try:
-        conn = get_db_connection()
+        conn = acquire_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             cursor.execute("SELECT user_num FROM user_mapping WHERE user_id = %s", (telegram_user_id,))
             row = cursor.fetchone()
@@ -248,7 +1059,7 @@ def get_internal_user_id(telegram_user_id: int) -> int:
         logger.error(f"Ошибка при запросе внутреннего user_num: {e}")
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
     return user_num
 
 if __name__ == "__main__":
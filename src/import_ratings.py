@@ -0,0 +1,93 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from typing import Iterator, Tuple
+
+from database import bulk_save_ratings, create_tables_if_not_exists, close_db_pool
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '100000')) # оценок в одной транзакции
+
+MALFORMED_ROWS_LOGGED = 10 # сколько некорректных строк показывать в логе (остальные только считаются)
+
+class _MalformedRows:
+    """Учет некорректных строк дампа: такие строки пропускаются, а не прерывают импорт."""
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+
+    def add(self, line_number: int, error: Exception):
+        self.count += 1
+        if self.count <= MALFORMED_ROWS_LOGGED:
+            logger.warning(f"'{self.path}', строка {line_number}: некорректная запись пропущена ({type(error).__name__}: {error}).")
+
+def _read_csv(path: str, malformed: _MalformedRows) -> Iterator[Tuple[int, str, int]]:
+    """CSV с заголовком user_id,track_id,rating (user_id - Telegram ID, track_id - Spotify ID)."""
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            try:
+                parsed = int(row['user_id']), row['track_id'], int(row['rating'])
+            except (ValueError, KeyError, TypeError) as e:
+                malformed.add(reader.line_num, e)
+                continue
+            yield parsed
+
+def _read_jsonl(path: str, malformed: _MalformedRows) -> Iterator[Tuple[int, str, int]]:
+    """JSONL: по объекту {"user_id": ..., "track_id": ..., "rating": ...} на строку."""
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                parsed = int(row['user_id']), row['track_id'], int(row['rating'])
+            except (json.JSONDecodeError, ValueError, KeyError, TypeError) as e:
+                malformed.add(line_number, e)
+                continue
+            yield parsed
+
+def import_ratings(path: str, file_format: str, batch_size: int = IMPORT_BATCH_SIZE) -> int:
+    reader = _read_jsonl if file_format == 'jsonl' else _read_csv
+    started = time.perf_counter()
+    imported = 0
+    batch = []
+    skipped = 0
+    malformed = _MalformedRows(path)
+    for user_id, track_id, rating in reader(path, malformed):
+        if not 1 <= rating <= 5 or not track_id or not isinstance(track_id, str):
+            skipped += 1
+            continue
+        batch.append((user_id, track_id, rating))
+        if len(batch) >= batch_size:
+            imported += bulk_save_ratings(batch)
+            batch = []
+            logger.info(f"Импортировано {imported} оценок...")
+    if batch:
+        imported += bulk_save_ratings(batch)
+    skipped += malformed.count
+    logger.info(f"Импорт '{path}' завершен за {time.perf_counter() - started:.1f} с: {imported} оценок, пропущено строк: {skipped}.")
+    return imported
+
+if __name__ == "__main__":
+    # Пример: python import_ratings.py ratings.csv
+    #         python import_ratings.py ratings.jsonl --batch-size 50000
+    parser = argparse.ArgumentParser(description="Импорт дампа оценок (CSV или JSONL) в track_ratings.")
+    parser.add_argument('path', help="файл с колонками/полями user_id (Telegram ID), track_id (Spotify ID), rating (1-5)")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="формат файла (по умолчанию - по расширению)")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="оценок в одной транзакции")
+    args = parser.parse_args()
+    file_format = args.format or ('jsonl' if args.path.endswith(('.jsonl', '.json')) else 'csv')
+    try:
+        create_tables_if_not_exists()
+        import_ratings(args.path, file_format, args.batch_size)
+    finally:
+        close_db_pool()
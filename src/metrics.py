@@ -0,0 +1,320 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108')) # 0 - не поднимать HTTP-эндпоинт
+
+# Границы корзин гистограмм длительности, секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: Tuple[str, str] = None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание, набор меток и потокобезопасное хранилище значений по меткам."""
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @property
+    def family_name(self) -> str:
+        """Имя семейства в выдаче /metrics (в # HELP/# TYPE)."""
+        return self.name
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.family_name} {self.documentation}", f"# TYPE {self.family_name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Счетчик; как в prometheus_client, и заголовок, и значения выдаются под именем <name>_total."""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name[:-len('_total')] if name.endswith('_total') else name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.family_name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+    @property
+    def family_name(self) -> str:
+        return f"{self.name}_total"
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], list] = {} # метки -> [счетчики по корзинам (без +Inf), сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение снимается при каждом запросе метрик: callback() -> {кортеж значений меток: число}."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Dict[Tuple[str, ...], float]], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _samples(self) -> List[str]:
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"Metrics: ошибка при снятии значения {self.name}: {e}", exc_info=True)
+            return []
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in sorted(values.items())]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+registry = MetricsRegistry()
+
+
+# --- Метрики конвейера ---
+STAGE_DURATION = registry.register(Histogram(
+    'mrs_recommendation_stage_duration_seconds', "Длительность этапов generate_recommendations.", ('stage',)
+))
+RECOMMENDATION_DURATION = registry.register(Histogram(
+    'mrs_recommendation_duration_seconds', "Полное время generate_recommendations.", ('source',)
+))
+RECOMMENDATION_FIRST_RESULT = registry.register(Histogram(
+    'mrs_recommendation_first_result_seconds', "Время до первой рекомендации в stream_recommendations.", ('source',)
+))
+RECOMMENDATION_API_CALLS = registry.register(Histogram(
+    'mrs_recommendation_api_calls', "Вызовов внешних API за один запрос рекомендаций.", ('service',), COUNT_BUCKETS
+))
+RECOMMENDATION_CACHE_HITS = registry.register(Histogram(
+    'mrs_recommendation_cache_hits', "Попаданий в кэши за один запрос рекомендаций.", (), COUNT_BUCKETS
+))
+API_DURATION = registry.register(Histogram(
+    'mrs_external_api_duration_seconds', "Длительность вызовов внешних API.", ('service', 'method', 'outcome')
+))
+DB_DURATION = registry.register(Histogram(
+    'mrs_db_function_duration_seconds', "Длительность функций database.py/async_database.py (включая ожидание соединения из пула).", ('function',)
+))
+CACHE_REQUESTS = registry.register(Counter(
+    'mrs_cache_requests', "Обращения к кэшам.", ('cache', 'layer', 'result')
+))
+
+API_SERVICES = ('spotify', 'lastfm', 'youtube')
+
+
+# --- Учет в рамках одного запроса рекомендаций ---
+class _RequestCounts:
+    def __init__(self):
+        self.api_calls = dict.fromkeys(API_SERVICES, 0)
+        self.cache_hits = 0
+        self.source = 'computed'
+
+_current_request: contextvars.ContextVar[Optional[_RequestCounts]] = contextvars.ContextVar('mrs_recommendation_request', default=None)
+
+@contextmanager
+def recommendation_request() -> Iterator[_RequestCounts]:
+    """
+    Учитывает вызовы API и попадания в кэш внутри одного generate_recommendations.
+    Счетчик передается через contextvars, поэтому задачи asyncio и потоки _run_sync (копирующие контекст) видят его.
+    """
+    counts = _RequestCounts()
+    token = _current_request.set(counts)
+    started = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        _current_request.reset(token)
+        RECOMMENDATION_DURATION.observe(time.perf_counter() - started, source=counts.source)
+        for service, calls in counts.api_calls.items():
+            RECOMMENDATION_API_CALLS.observe(calls, service=service)
+        RECOMMENDATION_CACHE_HITS.observe(counts.cache_hits)
+
+def observe_stage(stage: str, started: float):
+    """Записывает длительность этапа, начатого в момент started (time.perf_counter())."""
+    STAGE_DURATION.observe(time.perf_counter() - started, stage=stage)
+
+def observe_first_result(started: float, source: str):
+    """Записывает время от начала запроса (time.perf_counter()) до первой отданной рекомендации."""
+    RECOMMENDATION_FIRST_RESULT.observe(time.perf_counter() - started, source=source)
+
+
+class _ApiCall:
+    def __init__(self):
+        self.outcome = 'ok'
+
+@contextmanager
+def api_call(service: str, method: str) -> Iterator[_ApiCall]:
+    """
+    Замер одного обращения к внешнему API. Внутри блока можно поменять call.outcome (например, на 'not_found');
+    при исключении outcome - HTTP-статус ответа (http_404) или имя класса исключения.
+    """
+    call = _ApiCall()
+    counts = _current_request.get()
+    if counts is not None:
+        counts.api_calls[service] = counts.api_calls.get(service, 0) + 1
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        call.outcome = f"http_{status}" if status else type(e).__name__
+        raise
+    finally:
+        API_DURATION.observe(time.perf_counter() - started, service=service, method=method, outcome=call.outcome)
+
+def timed_db(func):
+    """Декоратор функций database.py и async_database.py: гистограмма длительности по имени модуля и функции."""
+    function = f"{func.__module__}.{func.__name__}"
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                DB_DURATION.observe(time.perf_counter() - started, function=function)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_DURATION.observe(time.perf_counter() - started, function=function)
+    return wrapper
+
+def record_cache(cache: str, layer: str, hits: int = 0, misses: int = 0):
+    """Учитывает попадания/промахи кэша (layer - 'memory' или 'db')."""
+    if hits:
+        CACHE_REQUESTS.inc(hits, cache=cache, layer=layer, result='hit')
+        counts = _current_request.get()
+        if counts is not None:
+            counts.cache_hits += hits
+    if misses:
+        CACHE_REQUESTS.inc(misses, cache=cache, layer=layer, result='miss')
+
+def register_gauge(name: str, documentation: str, callback: Callable[[], Dict[Tuple[str, ...], float]], labelnames: Sequence[str] = ()):
+    return registry.register(Gauge(name, documentation, callback, labelnames))
+
+
+# --- HTTP-эндпоинт ---
+# aiohttp (зависимость aiogram) импортируется только здесь: database.py и метрики используются
+# и в отдельных скриптах (populate_db.py, import_ratings.py), которым HTTP-сервер не нужен.
+async def _metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Поднимает GET /metrics в текущем event loop. Возвращает aiohttp runner (для cleanup()) или None, если эндпоинт выключен."""
+    if not port:
+        logger.info("Metrics: HTTP-эндпоинт выключен (METRICS_PORT=0).")
+        return None
+    from aiohttp import web
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.error(f"Metrics: не удалось открыть {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics: метрики Prometheus доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+logger = logging.getLogger(__name__)
+
+MF_MODEL_PATH = os.getenv('MF_MODEL_PATH', 'mf_model.npz')
+
+
+class MatrixFactorizationModel:
+    """
+    Латентная факторная модель (implicit ALS): эмбеддинги пользователей и треков в float32.
+    Рекомендации - одно векторное произведение item_factors @ user_vector и частичная сортировка.
+    """
+    def __init__(self, user_ids: np.ndarray, track_ids: np.ndarray, user_factors: np.ndarray, item_factors: np.ndarray):
+        self.user_ids = user_ids
+        self.track_ids = track_ids
+        self.user_factors = user_factors.astype(np.float32, copy=False)
+        self.item_factors = item_factors.astype(np.float32, copy=False)
+        self.user_index = {user_id: idx for idx, user_id in enumerate(user_ids.tolist())}
+        self.track_index = {track_id: idx for idx, track_id in enumerate(track_ids.tolist())}
+
+    @property
+    def factors(self) -> int:
+        return self.item_factors.shape[1]
+
+    def has_user(self, user_num: int) -> bool:
+        return user_num in self.user_index
+
+    def save(self, path: str = MF_MODEL_PATH):
+        """Сохраняет модель атомарно (через временный файл), чтобы бот не прочитал недописанный файл."""
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            user_ids=self.user_ids.astype(np.int64),
+            track_ids=self.track_ids.astype(str),
+            user_factors=self.user_factors,
+            item_factors=self.item_factors,
+        )
+        os.replace(tmp_path, path)
+        logger.info(f"MF-модель сохранена в '{path}' ({len(self.user_ids)} пользователей, {len(self.track_ids)} треков, {self.factors} факторов).")
+
+    @classmethod
+    def load(cls, path: str = MF_MODEL_PATH) -> Optional['MatrixFactorizationModel']:
+        if not os.path.exists(path):
+            logger.warning(f"Файл MF-модели '{path}' не найден.")
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['user_ids'], data['track_ids'].astype(object), data['user_factors'], data['item_factors'])
+
+    def recommend(self, user_num: int, n: int, exclude: Optional[Set[str]] = None) -> List[str]:
+        """n треков с наибольшим скором для пользователя, исключая exclude (обычно уже оцененные треки)."""
+        user_idx = self.user_index.get(user_num)
+        if user_idx is None or n <= 0:
+            return []
+        scores = self.item_factors @ self.user_factors[user_idx]
+        excluded_idx = [self.track_index[t] for t in exclude if t in self.track_index] if exclude else []
+        scores[excluded_idx] = -np.inf
+        n = min(n, len(scores) - len(excluded_idx))
+        if n == 0:
+            return []
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return self.track_ids[top].tolist()
+
+    def recommend_for_users(self, user_nums: List[int], n: int, exclude_by_user: Dict[int, Set[str]],
+                            chunk_size: int = 1000) -> Dict[int, List[str]]:
+        """Пакетный recommend(): скоры блока пользователей считаются одним матричным произведением."""
+        rows = [(user_num, self.user_index[user_num]) for user_num in user_nums if user_num in self.user_index]
+        results: Dict[int, List[str]] = {}
+        for block_start in range(0, len(rows), chunk_size):
+            block = rows[block_start:block_start + chunk_size]
+            scores = self.user_factors[[idx for _, idx in block]] @ self.item_factors.T
+            for position, (user_num, _) in enumerate(block):
+                excluded_idx = [self.track_index[t] for t in exclude_by_user.get(user_num, ()) if t in self.track_index]
+                user_scores = scores[position]
+                user_scores[excluded_idx] = -np.inf
+                user_n = min(n, len(user_scores) - len(excluded_idx))
+                if user_n <= 0:
+                    results[user_num] = []
+                    continue
+                top = np.argpartition(-user_scores, user_n - 1)[:user_n]
+                top = top[np.argsort(-user_scores[top], kind='stable')]
+                results[user_num] = self.track_ids[top].tolist()
+        return results
+
+
+def _als_step(fixed: np.ndarray, confidence: sparse.csr_matrix, regularization: float) -> np.ndarray:
+    """Один полушаг implicit ALS: пересчет факторов строк confidence при фиксированных факторах столбцов."""
+    n_factors = fixed.shape[1]
+    gram = fixed.T @ fixed + regularization * np.eye(n_factors)
+    solved = np.zeros((confidence.shape[0], n_factors), dtype=np.float64)
+    for row in range(confidence.shape[0]):
+        start, end = confidence.indptr[row], confidence.indptr[row + 1]
+        if start == end:
+            continue
+        cols = confidence.indices[start:end]
+        conf = confidence.data[start:end] # c_ui - 1
+        fixed_rows = fixed[cols]
+        a = gram + (fixed_rows.T * conf) @ fixed_rows
+        b = (fixed_rows.T * (conf + 1.0)).sum(axis=1)
+        solved[row] = np.linalg.solve(a, b)
+    return solved
+
+
+def train_als(df_ratings: pd.DataFrame, factors: int = 32, regularization: float = 0.1, alpha: float = 10.0,
+              iterations: int = 15, warm_start: Optional[MatrixFactorizationModel] = None,
+              seed: int = 42) -> MatrixFactorizationModel:
+    """
+    Обучает implicit ALS по оценкам (колонки user_id, track_id, rating). Уверенность c_ui = 1 + alpha * rating / 5.
+    При warm_start факторы известных пользователей и треков берутся из прежней модели, новые инициализируются случайно.
+    """
+    df = df_ratings.drop_duplicates(subset=['user_id', 'track_id'], keep='last')
+    user_ids, user_codes = np.unique(df['user_id'].to_numpy(), return_inverse=True)
+    track_ids, track_codes = np.unique(df['track_id'].to_numpy(dtype=object), return_inverse=True)
+    confidence = sparse.csr_matrix(
+        (alpha * df['rating'].to_numpy(dtype=np.float64) / 5.0, (user_codes, track_codes)),
+        shape=(len(user_ids), len(track_ids))
+    )
+    confidence_t = confidence.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    if warm_start is not None and warm_start.factors != factors:
+        logger.warning(f"Число факторов изменилось ({warm_start.factors} -> {factors}), warm start невозможен.")
+        warm_start = None
+    user_factors = rng.normal(scale=0.01, size=(len(user_ids), factors))
+    item_factors = rng.normal(scale=0.01, size=(len(track_ids), factors))
+    if warm_start is not None:
+        reused = 0
+        for idx, user_id in enumerate(user_ids.tolist()):
+            old_idx = warm_start.user_index.get(user_id)
+            if old_idx is not None:
+                user_factors[idx] = warm_start.user_factors[old_idx]
+                reused += 1
+        for idx, track_id in enumerate(track_ids.tolist()):
+            old_idx = warm_start.track_index.get(track_id)
+            if old_idx is not None:
+                item_factors[idx] = warm_start.item_factors[old_idx]
+        logger.info(f"Warm start: переиспользованы факторы {reused} из {len(user_ids)} пользователей.")
+
+    for iteration in range(iterations):
+        user_factors = _als_step(item_factors, confidence, regularization)
+        item_factors = _als_step(user_factors, confidence_t, regularization)
+        logger.debug(f"ALS: итерация {iteration + 1}/{iterations} завершена.")
+
+    return MatrixFactorizationModel(user_ids, track_ids, user_factors, item_factors)
+
+
+# --- Загрузка модели для обслуживания запросов ---
+_serving_model: Optional[MatrixFactorizationModel] = None
+_serving_model_mtime: Optional[float] = None
+_serving_lock = threading.Lock()
+
+def get_serving_model(path: str = MF_MODEL_PATH) -> Optional[MatrixFactorizationModel]:
+    """Возвращает загруженную MF-модель, перечитывая файл, если пакетное обучение его обновило."""
+    global _serving_model, _serving_model_mtime
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return _serving_model
+    with _serving_lock:
+        if _serving_model is None or mtime != _serving_model_mtime:
+            try:
+                _serving_model = MatrixFactorizationModel.load(path)
+                _serving_model_mtime = mtime
+                logger.info(f"MF-модель загружена из '{path}'.")
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Не удалось загрузить MF-модель из '{path}': {e}")
+        return _serving_model
@@ -1,10 +1,11 @@
 import random
 import logging
 import asyncio 
+import os
 from typing import Optional, List # Добавлен List
 
 # Убедитесь, что app.py и database.py находятся в том же каталоге или доступны через PYTHONPATH
-from database import save_track_rating, add_user_mapping, create_tables_if_not_exists, get_db_connection
+from database import bulk_save_ratings, bulk_add_user_mappings, create_tables_if_not_exists, get_db_connection, close_db_pool
 # Импортируем SpotifyAgent и клиент sp из authorization
 from app import SpotifyAgent # Класс-агент
 from authorization import sp # Клиент tekore, который будет передан в SpotifyAgent
@@ -50,6 +51,7 @@ SAMPLE_TRACK_QUERIES = [
 
 NUM_RATINGS_PER_USER = 10
 MAX_SEARCH_RESULTS_TO_CONSIDER = 1 # Берем первый результат поиска Spotify
+POPULATE_CONCURRENCY = int(os.getenv('POPULATE_CONCURRENCY', '8')) # одновременных поисков в Spotify (частоту ограничивает rate limiter)
 
 async def find_track_spotify_id(track_name: str, artist_name: str) -> Optional[str]:
     """Ищет трек на Spotify и возвращает его Spotify ID, если найден."""
@@ -93,55 +95,48 @@ async def populate():
     num_users_processed = 0
     num_ratings_added = 0
     
-    track_spotify_id_cache = {}
     logger.info(f"Получение Spotify ID для {len(SAMPLE_TRACK_QUERIES)} тестовых треков...")
-    for track_name, artist_name in SAMPLE_TRACK_QUERIES:
-        logger.info(f"Ищем Spotify ID для: '{track_name}' - '{artist_name}'")
-        spotify_id = await find_track_spotify_id(track_name, artist_name)
-        if spotify_id:
-            track_spotify_id_cache[(track_name, artist_name)] = spotify_id
-        await asyncio.sleep(0.2) # Небольшая задержка между запросами к Spotify API
-
-    valid_spotify_ids_to_rate = list(track_spotify_id_cache.values())
+    # Поиски идут параллельно; частоту запросов к Spotify API ограничивает общий spotify_rate_limiter
+    semaphore = asyncio.Semaphore(POPULATE_CONCURRENCY)
+    async def _find_limited(track_name: str, artist_name: str) -> Optional[str]:
+        async with semaphore:
+            logger.info(f"Ищем Spotify ID для: '{track_name}' - '{artist_name}'")
+            return await find_track_spotify_id(track_name, artist_name)
+    found_spotify_ids = await asyncio.gather(*(_find_limited(name, artist) for name, artist in SAMPLE_TRACK_QUERIES))
+
+    valid_spotify_ids_to_rate = list(dict.fromkeys(spotify_id for spotify_id in found_spotify_ids if spotify_id))
     if not valid_spotify_ids_to_rate:
         logger.error("Не удалось получить Spotify ID ни для одного из тестовых треков. Наполнение невозможно.")
         return
     logger.info(f"Успешно получено {len(valid_spotify_ids_to_rate)} Spotify ID для оценки.")
 
+    user_nums = bulk_add_user_mappings(SAMPLE_TELEGRAM_USER_IDS)
+    ratings_to_save = []
     for user_id in SAMPLE_TELEGRAM_USER_IDS:
-        logger.info(f"Обработка пользователя с Telegram ID: {user_id}")
-        user_num = add_user_mapping(user_id) # add_user_mapping синхронная
-        if user_num == -1:
+        user_num = user_nums.get(user_id)
+        if user_num is None:
             logger.error(f"Не удалось добавить/получить user_mapping для user_id={user_id}. Пропускаем.")
             continue
-        
-        logger.info(f"Пользователь {user_id} (user_num={user_num}) обработан/добавлен.")
         num_users_processed += 1
 
         num_tracks_to_rate = min(NUM_RATINGS_PER_USER, len(valid_spotify_ids_to_rate))
-        
-        if len(valid_spotify_ids_to_rate) >= num_tracks_to_rate and num_tracks_to_rate > 0 :
-            spotify_ids_for_this_user = random.sample(valid_spotify_ids_to_rate, num_tracks_to_rate)
-        elif valid_spotify_ids_to_rate: 
-            spotify_ids_for_this_user = valid_spotify_ids_to_rate
-            logger.warning(f"  Запрошено {num_tracks_to_rate} оценок, но доступно только {len(valid_spotify_ids_to_rate)} Spotify ID.")
-        else: 
-            logger.warning(f"  Нет доступных Spotify ID для оценки пользователем {user_id}.")
-            continue 
-        
-        for track_spotify_id in spotify_ids_for_this_user:
-            rating = random.randint(1, 5) 
-            logger.debug(f"  Сохранение оценки для user_id={user_id}, track_spotify_id='{track_spotify_id}', rating={rating}")
-            try:
-                save_track_rating(user_id, track_spotify_id, rating) # save_track_rating синхронная
-                num_ratings_added +=1
-            except Exception as e:
-                logger.error(f"  Ошибка при сохранении оценки для user_id={user_id}, track_spotify_id='{track_spotify_id}': {e}")
-            
+        spotify_ids_for_this_user = random.sample(valid_spotify_ids_to_rate, num_tracks_to_rate)
+        if num_tracks_to_rate < NUM_RATINGS_PER_USER:
+            logger.warning(f"  Запрошено {NUM_RATINGS_PER_USER} оценок, но доступно только {len(valid_spotify_ids_to_rate)} Spotify ID.")
+        ratings_to_save.extend(
+            (user_id, track_spotify_id, random.randint(1, 5)) for track_spotify_id in spotify_ids_for_this_user
+        )
+
+    # Все оценки записываются одной транзакцией
+    num_ratings_added = bulk_save_ratings(ratings_to_save)
+
     logger.info(f"Наполнение базы данных завершено. Обработано пользователей: {num_users_processed}. Добавлено оценок: {num_ratings_added}.")
 
 async def main_populate():
-    await populate()
+    try:
+        await populate()
+    finally:
+        close_db_pool()
 
 if __name__ == "__main__":
     # Перед запуском убедитесь, что:
@@ -0,0 +1,64 @@
+import logging
+import os
+import time
+
+from database import get_ratings, get_active_users, save_precomputed_recommendations, close_db_pool
+from collaborative import SparseRatingMatrix
+from mf_model import get_serving_model
+from config import RECS_ENGINE
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+PRECOMPUTE_ACTIVE_DAYS = float(os.getenv('PRECOMPUTE_ACTIVE_DAYS', '30')) # пользователи с оценками за последние N дней
+PRECOMPUTE_NUM_RECS = int(os.getenv('PRECOMPUTE_NUM_RECS', '10')) # коллаборативных кандидатов на пользователя
+PRECOMPUTE_K = int(os.getenv('PRECOMPUTE_K', '5')) # соседей для косинусной схожести
+PRECOMPUTE_CHUNK_SIZE = int(os.getenv('PRECOMPUTE_CHUNK_SIZE', '500')) # пользователей в одном матричном блоке
+
+def precompute():
+    logger.info(f"Пакетный расчет рекомендаций (движок '{RECS_ENGINE}')...")
+    if RECS_ENGINE not in ('cosine', 'mf'):
+        logger.error(f"Движок '{RECS_ENGINE}' не поддерживается пакетным расчетом (только 'cosine' и 'mf').")
+        return
+    active_users = get_active_users(PRECOMPUTE_ACTIVE_DAYS * 24 * 3600)
+    if not active_users:
+        logger.info("Нет активных пользователей.")
+        return
+    df_ratings = get_ratings()
+    if df_ratings.empty:
+        logger.error("Нет оценок для расчета рекомендаций.")
+        return
+    user_nums = [user_num for _, user_num in active_users]
+
+    started = time.perf_counter()
+    if RECS_ENGINE == 'mf':
+        mf_model = get_serving_model()
+        if mf_model is None:
+            logger.error("MF-модель не загружена, сначала запустите train_mf.py.")
+            return
+        active_ratings = df_ratings[df_ratings['user_id'].isin(user_nums)]
+        rated_by_user = {user_num: set(group) for user_num, group in active_ratings.groupby('user_id')['track_id']}
+        recs_by_user_num = mf_model.recommend_for_users(user_nums, PRECOMPUTE_NUM_RECS, rated_by_user)
+    else:
+        rating_matrix = SparseRatingMatrix.from_ratings(df_ratings)
+        recs_by_user_num = rating_matrix.recommend_for_users(
+            user_nums, k=PRECOMPUTE_K, n=PRECOMPUTE_NUM_RECS, chunk_size=PRECOMPUTE_CHUNK_SIZE
+        )
+    logger.info(f"Рекомендации для {len(recs_by_user_num)} из {len(active_users)} активных пользователей "
+                f"посчитаны за {time.perf_counter() - started:.1f} с.")
+
+    rows = [
+        (telegram_user_id, recs_by_user_num[user_num])
+        for telegram_user_id, user_num in active_users if user_num in recs_by_user_num
+    ]
+    save_precomputed_recommendations(RECS_ENGINE, rows)
+
+if __name__ == "__main__":
+    # Запускается по расписанию (например, cron) отдельно от бота, как populate_db.py и train_mf.py.
+    try:
+        precompute()
+    finally:
+        close_db_pool()
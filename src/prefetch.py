@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from audio_pipeline import AUDIO_DELIVERY_MODE, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+from async_database import get_track_audio, save_track_audio
+
+logger = logging.getLogger(__name__)
+
+AUDIO_PREFETCH_PER_USER = int(os.getenv('AUDIO_PREFETCH_PER_USER', '3')) # сколько рекомендаций предзагружать одному пользователю
+AUDIO_PREFETCH_MAX = int(os.getenv('AUDIO_PREFETCH_MAX', '20')) # всего предзагрузок одновременно (в работе и готовых)
+AUDIO_PREFETCH_TTL = float(os.getenv('AUDIO_PREFETCH_TTL', '600')) # секунд хранения невостребованной предзагрузки
+
+
+class _PrefetchEntry:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.created_at = time.monotonic()
+        self.claimed = False
+        self.video_url: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class AudioPrefetcher:
+    """
+    Фоновая предзагрузка аудио для только что отправленных рекомендаций: поиск видео и скачивание
+    с низким приоритетом в конвейере загрузок. В режиме native предзагружается только поиск видео:
+    аудио в памяти (до AUDIO_INMEMORY_MAX_BYTES на трек) держать для всех предзагрузок слишком дорого,
+    оно скачивается при нажатии. При нажатии "Прослушать" claim() отдает готовый
+    или еще скачивающийся результат. Невостребованные результаты удаляются, когда пользователь
+    запрашивает новые рекомендации (drop_user), и в любом случае по истечении TTL.
+    """
+    def __init__(self, youtube_agent, per_user_limit: int = AUDIO_PREFETCH_PER_USER,
+                 global_limit: int = AUDIO_PREFETCH_MAX, ttl: float = AUDIO_PREFETCH_TTL):
+        self.youtube_agent = youtube_agent
+        self.per_user_limit = per_user_limit
+        self.global_limit = global_limit
+        self.ttl = ttl
+        self._entries: Dict[str, _PrefetchEntry] = {} # Spotify ID -> предзагрузка
+        # Статистика
+        self.scheduled = 0
+        self.claimed_hits = 0
+        self.evicted = 0
+        self.superseded = 0
+
+    def schedule(self, user_id: int, recommendations: List[Dict[str, Any]]):
+        """Запускает предзагрузку первых рекомендаций (поля track_id, track_name, artist_names) в пределах лимитов."""
+        user_slots = self.per_user_limit - sum(1 for e in self._entries.values() if e.user_id == user_id)
+        for track_data in recommendations:
+            if user_slots <= 0 or len(self._entries) >= self.global_limit:
+                break
+            track_spotify_id = track_data['track_id']
+            if track_spotify_id in self._entries:
+                continue
+            artist_names = track_data.get('artist_names') or [""]
+            entry = _PrefetchEntry(user_id)
+            entry.task = asyncio.create_task(
+                self._prefetch(entry, track_spotify_id, track_data['track_name'], artist_names[0])
+            )
+            self._entries[track_spotify_id] = entry
+            self.scheduled += 1
+            user_slots -= 1
+
+    async def _prefetch(self, entry: _PrefetchEntry, track_spotify_id: str, track_name: str, artist_name: str) -> Optional[Dict[str, Any]]:
+        try:
+            cached_audio = await get_track_audio(track_spotify_id)
+            if cached_audio and cached_audio.get('telegram_file_id'):
+                return None # уже загружен в Telegram, отправится по file_id
+            video_id = cached_audio.get('youtube_video_id') if cached_audio else None
+            if not video_id:
+                video_info = await self.youtube_agent.search_video(track_name, artist_name)
+                if not video_info or 'videoId' not in video_info.get('id', {}):
+                    return None
+                video_id = video_info['id']['videoId']
+                await save_track_audio(track_spotify_id, None, video_id)
+            entry.video_url = f"https://www.youtube.com/watch?v={video_id}"
+            result = {'video_id': video_id, 'native_audio': None, 'audio_file_path': None}
+            if AUDIO_DELIVERY_MODE == 'native':
+                return result
+            priority = PRIORITY_INTERACTIVE if entry.claimed else PRIORITY_PREFETCH
+            result['audio_file_path'] = await self.youtube_agent.download_audio(entry.video_url, priority, wait_for_slot=entry.claimed)
+            logger.info(f"AudioPrefetcher: аудио для Spotify ID {track_spotify_id} предзагружено.")
+            return result
+        except Exception as e:
+            logger.warning(f"AudioPrefetcher: ошибка предзагрузки Spotify ID {track_spotify_id}: {e}")
+            return None
+
+    async def claim(self, track_spotify_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Забирает предзагрузку трека (дожидаясь ее, если она еще идет). Возвращает словарь
+        с video_id и audio_file_path (его нужно освободить через youtube_agent.release_audio; в режиме native
+        файла нет - только video_id) либо None, если предзагрузки нет или она не удалась.
+        """
+        entry = self._entries.pop(track_spotify_id, None)
+        if entry is None:
+            return None
+        entry.claimed = True
+        if entry.video_url:
+            self.youtube_agent.pipeline.promote(entry.video_url)
+        result = await asyncio.shield(entry.task)
+        if result:
+            self.claimed_hits += 1
+        return result
+
+    def _release(self, entry: _PrefetchEntry):
+        result = entry.task.result() if not entry.task.cancelled() else None
+        if result and result.get('audio_file_path'):
+            self.youtube_agent.release_audio(result['audio_file_path'])
+
+    def _discard(self, entry: _PrefetchEntry):
+        if entry.task.done():
+            self._release(entry)
+        else:
+            entry.task.cancel() # файл, успевший скачаться до отмены, освобождается по завершении задачи
+            entry.task.add_done_callback(lambda _: self._release(entry))
+
+    def drop_user(self, user_id: int):
+        """
+        Пользователь перешел к новым рекомендациям: невостребованные предзагрузки прежних
+        больше не занимают его лимит (готовые освобождаются, незавершенные отменяются).
+        """
+        for track_spotify_id, entry in list(self._entries.items()):
+            if entry.user_id == user_id:
+                del self._entries[track_spotify_id]
+                self._discard(entry)
+                self.superseded += 1
+
+    def evict_expired(self):
+        """Удаляет невостребованные предзагрузки старше TTL (незавершенные дожидаются следующего прохода)."""
+        now = time.monotonic()
+        for track_spotify_id, entry in list(self._entries.items()):
+            if now - entry.created_at >= self.ttl and entry.task.done():
+                del self._entries[track_spotify_id]
+                self._release(entry)
+                self.evicted += 1
+
+    async def run_periodic_eviction(self, interval: Optional[float] = None):
+        interval = interval or max(self.ttl / 4, 1.0)
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_expired()
+
+    async def shutdown(self):
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            entry.task.cancel()
+        await asyncio.gather(*(entry.task for entry in entries), return_exceptions=True)
+        for entry in entries:
+            self._release(entry)
+        logger.info(f"AudioPrefetcher: остановлен. Статистика: {self.stats()}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self._entries),
+            'scheduled': self.scheduled,
+            'claimed_hits': self.claimed_hits,
+            'evicted': self.evicted,
+            'superseded': self.superseded,
+        }
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов (token bucket), общий для всего процесса.
+    Потокобезопасен и не привязан к event loop: acquire() резервирует токен и ждет,
+    пока до него дойдет очередь, поэтому одновременные запросы выстраиваются равномерно.
+    """
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate # токенов в секунду
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.throttled = 0
+
+    def _reserve(self, tokens: float) -> float:
+        """Списывает токены (баланс может уйти в минус) и возвращает, сколько секунд ждать."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            self.acquired += 1
+            if self._tokens >= 0:
+                return 0.0
+            self.throttled += 1
+            return -self._tokens / self.rate
+
+    def _refund(self, tokens: float):
+        """Возвращает токены отмененного ожидания, чтобы следующие запросы не ждали за него."""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+    async def acquire(self, tokens: float = 1.0):
+        delay = self._reserve(tokens)
+        if delay > 0:
+            logger.debug(f"RateLimiter[{self.name}]: ожидание {delay:.3f} с")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self._refund(tokens)
+                raise
+
+
+# --- Ограничители для внешних API (запросов в секунду и допустимый всплеск) ---
+spotify_rate_limiter = TokenBucket(
+    'spotify', float(os.getenv('SPOTIFY_RATE_LIMIT', '10')), float(os.getenv('SPOTIFY_RATE_BURST', '10'))
+)
+lastfm_rate_limiter = TokenBucket(
+    'lastfm', float(os.getenv('LASTFM_RATE_LIMIT', '5')), float(os.getenv('LASTFM_RATE_BURST', '5'))
+)
+youtube_rate_limiter = TokenBucket(
+    'youtube', float(os.getenv('YOUTUBE_RATE_LIMIT', '5')), float(os.getenv('YOUTUBE_RATE_BURST', '5'))
+)
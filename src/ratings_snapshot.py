@@ -0,0 +1,81 @@
+import datetime
+import logging
+import os
+import threading
+from typing import Callable, Optional
+
+import pandas as pd
+
+from database import get_ratings_since
+from ratings_store import RatingsStore
+
+logger = logging.getLogger(__name__)
+
+# Запас при инкрементальной загрузке: rated_at ставится в начале транзакции, поэтому строка
+# с rated_at чуть меньше водяного знака может стать видимой уже после предыдущего обновления
+RATINGS_SNAPSHOT_OVERLAP = float(os.getenv('RATINGS_SNAPSHOT_OVERLAP', '60')) # секунд
+
+
+class RatingsSnapshot:
+    """
+    Снимок всех оценок в памяти процесса (в компактном RatingsStore). Первый вызов загружает таблицу целиком,
+    дальше refresh() догружает только строки с rated_at новее водяного знака (минус запас) и применяет их как upsert.
+    get_store() отдает само хранилище, get_ratings() - DataFrame того же вида, что database.get_ratings().
+    loader(since) возвращает строки (user_num, track_id, rating, rated_at) или None при ошибке БД.
+    """
+    def __init__(self, overlap_seconds: float = RATINGS_SNAPSHOT_OVERLAP,
+                 loader: Callable[[Optional[datetime.datetime]], Optional[list]] = get_ratings_since):
+        self.loader = loader
+        self.overlap = datetime.timedelta(seconds=overlap_seconds)
+        self._lock = threading.Lock()
+        self.store = RatingsStore()
+        self._watermark: Optional[datetime.datetime] = None
+        self._loaded = False
+        self._df: Optional[pd.DataFrame] = None
+        self._df_version = -1 # версия хранилища, из которой собран _df
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def refresh(self) -> bool:
+        """Догружает новые оценки. False - не удалось обратиться к БД (снимок остается прежним)."""
+        with self._lock:
+            since = self._watermark - self.overlap if self._watermark is not None else None
+            rows = self.loader(since)
+            if rows is None:
+                return False
+            changed = 0
+            if not self._loaded:
+                self.store.bulk_load((user_num, track_id, rating) for user_num, track_id, rating, _ in rows)
+            else:
+                for user_num, track_id, rating, _ in rows:
+                    changed += self.store.upsert(user_num, track_id, rating)
+            for *_, rated_at in rows:
+                if rated_at is not None and (self._watermark is None or rated_at > self._watermark):
+                    self._watermark = rated_at
+            if not self._loaded:
+                logger.info(f"RatingsSnapshot: загружено {len(self.store)} оценок.")
+            elif changed:
+                logger.info(f"RatingsSnapshot: получено {len(rows)} строк, изменилось {changed} оценок.")
+            self._loaded = True
+            return True
+
+    def get_store(self) -> Optional[RatingsStore]:
+        """Актуальное хранилище оценок; None, если снимок еще ни разу не загрузился."""
+        if not self.refresh() and not self._loaded:
+            return None
+        return self.store
+
+    def get_ratings(self) -> pd.DataFrame:
+        """Актуальные оценки (колонки user_id = user_num, track_id, rating)."""
+        if self.get_store() is None:
+            return pd.DataFrame()
+        with self._lock:
+            if self._df_version != self.store.version:
+                self._df = self.store.to_dataframe()
+                self._df_version = self.store.version
+            return self._df
+
+
+ratings_snapshot = RatingsSnapshot()
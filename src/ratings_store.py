@@ -0,0 +1,189 @@
+import logging
+import threading
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+logger = logging.getLogger(__name__)
+
+STORE_MAX_PENDING = 4096 # новых пар в буфере, после которых upsert вливает буфер в CSR
+
+
+class RatingsStore:
+    """
+    Компактное хранилище оценок в памяти. Spotify ID и user_num интернируются в int32-индексы,
+    оценки хранятся как int8 в CSR-раскладке по пользователям (indptr/items/values), поэтому
+    оценки пользователя - срез массива за O(1), а на одну оценку приходится ~5 байт (плюс indptr на пользователя).
+    Новые пары (пользователь, трек) копятся в небольшом буфере и вливаются в CSR при следующем чтении;
+    изменение существующей оценки пишется прямо в массив.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._user_index: Dict[int, int] = {} # user_num -> строка
+        self._user_ids: List[int] = []
+        self._track_index: Dict[str, int] = {} # Spotify ID -> столбец
+        self._track_ids: List[str] = []
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._items = np.empty(0, dtype=np.int32)
+        self._values = np.empty(0, dtype=np.int8)
+        self._pending: Dict[Tuple[int, int], int] = {} # (строка, столбец) -> оценка, еще не в CSR
+        self.version = 0 # увеличивается при каждом изменении
+
+    # --- Запись ---
+
+    def _intern_user(self, user_num: int) -> int:
+        row = self._user_index.get(user_num)
+        if row is None:
+            row = self._user_index[user_num] = len(self._user_ids)
+            self._user_ids.append(user_num)
+        return row
+
+    def _intern_track(self, track_id: str) -> int:
+        col = self._track_index.get(track_id)
+        if col is None:
+            col = self._track_index[track_id] = len(self._track_ids)
+            self._track_ids.append(track_id)
+        return col
+
+    def _set_from_coo(self, rows: np.ndarray, items: np.ndarray, values: np.ndarray):
+        order = np.lexsort((items, rows))
+        counts = np.bincount(rows, minlength=len(self._user_ids))
+        self._indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self._items = items[order].astype(np.int32, copy=False)
+        self._values = values[order].astype(np.int8, copy=False)
+
+    def bulk_load(self, rows: Iterable[Tuple[int, str, int]]):
+        """Заполняет хранилище строками (user_num, track_id, rating); при повторах пары побеждает последняя."""
+        with self._lock:
+            user_rows, items, values = [], [], []
+            for user_num, track_id, rating in rows:
+                user_rows.append(self._intern_user(int(user_num)))
+                items.append(self._intern_track(track_id))
+                values.append(rating)
+            self._compact()
+            user_rows = np.concatenate([self._row_numbers(), np.array(user_rows, dtype=np.int32)])
+            items = np.concatenate([self._items, np.array(items, dtype=np.int32)])
+            values = np.concatenate([self._values, np.array(values, dtype=np.int8)])
+            keys = user_rows.astype(np.int64) * max(len(self._track_ids), 1) + items
+            _, last_reversed = np.unique(keys[::-1], return_index=True)
+            keep = len(keys) - 1 - last_reversed
+            self._set_from_coo(user_rows[keep], items[keep], values[keep])
+            self.version += 1
+            logger.info(f"RatingsStore: загружено {len(self._items)} оценок ({self.nbytes} байт в массивах оценок).")
+
+    def upsert(self, user_num: int, track_id: str, rating: int) -> bool:
+        """Добавляет или меняет оценку. Возвращает True, если хранилище изменилось."""
+        with self._lock:
+            row = self._intern_user(int(user_num))
+            col = self._intern_track(track_id)
+            if row < len(self._indptr) - 1:
+                start, end = self._indptr[row], self._indptr[row + 1]
+                pos = start + np.searchsorted(self._items[start:end], col)
+                if pos < end and self._items[pos] == col:
+                    if self._values[pos] == rating:
+                        return False
+                    self._values[pos] = rating
+                    self.version += 1
+                    return True
+            if self._pending.get((row, col)) == rating:
+                return False
+            self._pending[(row, col)] = rating
+            self.version += 1
+            if len(self._pending) >= STORE_MAX_PENDING:
+                self._compact()
+            return True
+
+    def _row_numbers(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self._indptr) - 1, dtype=np.int32), np.diff(self._indptr))
+
+    def _compact(self):
+        """Вливает буфер новых пар в CSR."""
+        if not self._pending and len(self._indptr) - 1 == len(self._user_ids):
+            return
+        pending_keys = np.array(list(self._pending), dtype=np.int32).reshape(-1, 2)
+        pending_values = np.fromiter(self._pending.values(), dtype=np.int8, count=len(self._pending))
+        self._set_from_coo(
+            np.concatenate([self._row_numbers(), pending_keys[:, 0]]),
+            np.concatenate([self._items, pending_keys[:, 1]]),
+            np.concatenate([self._values, pending_values]),
+        )
+        self._pending = {}
+
+    # --- Чтение ---
+
+    def __len__(self) -> int:
+        return len(self._items) + len(self._pending)
+
+    @property
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._indptr.nbytes + self._items.nbytes + self._values.nbytes
+
+    def has_user(self, user_num: int) -> bool:
+        return user_num in self._user_index
+
+    def rated_tracks(self, user_num: int) -> Set[str]:
+        with self._lock:
+            row = self._user_index.get(user_num)
+            if row is None:
+                return set()
+            self._compact()
+            items = self._items[self._indptr[row]:self._indptr[row + 1]]
+            return {self._track_ids[col] for col in items.tolist()}
+
+    def user_ratings(self, user_num: int) -> Dict[str, int]:
+        """Оценки пользователя {Spotify ID: оценка}: срез CSR плюс его пары из буфера (без вливания буфера)."""
+        with self._lock:
+            row = self._user_index.get(user_num)
+            if row is None:
+                return {}
+            ratings = {}
+            if row < len(self._indptr) - 1:
+                start, end = self._indptr[row], self._indptr[row + 1]
+                ratings = dict(zip((self._track_ids[col] for col in self._items[start:end].tolist()),
+                                   self._values[start:end].tolist()))
+            for (pending_row, col), rating in self._pending.items():
+                if pending_row == row:
+                    ratings[self._track_ids[col]] = rating
+            return ratings
+
+    def iter_ratings(self) -> Iterator[Tuple[int, str, int]]:
+        """Все оценки (user_num, track_id, rating); снимок на момент вызова."""
+        with self._lock:
+            self._compact()
+            user_ids = np.array(self._user_ids, dtype=np.int64)[self._row_numbers()].tolist()
+            track_ids = [self._track_ids[col] for col in self._items.tolist()]
+            values = self._values.tolist()
+        return zip(user_ids, track_ids, values)
+
+    def to_csr(self) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+        """
+        (user_ids, track_ids, матрица оценок) с пользователями и треками в отсортированном порядке -
+        в том же виде, что строит SparseRatingMatrix.from_ratings.
+        """
+        with self._lock:
+            self._compact()
+            user_ids = np.array(self._user_ids, dtype=np.int64)
+            track_ids = np.array(self._track_ids, dtype=object)
+            rows, items, values = self._row_numbers(), self._items.copy(), self._values.copy()
+        user_order = np.argsort(user_ids, kind='stable')
+        track_order = np.argsort(track_ids, kind='stable')
+        user_rank = np.empty(len(user_ids), dtype=np.int32)
+        user_rank[user_order] = np.arange(len(user_ids), dtype=np.int32)
+        track_rank = np.empty(len(track_ids), dtype=np.int32)
+        track_rank[track_order] = np.arange(len(track_ids), dtype=np.int32)
+        ratings = sparse.csr_matrix(
+            (values.astype(np.float64), (user_rank[rows], track_rank[items])),
+            shape=(len(user_ids), len(track_ids))
+        )
+        ratings.sort_indices()
+        return user_ids[user_order], track_ids[track_order], ratings
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Оценки в виде DataFrame database.get_ratings() (колонки user_id = user_num, track_id, rating)."""
+        return pd.DataFrame(list(self.iter_ratings()), columns=['user_id', 'track_id', 'rating'])
@@ -0,0 +1,392 @@
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import async_database
+from cache import RecommendationCache, recommendation_cache
+from candidate_sources import (
+    CandidateContext,
+    CandidateSource,
+    collect_candidates,
+    iter_candidate_batches,
+    merge_candidates,
+)
+from collaborative import NeighbourModel, get_rating_matrix, neighbour_model
+from config import RECS_ENGINE, PRECOMPUTED_RECS_MAX_AGE, CONTENT_STAGE_CONCURRENCY, RECS_LATENCY_BUDGET
+from metrics import observe_first_result, observe_stage, recommendation_request
+from mf_model import get_serving_model
+from ratings_snapshot import RatingsSnapshot, ratings_snapshot
+from user_mapping import UserMappingCache, user_mapping_cache
+from write_buffer import WriteBehindBuffer, write_buffer
+
+logger = logging.getLogger(__name__)
+
+
+# --- Вспомогательная функция для коллаборативной фильтрации ---
+def _collaborative_from_snapshot(snapshot: RatingsSnapshot, target_user_matrix_idx: int, k: int, n: int) -> List[str]:
+    """Коллаборативные рекомендации по снимку всех оценок (если модель соседей не загружена)."""
+    rating_matrix = get_rating_matrix(snapshot)
+    if rating_matrix is None or rating_matrix.empty or not rating_matrix.has_user(target_user_matrix_idx):
+        logger.warning("Матрица оценок пуста или текущий пользователь в ней отсутствует для коллаборативной фильтрации.")
+        return []
+    similar_user_indices = rating_matrix.similar_users(target_user_matrix_idx, k=k)
+    if not similar_user_indices:
+        return []
+    return rating_matrix.recommend_tracks(target_user_matrix_idx, similar_user_indices, n)
+
+# --- Вспомогательные функции контентного этапа ---
+async def _limited(semaphore: asyncio.Semaphore, coro):
+    async with semaphore:
+        return await coro
+
+async def _similar_tracks_via_lastfm(seed_info: Dict[str, Any], lastfm_agent, spotify_agent,
+                                     semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+    """Похожие на сид треки с Last.fm, найденные в Spotify (поиски в Spotify - параллельно)."""
+    track_title, artist_name = seed_info['name'], seed_info['artist_name']
+    logger.info(f"Ищем похожие треки на Last.fm для: '{track_title}' - '{artist_name}'")
+    similar_lfm_tracks = await _limited(semaphore, lastfm_agent.get_similar_tracks(track_title, artist_name, limit=3))
+    if not similar_lfm_tracks:
+        return []
+    logger.info(f"Найдено на Last.fm: {len(similar_lfm_tracks)} похожих. Ищем их в Spotify...")
+    spotify_results = await asyncio.gather(*(
+        _limited(semaphore, spotify_agent.resolve_track(lfm_track['name'], lfm_track['artist_name']))
+        for lfm_track in similar_lfm_tracks
+    ))
+    candidates = []
+    for lfm_track, spotify_equivalent in zip(similar_lfm_tracks, spotify_results):
+        if spotify_equivalent:
+            logger.info(f"  Last.fm '{lfm_track['name']}' -> Spotify: {spotify_equivalent['name']} (ID: {spotify_equivalent['id']})")
+            candidates.append(spotify_equivalent)
+    return candidates
+
+async def _artist_top_tracks(artist_id: str, spotify_agent, semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+    top_artist_tracks_spotify = await _limited(semaphore, spotify_agent.get_artist_top_tracks(artist_id, "US", 2))
+    if top_artist_tracks_spotify:
+        logger.info(f"  Добавлены топ-треки ({len(top_artist_tracks_spotify)}) от исполнителя {artist_id}")
+    return top_artist_tracks_spotify
+
+# --- Источники кандидатов (фреймворк - в candidate_sources.py) ---
+def _content_candidate(track_info: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'track_id': track_info['id'],
+        'track_name': track_info['name'],
+        'artist_names': track_info.get('artist_names', [track_info.get('artist_name', 'Unknown Artist')]),
+        'spotify_url': track_info.get('spotify_url', "N/A"),
+        'source': 'content_hybrid'
+    }
+
+class CollaborativeSource(CandidateSource):
+    """Коллаборативные кандидаты (Spotify ID) движком рекомендателя или из предрасчета, с метаданными из Spotify."""
+    name = 'collaborative'
+
+    async def fetch(self, context: CandidateContext) -> List[Dict[str, Any]]:
+        recommender: Recommender = context.extra['recommender']
+        logger.info(f"Источник коллаборативной фильтрации (Spotify ID, движок '{recommender.engine}')...")
+        started = time.perf_counter()
+        track_ids = await self._track_ids(context, recommender)
+        logger.info(f"Найдено {len(track_ids)} потенциальных коллаборативных рекомендаций (Spotify ID) "
+                    f"за {(time.perf_counter() - started) * 1000:.1f} мс.")
+        tracks_info = await recommender.spotify_agent.get_tracks_basic_info(track_ids)
+        candidates = []
+        for sp_id in dict.fromkeys(track_ids):
+            track_info = tracks_info.get(sp_id) if sp_id else None
+            if track_info:
+                candidates.append({
+                    'track_id': sp_id,
+                    'track_name': track_info['name'],
+                    'artist_names': track_info['artist_names'],
+                    'spotify_url': track_info.get('spotify_url', "N/A"),
+                    'source': 'collaborative'
+                })
+        return candidates
+
+    @staticmethod
+    async def _track_ids(context: CandidateContext, recommender: 'Recommender') -> List[str]:
+        user_num, rated = context.user_num, context.rated_track_ids
+        limit = context.num_recs * 2
+        precomputed_recs = context.extra['precomputed_recs']
+        ratings_store = context.extra['ratings_store']
+        if precomputed_recs is not None:
+            logger.info("Используем предрасчитанные коллаборативные рекомендации.")
+            return [t for t in precomputed_recs if t not in rated][:limit]
+        if recommender.engine == 'mf':
+            mf_model = await asyncio.to_thread(get_serving_model)
+            if mf_model is not None and mf_model.has_user(user_num):
+                return mf_model.recommend(user_num, limit, exclude=rated)
+            logger.info("MF-модель не загружена или пользователь в ней отсутствует, используем косинусную схожесть пользователей.")
+        elif recommender.engine == 'item':
+            item_recs = await recommender.database.get_item_based_recommendations(context.telegram_user_id, 4, limit)
+            if item_recs:
+                return item_recs
+            logger.info("Нет item-based рекомендаций (track_neighbors пуста?), используем косинусную схожесть пользователей.")
+        if ratings_store is None:
+            return await asyncio.to_thread(recommender.neighbours.recommend, user_num, context.k_similar_users, limit)
+        return await asyncio.to_thread(
+            _collaborative_from_snapshot, recommender.snapshot, user_num, context.k_similar_users, limit
+        )
+
+async def _load_seeds(context: CandidateContext) -> List[Dict[str, Any]]:
+    """Сиды контентных источников: два самых высоко оцененных трека пользователя с метаданными Spotify."""
+    recommender: Recommender = context.extra['recommender']
+    top_rated_spotify_ids_by_user = await recommender.database.get_top_rated_tracks(context.telegram_user_id, 4)
+    if not top_rated_spotify_ids_by_user:
+        logger.info("У пользователя нет высоко оцененных треков для использования в качестве сидов.")
+        return []
+    logger.info(f"Найдено {len(top_rated_spotify_ids_by_user)} высоко оцененных треков пользователя (Spotify ID).")
+    seed_spotify_ids = top_rated_spotify_ids_by_user[:2]
+    seed_tracks_spotify_info = await recommender.spotify_agent.get_tracks_basic_info(seed_spotify_ids)
+    return [
+        seed_tracks_spotify_info[seed_id] for seed_id in seed_spotify_ids
+        if seed_id in seed_tracks_spotify_info
+        and seed_tracks_spotify_info[seed_id].get('name') and seed_tracks_spotify_info[seed_id].get('artist_name')
+    ]
+
+class LastFMSimilarSource(CandidateSource):
+    """Похожие на сиды треки с Last.fm, найденные в Spotify."""
+    name = 'lastfm_similar'
+
+    async def fetch(self, context: CandidateContext) -> List[Dict[str, Any]]:
+        recommender: Recommender = context.extra['recommender']
+        seeds_info = await context.shared('seeds', lambda: _load_seeds(context))
+        chains = await asyncio.gather(*(
+            _similar_tracks_via_lastfm(seed_info, recommender.lastfm_agent, recommender.spotify_agent, context.extra['semaphore'])
+            for seed_info in seeds_info
+        ))
+        return [_content_candidate(track_info) for chain in chains for track_info in chain]
+
+class ArtistTopTracksSource(CandidateSource):
+    """Топ-треки исполнителей сидов."""
+    name = 'artist_top_tracks'
+
+    async def fetch(self, context: CandidateContext) -> List[Dict[str, Any]]:
+        recommender: Recommender = context.extra['recommender']
+        seeds_info = await context.shared('seeds', lambda: _load_seeds(context))
+        liked_artist_spotify_ids = list(dict.fromkeys(info['artist_id'] for info in seeds_info if info.get('artist_id')))[:2]
+        if not liked_artist_spotify_ids:
+            return []
+        logger.info(f"Ищем топ-треки для понравившихся исполнителей Spotify IDs: {liked_artist_spotify_ids}...")
+        chains = await asyncio.gather(*(
+            _artist_top_tracks(artist_id, recommender.spotify_agent, context.extra['semaphore'])
+            for artist_id in liked_artist_spotify_ids
+        ))
+        return [_content_candidate(track_info) for chain in chains for track_info in chain]
+
+# Порядок источников - приоритет при объединении (трек из более раннего источника побеждает)
+DEFAULT_CANDIDATE_SOURCES: Tuple[CandidateSource, ...] = (CollaborativeSource(), LastFMSimilarSource(), ArtistTopTracksSource())
+
+
+# --- Рекомендатель ---
+
+class Recommender:
+    """
+    Конвейер рекомендаций: данные пользователя, источники кандидатов под бюджетом времени, объединение
+    и кэш рассчитанных кандидатов. Все зависимости передаются в конструкторе (по умолчанию - общие объекты
+    процесса); database - объект с асинхронными get_precomputed_recommendations, get_top_rated_tracks
+    и get_item_based_recommendations (по умолчанию async_database). Агенты - SpotifyAgent/LastFMAgent из app.py
+    или совместимые с ними объекты, поэтому бенчмарк и тесты запускают конвейер без бота и сети.
+    """
+    def __init__(self, spotify_agent, lastfm_agent, database=async_database,
+                 snapshot: RatingsSnapshot = ratings_snapshot, neighbours: NeighbourModel = neighbour_model,
+                 user_mapping: UserMappingCache = user_mapping_cache, buffer: WriteBehindBuffer = write_buffer,
+                 cache: RecommendationCache = recommendation_cache, engine: str = RECS_ENGINE,
+                 sources: Sequence[CandidateSource] = DEFAULT_CANDIDATE_SOURCES,
+                 latency_budget: float = RECS_LATENCY_BUDGET, concurrency: int = CONTENT_STAGE_CONCURRENCY):
+        self.spotify_agent = spotify_agent
+        self.lastfm_agent = lastfm_agent
+        self.database = database
+        self.snapshot = snapshot
+        self.neighbours = neighbours
+        self.user_mapping = user_mapping
+        self.buffer = buffer
+        self.cache = cache
+        self.engine = engine
+        self.sources = list(sources)
+        self.latency_budget = latency_budget
+        self.concurrency = concurrency
+
+    async def generate(self, telegram_user_id: int, k_similar_users: int = 5, num_recs_to_return: int = 5) -> List[Dict[str, Any]]:
+        """
+        Следующая порция рекомендаций. Рассчитанные кандидаты кэшируются на пользователя: повторный запрос
+        отдает еще не показанных кандидатов без расчета, новая оценка пользователя сбрасывает кэш.
+        Время, вызовы API и попадания в кэши за запрос пишутся в метрики (см. metrics.py).
+        """
+        with recommendation_request() as request_counts:
+            # Оценки пользователя, еще лежащие в буфере записи, должны попасть в БД (и сбросить кэш) до расчета
+            await self.buffer.flush_user(telegram_user_id)
+            cached_page = self.cache.next_page(telegram_user_id, num_recs_to_return)
+            if cached_page:
+                request_counts.source = 'cache'
+                logger.info(f"Отдано {len(cached_page)} рекомендаций для telegram_user_id={telegram_user_id} из кэша.")
+                return cached_page
+
+            cache_version = self.cache.version(telegram_user_id)
+            candidates = await self._compute_candidates(telegram_user_id, k_similar_users, num_recs_to_return)
+            final_recommendations_list = candidates[:num_recs_to_return]
+            if candidates:
+                self.cache.put(telegram_user_id, candidates, len(final_recommendations_list), cache_version)
+            logger.info(f"Сгенерировано {len(final_recommendations_list)} финальных рекомендаций для telegram_user_id={telegram_user_id}")
+            return final_recommendations_list
+
+    async def _prepare_context(self, telegram_user_id: int, k_similar_users: int,
+                               num_recs_to_return: int) -> Optional[Tuple[CandidateContext, float]]:
+        """Данные пользователя для источников кандидатов и дедлайн расчета; None - рекомендовать нечего."""
+        logger.info(f"Генерация рекомендаций для telegram_user_id={telegram_user_id} (Spotify ID + Last.fm)")
+
+        if not self.spotify_agent.sp and not self.lastfm_agent.lastfm: # Проверка на наличие хотя бы одного клиента
+            logger.error("Клиенты Spotify и Last.fm не инициализированы.")
+            return None
+
+        deadline = time.monotonic() + self.latency_budget
+        stage_started = time.perf_counter()
+        target_user_matrix_idx, precomputed_recs = await asyncio.gather(
+            self.user_mapping.get_user_num(telegram_user_id),
+            self.database.get_precomputed_recommendations(telegram_user_id, self.engine, PRECOMPUTED_RECS_MAX_AGE),
+        )
+        ratings_store = None
+        if self.neighbours.is_loaded:
+            # Модель соседей загружена при старте бота и актуальна - полная выгрузка оценок не нужна
+            has_ratings = not self.neighbours.empty
+        elif precomputed_recs is not None:
+            # Коллаборативный этап уже посчитан пакетно - полная выгрузка оценок не нужна
+            has_ratings = True
+        else:
+            ratings_store = await asyncio.to_thread(self.snapshot.get_store)
+            has_ratings = ratings_store is not None and not ratings_store.empty
+
+        if not has_ratings:
+            logger.warning("Нет данных об оценках в БД.")
+            return None
+        if target_user_matrix_idx == -1:
+            logger.warning(f"Пользователь telegram_user_id={telegram_user_id} не найден в user_mapping.")
+            return None
+
+        if self.neighbours.is_loaded:
+            all_rated_spotify_ids_by_user = self.neighbours.rated_tracks(target_user_matrix_idx)
+        elif ratings_store is None:
+            all_rated_spotify_ids_by_user = set(await self.database.get_top_rated_tracks(telegram_user_id, 1))
+        else:
+            all_rated_spotify_ids_by_user = ratings_store.rated_tracks(target_user_matrix_idx)
+        observe_stage('user_data', stage_started)
+
+        context = CandidateContext(
+            telegram_user_id, target_user_matrix_idx, k_similar_users, num_recs_to_return, all_rated_spotify_ids_by_user,
+            recommender=self, precomputed_recs=precomputed_recs, ratings_store=ratings_store,
+            # Частоту запросов к API ограничивают общие rate limiter'ы, число одновременных вызовов источников - семафор
+            semaphore=asyncio.Semaphore(self.concurrency),
+        )
+        return context, deadline
+
+    async def _compute_candidates(self, telegram_user_id: int, k_similar_users: int, num_recs_to_return: int) -> List[Dict[str, Any]]:
+        """
+        Полный расчет: кандидаты всех источников, успевших за latency_budget,
+        без уже оцененных треков, коллаборативные первыми.
+        """
+        prepared = await self._prepare_context(telegram_user_id, k_similar_users, num_recs_to_return)
+        if prepared is None:
+            return []
+        context, deadline = prepared
+
+        # Источники выполняются параллельно; не уложившиеся в бюджет времени отбрасываются, объединяем то, что успело
+        stage_started = time.perf_counter()
+        batches = await collect_candidates(self.sources, context, deadline)
+        logger.info("Кандидаты по источникам: " + ", ".join(
+            f"{source.name}={len(batch)}" for source, batch in zip(self.sources, batches)
+        ))
+        observe_stage('candidates', stage_started)
+
+        stage_started = time.perf_counter()
+        filtered_recs_list = merge_candidates(batches, context.rated_track_ids)
+        observe_stage('merge', stage_started)
+        return filtered_recs_list
+
+    # --- Потоковая выдача ---
+
+    async def stream(self, telegram_user_id: int, k_similar_users: int = 5, num_recs_to_return: int = 5) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Вариант generate(), отдающий рекомендации по одной, не дожидаясь всех источников. Порядок - как в generate():
+        кандидаты источника отдаются, когда все более приоритетные источники (коллаборативный - первым) завершились
+        или не успели к дедлайну. Как только отдано num_recs_to_return рекомендаций, поток заканчивается,
+        а оставшиеся источники отменяются. Расчет идет в отдельной задаче и не ждет, пока вызывающий обработает
+        очередную рекомендацию; если вызывающий прервал перебор, задача отменяется.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.create_task(self._produce(telegram_user_id, k_similar_users, num_recs_to_return, queue))
+        try:
+            while True:
+                rec = await queue.get()
+                if rec is None:
+                    break
+                yield rec
+            await producer # исключение расчета пробрасываем вызывающему
+        finally:
+            if not producer.done():
+                producer.cancel()
+
+    async def _produce(self, telegram_user_id: int, k_similar_users: int, num_recs_to_return: int, queue: asyncio.Queue):
+        """
+        Кладет в очередь до num_recs_to_return рекомендаций без повторов и уже оцененных, затем None.
+        Кандидаты источников, успевших завершиться, кэшируются (показанные - первыми), как в generate().
+        """
+        try:
+            with recommendation_request() as request_counts:
+                started = time.perf_counter()
+                await self.buffer.flush_user(telegram_user_id) # как в generate()
+                cached_page = self.cache.next_page(telegram_user_id, num_recs_to_return)
+                if cached_page:
+                    request_counts.source = 'cache'
+                    observe_first_result(started, 'cache')
+                    for rec in cached_page:
+                        queue.put_nowait(rec)
+                    logger.info(f"Отдано {len(cached_page)} рекомендаций для telegram_user_id={telegram_user_id} из кэша.")
+                    return
+
+                cache_version = self.cache.version(telegram_user_id)
+                prepared = await self._prepare_context(telegram_user_id, k_similar_users, num_recs_to_return)
+                if prepared is None:
+                    return
+                context, deadline = prepared
+
+                batches: Dict[CandidateSource, List[Dict[str, Any]]] = {}
+                shown: List[Dict[str, Any]] = []
+                shown_ids = set()
+                released = 0 # источники self.sources[:released] уже выданы
+
+                def release(candidates: List[Dict[str, Any]]):
+                    for rec in candidates:
+                        if len(shown) >= num_recs_to_return:
+                            return
+                        if rec['track_id'] in shown_ids or rec['track_id'] in context.rated_track_ids:
+                            continue
+                        if not shown:
+                            observe_first_result(started, 'computed')
+                        shown.append(rec)
+                        shown_ids.add(rec['track_id'])
+                        queue.put_nowait(rec)
+
+                source_batches = iter_candidate_batches(self.sources, context, deadline)
+                try:
+                    async for source, candidates in source_batches:
+                        batches[source] = candidates
+                        logger.info(f"Источник {source.name}: {len(candidates)} кандидатов.")
+                        # Более ранний источник еще считается - кандидаты следующих ждут его (или дедлайна)
+                        while released < len(self.sources) and self.sources[released] in batches:
+                            release(batches[self.sources[released]])
+                            released += 1
+                        if len(shown) >= num_recs_to_return:
+                            break
+                finally:
+                    await source_batches.aclose() # отменяет источники, которые больше не нужны
+                # Дедлайн: не успевшие источники пропускаем, выдаем кандидатов следующих за ними
+                for source in self.sources[released:]:
+                    release(batches.get(source, []))
+
+                remaining = merge_candidates(
+                    [batches.get(source, []) for source in self.sources], context.rated_track_ids | shown_ids
+                )
+                if shown or remaining:
+                    self.cache.put(telegram_user_id, shown + remaining, len(shown), cache_version)
+                logger.info(f"Потоково отдано {len(shown)} рекомендаций для telegram_user_id={telegram_user_id}, "
+                            f"в кэше еще {len(remaining)}.")
+        finally:
+            queue.put_nowait(None)
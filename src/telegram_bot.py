@@ -1,4 +1,5 @@
 import asyncio
+import io
 import os
 import logging
 from aiogram import types, Dispatcher
@@ -15,12 +16,27 @@ from authorization import bot, sp, youtube, lastfm_network # sp, youtube, lastfm
 from app import (
     SpotifyAgent, 
     YouTubeAgent,
-    generate_recommendations, 
+    stream_recommendations,
 )
-from database import (
-    save_track_rating,      # Принимает Spotify ID
+from collaborative import neighbour_model, run_periodic_rebuild
+from audio_pipeline import AUDIO_DELIVERY_MODE
+from prefetch import AudioPrefetcher
+from metrics import register_gauge, start_metrics_server
+from write_buffer import write_buffer
+from user_mapping import user_mapping_cache
+from cache import (
+    track_metadata_cache, lastfm_similar_cache, spotify_resolve_cache, recommendation_cache,
+    LASTFM_SIMILAR_TTL, SPOTIFY_RESOLVE_TTL,
+)
+from database import close_db_pool, get_db_pool_stats
+from async_database import (
     check_user_has_ratings,
-    add_user_mapping,
+    prune_external_api_cache,
+    get_track_audio,
+    save_track_audio,
+    get_async_pool,
+    get_async_pool_stats,
+    close_async_pool,
 )
 
 logger = logging.getLogger(__name__)
@@ -35,6 +51,20 @@ class UserActions(StatesGroup):
 # --- Создаем экземпляры агентов ---
 spotify_agent = SpotifyAgent(sp) 
 youtube_agent = YouTubeAgent(youtube)
+audio_prefetcher = AudioPrefetcher(youtube_agent)
+
+def register_runtime_gauges():
+    """Текущее состояние пула соединений и очереди загрузок - в метрики, снимается при каждом запросе /metrics."""
+    register_gauge('mrs_db_pool_connections', "Соединения пулов PostgreSQL (sync - psycopg2 в потоках, async - asyncpg).",
+                   lambda: {(pool, state): stats[state]
+                            for pool, stats in (('sync', get_db_pool_stats()), ('async', get_async_pool_stats()))
+                            for state in ('in_use', 'idle')}, ('pool', 'state'))
+    register_gauge('mrs_audio_pipeline_jobs', "Задания конвейера загрузки аудио.",
+                   lambda: {(state,): youtube_agent.pipeline.stats()[state] for state in ('queue_depth', 'in_flight', 'native_in_flight')}, ('state',))
+    register_gauge('mrs_audio_prefetch_pending', "Треки в предзагрузке, еще не запрошенные пользователем.",
+                   lambda: {(): audio_prefetcher.stats()['pending']})
+    register_gauge('mrs_write_buffer_pending', "Оценки и прослушивания, ожидающие записи в БД.",
+                   lambda: {(): len(write_buffer)})
 
 # --- Вспомогательная функция для основной клавиатуры ---
 def get_main_keyboard() -> ReplyKeyboardMarkup:
@@ -57,44 +87,91 @@ async def safe_delete_message(chat_id: int, message_id: int):
 
 # --- Функции отправки сообщений и обработки ---
 
+def get_rate_keyboard(track_spotify_id: str) -> InlineKeyboardMarkup:
+    rate_button = InlineKeyboardButton("⭐️ Оценить трек", callback_data=f"rateprompt_{track_spotify_id}")
+    return InlineKeyboardMarkup().add(rate_button)
+
+async def _send_and_remember_audio(chat_id: int, audio, track_spotify_id: str, video_id: str, caption: str):
+    """Отправляет аудио (файл или InputFile из памяти) и сохраняет полученный file_id для повторных отправок."""
+    try:
+        sent_message = await bot.send_audio(chat_id, audio,
+                                            reply_markup=get_rate_keyboard(track_spotify_id),
+                                            caption=caption,
+                                            parse_mode=ParseMode.MARKDOWN)
+        logger.info(f"Аудио для Spotify ID {track_spotify_id} отправлено пользователю {chat_id}")
+        write_buffer.add_listen(chat_id, track_spotify_id)
+        if sent_message and sent_message.audio:
+            await save_track_audio(track_spotify_id, sent_message.audio.file_id, video_id)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке аудио для Spotify ID {track_spotify_id} пользователю {chat_id}: {e}")
+        await bot.send_message(chat_id, "Произошла ошибка при отправке аудио.")
+
 async def send_audio_with_rating_prompt(chat_id: int, track_spotify_id: str, track_name: str, artist_name: str):
-    """Отправляет аудиофайл и кнопку для оценки, используя Spotify ID."""
+    """
+    Отправляет аудиофайл и кнопку для оценки, используя Spotify ID.
+    Если трек уже загружался в Telegram, повторно отправляется сохраненный file_id без поиска и скачивания,
+    а если аудио предзагружено для рекомендаций - используется готовый результат.
+    """
+    caption = f"🎧 **{track_name}**\n_{artist_name}_"
+    cached_audio = await get_track_audio(track_spotify_id)
+    video_id = cached_audio.get('youtube_video_id') if cached_audio else None
+    if cached_audio and cached_audio.get('telegram_file_id'):
+        try:
+            await bot.send_audio(chat_id, cached_audio['telegram_file_id'],
+                                 reply_markup=get_rate_keyboard(track_spotify_id),
+                                 caption=caption,
+                                 parse_mode=ParseMode.MARKDOWN)
+            logger.info(f"Аудио для Spotify ID {track_spotify_id} отправлено пользователю {chat_id} по сохраненному file_id")
+            write_buffer.add_listen(chat_id, track_spotify_id)
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сохраненный file_id для Spotify ID {track_spotify_id}, скачиваем заново: {e}")
+            await save_track_audio(track_spotify_id, None, video_id)
+
     loading_msg = None
     try:
         loading_msg = await bot.send_message(chat_id, "Загружаю аудио, это может занять некоторое время...")
-        
-        video_info = await youtube_agent.search_video(track_name, artist_name)
 
-        if not video_info or 'id' not in video_info or 'videoId' not in video_info['id']:
-            await bot.send_message(chat_id, "К сожалению, не удалось найти аудио для этого трека на YouTube.")
-            logger.warning(f"YouTubeAgent: Видео не найдено для запроса: {track_name} - {artist_name}")
-            return
+        native_audio, audio_file_path = None, None
+        prefetched = await audio_prefetcher.claim(track_spotify_id)
+        if prefetched:
+            logger.info(f"Используем предзагруженное аудио для Spotify ID {track_spotify_id}")
+            video_id = prefetched['video_id']
+            native_audio, audio_file_path = prefetched['native_audio'], prefetched['audio_file_path']
+
+        if not video_id:
+            video_info = await youtube_agent.search_video(track_name, artist_name)
 
-        video_id = video_info['id']['videoId']
+            if not video_info or 'id' not in video_info or 'videoId' not in video_info['id']:
+                await bot.send_message(chat_id, "К сожалению, не удалось найти аудио для этого трека на YouTube.")
+                logger.warning(f"YouTubeAgent: Видео не найдено для запроса: {track_name} - {artist_name}")
+                return
+
+            video_id = video_info['id']['videoId']
         youtube_url = f"https://www.youtube.com/watch?v={video_id}"
         
-        audio_file_path = await youtube_agent.download_audio(youtube_url)
+        if AUDIO_DELIVERY_MODE == 'native' and not audio_file_path:
+            if not native_audio:
+                native_audio = await youtube_agent.download_audio_in_memory(youtube_url)
+            if native_audio:
+                audio_bytes, filename = native_audio
+                logger.info(f"Аудио '{filename}' ({len(audio_bytes)} байт) получено без перекодирования. Отправка пользователю {chat_id}.")
+                await _send_and_remember_audio(chat_id, types.InputFile(io.BytesIO(audio_bytes), filename=filename),
+                                               track_spotify_id, video_id, caption)
+                return
+            logger.info(f"Аудио без перекодирования недоступно для {youtube_url}, используем перекодирование в MP3.")
+
+        if not audio_file_path:
+            audio_file_path = await youtube_agent.download_audio(youtube_url)
 
         if audio_file_path and os.path.exists(audio_file_path):
             logger.info(f"Аудио '{audio_file_path}' скачано. Отправка пользователю {chat_id}.")
             try:
                 with open(audio_file_path, 'rb') as audio_file:
-                    rate_button = InlineKeyboardButton("⭐️ Оценить трек", callback_data=f"rateprompt_{track_spotify_id}")
-                    keyboard = InlineKeyboardMarkup().add(rate_button)
-                    await bot.send_audio(chat_id, audio_file, 
-                                         reply_markup=keyboard, 
-                                         caption=f"🎧 **{track_name}**\n_{artist_name}_",
-                                         parse_mode=ParseMode.MARKDOWN)
-                logger.info(f"Аудио для Spotify ID {track_spotify_id} отправлено пользователю {chat_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке аудиофайла {audio_file_path} пользователю {chat_id}: {e}")
-                await bot.send_message(chat_id, "Произошла ошибка при отправке аудио.")
+                    await _send_and_remember_audio(chat_id, audio_file, track_spotify_id, video_id, caption)
             finally:
-                logger.debug(f"Удаление временного аудиофайла: {audio_file_path}")
-                try:
-                    os.remove(audio_file_path)
-                except OSError as e_os:
-                    logger.warning(f"Не удалось удалить файл {audio_file_path}: {e_os}")
+                logger.debug(f"Освобождение временного аудиофайла: {audio_file_path}")
+                youtube_agent.release_audio(audio_file_path)
         else:
             logger.warning(f"Аудиофайл не был скачан или не найден для YouTube URL: {youtube_url}")
             await bot.send_message(chat_id, "Не удалось загрузить аудио для этого трека. Попробуйте другой.")
@@ -111,7 +188,7 @@ def register_handlers(dp: Dispatcher):
         telegram_user_id = message.chat.id
         logger.info(f"Пользователь {telegram_user_id} запустил команду /start или /help")
         
-        matrix_idx = await asyncio.to_thread(add_user_mapping, telegram_user_id) 
+        matrix_idx = await user_mapping_cache.add_user(telegram_user_id)
         if matrix_idx == -1:
             await message.reply("Произошла ошибка при инициализации вашего профиля. Пожалуйста, попробуйте позже.")
             return
@@ -253,7 +330,8 @@ def register_handlers(dp: Dispatcher):
 
         logger.info(f"Пользователь {telegram_user_id} оценил Spotify ID='{track_spotify_id}' на {rating}")
         
-        await asyncio.to_thread(save_track_rating, telegram_user_id, track_spotify_id, rating)
+        # Запись в БД - отложенная и пакетная (write_buffer), кэш рекомендаций и модель соседей обновляются после записи
+        await write_buffer.add_rating(telegram_user_id, track_spotify_id, rating)
 
         # Удаляем сообщение с кнопками оценки ("Пожалуйста, оцените трек...")
         if callback.message:
@@ -271,39 +349,53 @@ def register_handlers(dp: Dispatcher):
         
         loading_msg = None
         try:
-            if not await asyncio.to_thread(check_user_has_ratings, telegram_user_id):
+            if not write_buffer.has_pending_ratings(telegram_user_id) and \
+               not await check_user_has_ratings(telegram_user_id):
                 logger.info(f"У пользователя {telegram_user_id} нет оценок для генерации рекомендаций.")
                 await message.reply("Сначала вам нужно найти и оценить хотя бы несколько треков.", reply_markup=get_main_keyboard())
                 return
 
-            loading_msg = await message.reply("Подбираю рекомендации для вас... Это может занять некоторое время. 🎶")
-            
-            recs = await generate_recommendations(telegram_user_id) 
+            loading_msg = await message.reply("Подбираю рекомендации для вас... 🎶")
 
-            if not recs:
+            audio_prefetcher.drop_user(telegram_user_id) # предзагрузки прежней порции больше не нужны
+            # Рекомендации отправляются по мере готовности, а не после расчета всех источников
+            shown_track_ids = set()
+            recs_stream = stream_recommendations(telegram_user_id)
+            try:
+                async for track_data in recs_stream:
+                    track_spotify_id = track_data['track_id']
+                    if track_spotify_id in shown_track_ids:
+                        continue
+                    if shown_track_ids:
+                        await asyncio.sleep(0.5)
+                    else:
+                        await safe_delete_message(message.chat.id, loading_msg.message_id)
+                        loading_msg = None
+                        await message.reply("Вот треки, которые могут вам понравиться:", reply_markup=get_main_keyboard())
+                    shown_track_ids.add(track_spotify_id)
+                    if youtube_agent.youtube:
+                        audio_prefetcher.schedule(telegram_user_id, [track_data])
+
+                    track_name = track_data['track_name']
+                    artist_display_name = ", ".join(track_data.get('artist_names', ["Неизвестный исполнитель"]))
+                    spotify_url = track_data.get('spotify_url', '')
+
+                    caption = f"✨ **{track_name}**\n👤 _{artist_display_name}_"
+                    if spotify_url and spotify_url != "N/A":
+                        caption += f"\n[Слушать на Spotify]({spotify_url})"
+
+                    play_button = InlineKeyboardButton("🎵 Прослушать и оценить", callback_data=f"playrecom_{track_spotify_id}")
+                    keyboard = InlineKeyboardMarkup().add(play_button)
+
+                    await bot.send_message(message.chat.id, caption, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+            finally:
+                await recs_stream.aclose()
+
+            if not shown_track_ids:
                 logger.info(f"Для пользователя {telegram_user_id} не удалось сгенерировать рекомендации.")
                 await message.reply("К сожалению, пока не удалось подобрать для вас рекомендации. Попробуйте оценить больше треков.", reply_markup=get_main_keyboard())
                 return
-
-            logger.info(f"Сгенерировано {len(recs)} рекомендаций для {telegram_user_id}.")
-            await message.reply(f"Вот несколько треков, которые могут вам понравиться ({len(recs)} шт.):", reply_markup=get_main_keyboard())
-
-            for i, track_data in enumerate(recs): 
-                track_spotify_id = track_data['track_id'] 
-                track_name = track_data['track_name']
-                artist_display_name = ", ".join(track_data.get('artist_names', ["Неизвестный исполнитель"]))
-                spotify_url = track_data.get('spotify_url', '')
-                
-                caption = f"✨ **{track_name}**\n👤 _{artist_display_name}_"
-                if spotify_url and spotify_url != "N/A":
-                    caption += f"\n[Слушать на Spotify]({spotify_url})"
-
-                play_button = InlineKeyboardButton("🎵 Прослушать и оценить", callback_data=f"playrecom_{track_spotify_id}")
-                keyboard = InlineKeyboardMarkup().add(play_button)
-                
-                await bot.send_message(message.chat.id, caption, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-                if i < len(recs) - 1:
-                    await asyncio.sleep(0.5)
+            logger.info(f"Отправлено {len(shown_track_ids)} рекомендаций для {telegram_user_id}.")
         finally:
             if loading_msg:
                 await safe_delete_message(message.chat.id, loading_msg.message_id)
@@ -318,13 +410,14 @@ def register_handlers(dp: Dispatcher):
         if callback.message: # Удаляем сообщение с рекомендованным треком
              await safe_delete_message(callback.message.chat.id, callback.message.message_id)
 
-        if not spotify_agent.sp: 
+        # Метаданные берутся из кэша и без клиента Spotify; без него недоступны только промахи кэша
+        track_details = await spotify_agent.get_track_basic_info(track_spotify_id)
+
+        if not track_details and not spotify_agent.sp:
             await bot.send_message(telegram_user_id, "Сервис музыки временно недоступен.", reply_markup=get_main_keyboard())
             await callback.answer("Сервис недоступен")
             return
 
-        track_details = await spotify_agent.get_track_basic_info(track_spotify_id)
-
         if track_details:
             await send_audio_with_rating_prompt(
                 telegram_user_id,
@@ -356,16 +449,43 @@ async def main():
     dp = Dispatcher(bot, storage=storage)
     register_handlers(dp)
 
+    try:
+        await get_async_pool()
+    except Exception as e:
+        logger.error(f"Не удалось создать асинхронный пул соединений PostgreSQL (повторная попытка при первом запросе): {e}")
+    await user_mapping_cache.warm() # единственная полная выгрузка user_mapping, дальше - точечные запросы при промахах
+
+    logger.info("Загрузка модели соседей...")
+    if not await asyncio.to_thread(neighbour_model.rebuild):
+        logger.warning("Модель соседей не загружена, рекомендации будут строиться по полной выгрузке оценок.")
+    rebuild_task = asyncio.create_task(run_periodic_rebuild())
+    prefetch_eviction_task = asyncio.create_task(audio_prefetcher.run_periodic_eviction())
+    await prune_external_api_cache(max(LASTFM_SIMILAR_TTL, SPOTIFY_RESOLVE_TTL))
+    register_runtime_gauges()
+    metrics_runner = await start_metrics_server()
+
     logger.info("Запуск polling...")
     try:
         await dp.start_polling()
     finally:
         logger.info("Остановка бота.")
+        rebuild_task.cancel()
+        prefetch_eviction_task.cancel()
+        await write_buffer.shutdown() # до закрытия пула: дописываем оценки и прослушивания
+        await audio_prefetcher.shutdown()
+        await youtube_agent.pipeline.shutdown()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        logger.info(f"Статистика кэша метаданных треков: {track_metadata_cache.stats()}")
+        logger.info(f"Статистика кэша Last.fm: {lastfm_similar_cache.stats()}, кэша Last.fm -> Spotify: {spotify_resolve_cache.stats()}")
+        logger.info(f"Статистика кэша рекомендаций: {recommendation_cache.stats()}")
         await dp.storage.close()
         await dp.storage.wait_closed()
         session = await bot.get_session()
         if session:
             await session.close()
+        await close_async_pool()
+        close_db_pool()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,49 @@
+import logging
+import os
+import time
+
+from database import get_ratings, close_db_pool
+from mf_model import MatrixFactorizationModel, train_als, MF_MODEL_PATH
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+MF_FACTORS = int(os.getenv('MF_FACTORS', '32'))
+MF_ITERATIONS = int(os.getenv('MF_ITERATIONS', '15'))
+MF_REGULARIZATION = float(os.getenv('MF_REGULARIZATION', '0.1'))
+MF_ALPHA = float(os.getenv('MF_ALPHA', '10'))
+MF_WARM_START = os.getenv('MF_WARM_START', '1') == '1' # продолжать обучение с факторов из прежнего файла модели
+
+def train():
+    logger.info("Запуск пакетного обучения MF-модели (implicit ALS)...")
+    df_ratings = get_ratings()
+    if df_ratings.empty:
+        logger.error("Нет оценок для обучения MF-модели.")
+        return
+
+    warm_start = MatrixFactorizationModel.load(MF_MODEL_PATH) if MF_WARM_START else None
+    if warm_start is not None:
+        logger.info(f"Warm start с модели из '{MF_MODEL_PATH}'.")
+
+    started = time.perf_counter()
+    model = train_als(
+        df_ratings,
+        factors=MF_FACTORS,
+        regularization=MF_REGULARIZATION,
+        alpha=MF_ALPHA,
+        iterations=MF_ITERATIONS,
+        warm_start=warm_start,
+    )
+    logger.info(f"Обучение завершено за {time.perf_counter() - started:.1f} с.")
+    model.save(MF_MODEL_PATH)
+
+if __name__ == "__main__":
+    # Запускается по расписанию (например, cron) отдельно от бота.
+    # Бот подхватывает новый файл модели автоматически, если RECS_ENGINE=mf.
+    try:
+        train()
+    finally:
+        close_db_pool()
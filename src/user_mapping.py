@@ -0,0 +1,81 @@
+import logging
+import threading
+from typing import Dict, Optional
+
+import async_database
+import database
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+
+class UserMappingCache:
+    """
+    Общий для процесса двусторонний кэш telegram user_id <-> user_num. Строки user_mapping после вставки
+    не меняются, поэтому кэш не инвалидируется: таблица читается целиком один раз при старте (warm),
+    дальше кэш дополняется при вставках (add_user) и промахах (точечный запрос одной строки).
+    Потокобезопасен: используется и обработчиками бота, и рекомендателем, и подписчиками оценок в потоках.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._to_num: Dict[int, int] = {}
+        self._to_telegram: Dict[int, int] = {}
+        self.warmed = False
+
+    def update(self, user_map: Dict[int, int]):
+        """Добавляет сопоставления {telegram user_id: user_num}."""
+        with self._lock:
+            for telegram_user_id, user_num in user_map.items():
+                self._to_num[telegram_user_id] = user_num
+                self._to_telegram[user_num] = telegram_user_id
+
+    def _lookup(self, telegram_user_id: int) -> Optional[int]:
+        with self._lock:
+            user_num = self._to_num.get(telegram_user_id)
+        record_cache('user_mapping', 'memory', hits=int(user_num is not None), misses=int(user_num is None))
+        return user_num
+
+    def _remember(self, telegram_user_id: int, user_num: int) -> int:
+        if user_num != -1:
+            self.update({telegram_user_id: user_num})
+        return user_num
+
+    async def warm(self) -> bool:
+        """Загружает всю таблицу user_mapping (один раз при старте бота)."""
+        user_map = await async_database.get_user_to_idx_map()
+        self.update(user_map)
+        self.warmed = True
+        logger.info(f"UserMappingCache: загружено {len(user_map)} сопоставлений.")
+        return bool(user_map)
+
+    async def get_user_num(self, telegram_user_id: int) -> int:
+        """user_num пользователя или -1, если он не зарегистрирован (/start)."""
+        user_num = self._lookup(telegram_user_id)
+        if user_num is not None:
+            return user_num
+        return self._remember(telegram_user_id, await async_database.get_internal_user_id(telegram_user_id))
+
+    def get_user_num_sync(self, telegram_user_id: int) -> int:
+        """То же для кода, работающего в потоках (синхронный database.py)."""
+        user_num = self._lookup(telegram_user_id)
+        if user_num is not None:
+            return user_num
+        return self._remember(telegram_user_id, database.get_internal_user_id(telegram_user_id))
+
+    async def add_user(self, telegram_user_id: int) -> int:
+        """Регистрирует пользователя (если его еще нет) и возвращает user_num; -1 при ошибке БД."""
+        user_num = self._lookup(telegram_user_id)
+        if user_num is not None:
+            return user_num
+        return self._remember(telegram_user_id, await async_database.add_user_mapping(telegram_user_id))
+
+    def get_telegram_id(self, user_num: int) -> Optional[int]:
+        """Telegram ID по user_num (только из кэша)."""
+        with self._lock:
+            return self._to_telegram.get(user_num)
+
+    def __len__(self) -> int:
+        return len(self._to_num)
+
+
+user_mapping_cache = UserMappingCache()
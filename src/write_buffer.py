@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Optional, Set, Tuple
+
+from async_database import save_interactions_batch
+from database import notify_rating_listeners
+
+logger = logging.getLogger(__name__)
+
+WRITE_BUFFER_MAX_EVENTS = int(os.getenv('WRITE_BUFFER_MAX_EVENTS', '500')) # столько событий в буфере - запись сразу
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv('WRITE_BUFFER_FLUSH_INTERVAL', '2')) # секунд между плановыми записями
+# Предел событий в буфере (на случай долгой недоступности БД): сверх него новые события отбрасываются
+WRITE_BUFFER_MAX_PENDING = int(os.getenv('WRITE_BUFFER_MAX_PENDING', '100000'))
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная запись оценок и прослушиваний. Обработчик только кладет событие в буфер, фоновая задача
+    раз в flush_interval (или при max_events событиях) пишет все накопленное одной транзакцией
+    с многострочными upsert'ами. Повторные оценки одной пары (пользователь, трек) схлопываются - пишется последняя.
+    Подписчики на оценки (кэш рекомендаций, модель соседей) уведомляются только после успешной записи пачки,
+    поэтому они не видят оценок, которых нет в БД; flush_user() дописывает буфер перед чтением данных пользователя.
+    При ошибке БД события остаются в буфере, но не больше max_pending: сверх предела новая оценка сначала
+    ждет записи буфера, а если и она не удалась - отбрасывается (как и лишние прослушивания) с записью в лог.
+    """
+    def __init__(self, max_events: int = WRITE_BUFFER_MAX_EVENTS, flush_interval: float = WRITE_BUFFER_FLUSH_INTERVAL,
+                 max_pending: int = WRITE_BUFFER_MAX_PENDING):
+        self.max_events = max_events
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._ratings: Dict[Tuple[int, str], int] = {} # (user_id, Spotify ID) -> последняя оценка
+        self._listens: Dict[Tuple[int, str], None] = {} # упорядоченное множество пар
+        self._pending_users: Dict[int, int] = {} # user_id -> число его оценок в _ratings
+        self._flushing_users: Set[int] = set() # пользователи, чьи оценки сейчас записываются
+        self._overflowing = False
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # Статистика
+        self.accepted_ratings = 0
+        self.accepted_listens = 0
+        self.collapsed = 0
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        """Фоновая задача запускается при первом событии, уже внутри работающего event loop."""
+        if self._task is None:
+            self._flush_lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def _accepted(self):
+        self._ensure_started()
+        if len(self) >= self.max_events:
+            self._wakeup.set()
+
+    def _has_room(self) -> bool:
+        if len(self) < self.max_pending:
+            self._overflowing = False
+            return True
+        self.dropped += 1
+        if not self._overflowing: # пишем в лог один раз на эпизод переполнения
+            self._overflowing = True
+            logger.error(f"WriteBehindBuffer: в буфере {len(self)} незаписанных событий (предел {self.max_pending}), "
+                         f"новые события отбрасываются до восстановления записи в БД.")
+        return False
+
+    def _put_rating(self, key: Tuple[int, str], rating: int):
+        if key not in self._ratings:
+            self._pending_users[key[0]] = self._pending_users.get(key[0], 0) + 1
+        self._ratings[key] = rating
+
+    async def add_rating(self, user_id: int, track_spotify_id: str, rating: int):
+        key = (user_id, track_spotify_id)
+        if key in self._ratings:
+            self.collapsed += 1
+        elif len(self) >= self.max_pending:
+            await self.flush() # обратное давление: буфер полон - ждем записи, прежде чем принять оценку
+            if not self._has_room():
+                return
+        self._put_rating(key, rating)
+        self.accepted_ratings += 1
+        self._accepted()
+
+    def add_listen(self, user_id: int, track_spotify_id: str):
+        key = (user_id, track_spotify_id)
+        if key in self._listens:
+            self.collapsed += 1
+        elif not self._has_room():
+            return
+        self._listens[key] = None
+        self.accepted_listens += 1
+        self._accepted()
+
+    def __len__(self) -> int:
+        return len(self._ratings) + len(self._listens)
+
+    def has_pending_ratings(self, user_id: int) -> bool:
+        """Есть ли у пользователя оценки, еще не записанные в БД (в буфере или в текущей записи)."""
+        return user_id in self._flushing_users or user_id in self._pending_users
+
+    async def flush(self) -> bool:
+        """
+        Записывает все накопленное одной транзакцией и после записи уведомляет подписчиков о записанных оценках.
+        При ошибке БД события возвращаются в буфер (в пределах max_pending).
+        """
+        if self._flush_lock is None:
+            return True # событий еще не было
+        async with self._flush_lock:
+            if not self._ratings and not self._listens:
+                return True
+            ratings, listens = self._ratings, self._listens
+            self._flushing_users = set(self._pending_users)
+            self._ratings, self._listens, self._pending_users = {}, {}, {}
+            try:
+                saved = await save_interactions_batch(
+                    [(user_id, track_id, rating) for (user_id, track_id), rating in ratings.items()],
+                    list(listens)
+                )
+                if saved and ratings:
+                    # Подписчики могут обращаться к БД (модель соседей ищет user_num) - вызываем их в потоке
+                    await asyncio.to_thread(_notify_rating_listeners, ratings)
+            finally:
+                self._flushing_users = set()
+            if saved:
+                self.flushes += 1
+                self.flushed_events += len(ratings) + len(listens)
+                return True
+            self.failed_flushes += 1
+            # Более новые события, пришедшие во время записи, не перетираем; сверх max_pending - отбрасываем
+            lost = 0
+            for key, rating in ratings.items():
+                if key in self._ratings:
+                    continue
+                if len(self) >= self.max_pending:
+                    lost += 1
+                    continue
+                self._put_rating(key, rating)
+            for key in listens:
+                if key in self._listens:
+                    continue
+                if len(self) >= self.max_pending:
+                    lost += 1
+                    continue
+                self._listens[key] = None
+            self.dropped += lost
+            logger.warning(f"WriteBehindBuffer: запись не удалась, {len(self)} событий остаются в буфере до следующей попытки"
+                           + (f", {lost} отброшено (предел {self.max_pending})." if lost else "."))
+            return False
+
+    async def flush_user(self, user_id: int):
+        """Чтение своих записей: если у пользователя есть незаписанные оценки, дописывает буфер в БД."""
+        if self.has_pending_ratings(user_id):
+            await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"WriteBehindBuffer: ошибка фоновой записи: {e}", exc_info=True)
+
+    async def shutdown(self):
+        """Останавливает фоновую задачу (не прерывая текущую запись) и дописывает остаток буфера."""
+        self._stopping = True
+        if self._task:
+            self._wakeup.set()
+            await self._task
+        if not await self.flush():
+            logger.error(f"WriteBehindBuffer: при остановке не удалось записать {len(self)} событий.")
+        logger.info(f"WriteBehindBuffer: остановлен. Статистика: {self.stats()}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self),
+            'accepted_ratings': self.accepted_ratings,
+            'accepted_listens': self.accepted_listens,
+            'collapsed': self.collapsed,
+            'flushes': self.flushes,
+            'flushed_events': self.flushed_events,
+            'failed_flushes': self.failed_flushes,
+            'dropped': self.dropped,
+        }
+
+
+def _notify_rating_listeners(ratings: Dict[Tuple[int, str], int]):
+    for (user_id, track_spotify_id), rating in ratings.items():
+        notify_rating_listeners(user_id, track_spotify_id, rating)
+
+
+write_buffer = WriteBehindBuffer()
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import authorization_stub
+
+authorization_stub.install('test')
+
+from candidate_sources import CandidateSource
+
+
+def rec(track_id, source='content_hybrid'):
+    return {'track_id': track_id, 'track_name': track_id, 'artist_names': [], 'spotify_url': 'N/A', 'source': source}
+
+class StaticSource(CandidateSource):
+    """Источник кандидатов с заданным результатом, задержкой и ошибкой; запоминает, что его отменили."""
+    def __init__(self, name, candidates, delay=0.0, error=None):
+        self.name = name
+        self.candidates = candidates
+        self.delay = delay
+        self.error = error
+        self.cancelled = False
+
+    async def fetch(self, context):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return self.candidates
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """Подменяет модуль time в переданных модулях общими ручными часами: fake_clock(cache) -> FakeClock."""
+    clock = FakeClock()
+    def install(*modules):
+        for module in modules:
+            monkeypatch.setattr(module, 'time', clock)
+        return clock
+    return install
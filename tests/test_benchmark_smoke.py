@@ -0,0 +1,19 @@
+import argparse
+
+import benchmark_recommendations
+
+
+def test_benchmark_runs_on_small_synthetic_data():
+    args = argparse.Namespace(
+        ratings=2_000, users=100, tracks=500, zipf=1.1, k=3, sample_users=3,
+        spotify_latency=0.0, lastfm_latency=0.0, seed=7,
+    )
+    result = benchmark_recommendations.run_benchmark(args)
+
+    assert result['params']['ratings'] > 0
+    assert {'snapshot_load', 'pivot', 'neighbour_model_rebuild', 'generate_recommendations',
+            'generate_recommendations_snapshot', 'stream_recommendations'} <= set(result['stages'])
+    assert result['generate_recommendations_latency']['count'] == 3
+    assert result['generate_recommendations_snapshot_latency']['count'] == 3
+    assert result['stream_first_result_latency']['count'] == 3
+    assert result['stub_calls']['spotify'] > 0
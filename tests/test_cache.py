@@ -0,0 +1,69 @@
+import pytest
+
+import cache as cache_module
+from cache import RecommendationCache, TTLCache
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(cache_module)
+
+
+def test_ttl_cache_expires_entries(clock):
+    ttl_cache = TTLCache(max_size=10, ttl=5)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2, ttl=60)
+
+    clock.now += 6
+    assert ttl_cache.get('a') is None
+    assert ttl_cache.get('b') == 2
+    assert len(ttl_cache) == 1
+    assert ttl_cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    ttl_cache = TTLCache(max_size=2, ttl=60)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2)
+    ttl_cache.get('a')
+    ttl_cache.set('c', 3)
+
+    assert ttl_cache.get('b') is None
+    assert ttl_cache.get('a') == 1 and ttl_cache.get('c') == 3
+
+def recs(*track_ids):
+    return [{'track_id': track_id} for track_id in track_ids]
+
+def test_recommendation_cache_pages_through_candidates():
+    recs_cache = RecommendationCache()
+    recs_cache.put(1, recs('a', 'b', 'c', 'd', 'e'), 2, recs_cache.version(1))
+
+    assert recs_cache.next_page(1, 2) == recs('c', 'd')
+    assert recs_cache.next_page(1, 2) == recs('e')
+    assert recs_cache.next_page(1, 2) is None
+    assert recs_cache.next_page(2, 2) is None
+
+def test_invalidation_drops_entry_and_rejects_stale_computation():
+    recs_cache = RecommendationCache()
+    recs_cache.put(1, recs('a', 'b'), 0, recs_cache.version(1))
+    version = recs_cache.version(1) # расчет начался...
+
+    recs_cache.invalidate(1, 'track', 5) # ...а пользователь поставил новую оценку
+    assert recs_cache.next_page(1, 1) is None
+
+    recs_cache.put(1, recs('x'), 0, version)
+    assert recs_cache.next_page(1, 1) is None
+    recs_cache.put(1, recs('y'), 0, recs_cache.version(1))
+    assert recs_cache.next_page(1, 1) == recs('y')
+
+def test_invalidation_history_is_bounded_and_stays_conservative():
+    recs_cache = RecommendationCache(max_size=2)
+    version = recs_cache.version(1) # расчет для пользователя 1 начался...
+    recs_cache.invalidate(1) # ...пользователь поставил оценку
+    for user_id in range(2, 10):
+        recs_cache.invalidate(user_id) # сброс пользователя 1 вытеснен
+
+    assert len(recs_cache._invalidated) == 2
+    recs_cache.put(1, recs('stale'), 0, version)
+    assert recs_cache.next_page(1, 1) is None
+    recs_cache.put(1, recs('fresh'), 0, recs_cache.version(1))
+    assert recs_cache.next_page(1, 1) == recs('fresh')
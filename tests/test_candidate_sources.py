@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import pytest
+
+from candidate_sources import CandidateContext, CandidateSource, collect_candidates, iter_candidate_batches, merge_candidates
+from conftest import StaticSource, rec
+
+
+def make_context():
+    return CandidateContext(1, 0, 5, 5, set())
+
+
+def test_candidate_source_requires_fetch():
+    class Incomplete(CandidateSource):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_late_sources_are_cancelled_at_deadline():
+    fast = StaticSource('fast', [rec('a')])
+    broken = StaticSource('broken', [rec('b')], error=RuntimeError('boom'))
+    slow = StaticSource('slow', [rec('c')], delay=10)
+
+    async def scenario():
+        started = time.monotonic()
+        batches = await collect_candidates([slow, fast, broken], make_context(), started + 0.1)
+        return batches, time.monotonic() - started
+
+    batches, elapsed = asyncio.run(scenario())
+    assert batches == [[], [rec('a')], []]
+    assert slow.cancelled
+    assert elapsed < 1
+
+def test_closing_iteration_early_cancels_remaining_sources():
+    fast = StaticSource('fast', [rec('a')])
+    slow = StaticSource('slow', [rec('c')], delay=10)
+
+    async def scenario():
+        batches = iter_candidate_batches([fast, slow], make_context(), time.monotonic() + 5)
+        source, candidates = await batches.__anext__()
+        await batches.aclose()
+        return source, candidates
+
+    source, candidates = asyncio.run(scenario())
+    assert source is fast and candidates == [rec('a')]
+    assert slow.cancelled
+
+def test_shared_result_survives_cancelled_source():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'seeds'
+
+    class SharedSource(StaticSource):
+        async def fetch(self, context):
+            seeds = await context.shared('seeds', load)
+            await asyncio.sleep(self.delay)
+            return [rec(seeds)]
+
+    context = make_context()
+
+    async def scenario():
+        quick = SharedSource('quick', [])
+        late = SharedSource('late', [], delay=10)
+        batches = await collect_candidates([late, quick], context, time.monotonic() + 0.2)
+        return batches, await context.shared('seeds', load)
+
+    batches, seeds = asyncio.run(scenario())
+    assert batches == [[], [rec('seeds')]]
+    assert seeds == 'seeds' and calls == [1]
+
+def test_merge_candidates_dedupes_excludes_and_puts_collaborative_first():
+    merged = merge_candidates(
+        [[rec('a'), rec('b')], [rec('b', 'collaborative'), rec('c', 'collaborative'), rec('d')]], exclude={'a'}
+    )
+    assert [r['track_id'] for r in merged] == ['c', 'b', 'd']
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from collaborative import NeighbourModel, SparseRatingMatrix
+from ratings_snapshot import RatingsSnapshot
+from user_mapping import UserMappingCache
+
+TELEGRAM_ID_OFFSET = 10_000
+
+
+def random_ratings(n_users=60, n_tracks=40, n_ratings=600, seed=3):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'user_id': rng.integers(1, n_users + 1, n_ratings),
+        'track_id': [f"trk{t:03d}" for t in rng.integers(0, n_tracks, n_ratings)],
+        'rating': rng.integers(1, 6, n_ratings),
+    })
+
+
+def test_recommend_for_users_matches_per_user_path():
+    matrix = SparseRatingMatrix.from_ratings(random_ratings())
+    user_ids = matrix.user_ids.tolist()
+
+    batch = matrix.recommend_for_users(user_ids, k=5, n=10, chunk_size=7)
+
+    assert set(batch) == set(user_ids)
+    for user_id in user_ids:
+        expected = matrix.recommend_tracks(user_id, matrix.similar_users(user_id, 5), 10)
+        assert batch[user_id] == expected, user_id
+
+def test_similarity_matches_dense_cosine():
+    df = random_ratings(n_users=15, n_tracks=10, n_ratings=80)
+    matrix = SparseRatingMatrix.from_ratings(df)
+    dense = df.drop_duplicates(['user_id', 'track_id'], keep='last').pivot_table(
+        index='user_id', columns='track_id', values='rating', fill_value=0
+    ).to_numpy(dtype=float)
+    normalized = dense / np.linalg.norm(dense, axis=1, keepdims=True)
+
+    for row, user_id in enumerate(matrix.user_ids.tolist()):
+        np.testing.assert_allclose(matrix.similarity_row(user_id), normalized @ normalized[row])
+
+def test_recommendations_exclude_rated_tracks_and_unknown_users():
+    matrix = SparseRatingMatrix.from_ratings(pd.DataFrame({
+        'user_id': [1, 1, 2, 2, 2, 3],
+        'track_id': ['a', 'b', 'a', 'b', 'c', 'd'],
+        'rating': [5, 4, 5, 4, 5, 1],
+    }))
+
+    assert matrix.similar_users(1, k=1) == [2]
+    assert matrix.recommend_tracks(1, [2], 5)[0] == 'c'
+    assert 'a' not in matrix.recommend_tracks(1, [2], 5)
+    assert matrix.recommend_for_users([99]) == {}
+    assert matrix.similar_users(99) == []
+
+
+def make_neighbour_model(rows, k=3, max_dirty=10_000):
+    snapshot = RatingsSnapshot(loader=lambda since=None: [(*row, None) for row in rows] if since is None else [])
+    user_mapping = UserMappingCache()
+    user_mapping.update({TELEGRAM_ID_OFFSET + user_num: user_num for user_num in range(200)})
+    model = NeighbourModel(k, snapshot, user_mapping, max_dirty)
+    assert model.rebuild()
+    return model, snapshot.store
+
+def assert_model_matches(model, store, k=3):
+    rebuilt, _ = make_neighbour_model(list(store.iter_ratings()), k)
+    matrix = SparseRatingMatrix.from_store(store)
+    for user_num in matrix.user_ids.tolist():
+        neighbours = model.similar_users(user_num)
+        assert neighbours == rebuilt.similar_users(user_num) == matrix.similar_users(user_num, k), user_num
+        recommended = model.recommend(user_num, n=10)
+        assert recommended == rebuilt.recommend(user_num, n=10) == matrix.recommend_tracks(user_num, neighbours, 10), user_num
+
+@pytest.mark.parametrize('max_dirty', [10_000, 5])
+def test_incremental_updates_match_full_rebuild_and_sparse_matrix(max_dirty):
+    df = random_ratings(n_users=40, n_tracks=30, n_ratings=300, seed=11)
+    model, store = make_neighbour_model(list(df.itertuples(index=False, name=None)), max_dirty=max_dirty)
+    rng = np.random.default_rng(12)
+    for step in range(80):
+        for user_num in rng.choice(40, 10).tolist(): # кэш соседей заполнен - проверяем его сброс
+            model.similar_users(user_num + 1)
+        user_num = int(rng.integers(1, 46)) # есть и новые пользователи
+        track_id = f"trk{int(rng.integers(0, 34)):03d}" # и новые треки
+        model.update_rating(TELEGRAM_ID_OFFSET + user_num, track_id, int(rng.integers(1, 6)))
+        if step % 20 == 19:
+            assert_model_matches(model, store)
+    assert_model_matches(model, store)
+
+def test_update_does_not_drop_unaffected_neighbour_lists():
+    df = random_ratings(n_users=40, n_tracks=200, n_ratings=300, seed=13)
+    model, store = make_neighbour_model(list(df.itertuples(index=False, name=None)))
+    for user_num in range(1, 41):
+        model.similar_users(user_num)
+    cached = len(model._neighbours)
+
+    model.update_rating(TELEGRAM_ID_OFFSET + 1, 'trk000', 5)
+
+    assert len(model._neighbours) > cached // 2
+    assert_model_matches(model, store)
@@ -0,0 +1,29 @@
+from metrics import Counter, Histogram
+
+
+def test_counter_header_and_samples_share_total_name():
+    counter = Counter('mrs_test_requests', "Тестовый счетчик.", ('result',))
+    counter.inc(result='hit')
+    counter.inc(2, result='miss')
+
+    assert counter.render() == [
+        '# HELP mrs_test_requests_total Тестовый счетчик.',
+        '# TYPE mrs_test_requests_total counter',
+        'mrs_test_requests_total{result="hit"} 1',
+        'mrs_test_requests_total{result="miss"} 2',
+    ]
+
+def test_counter_name_with_total_suffix_is_not_doubled():
+    counter = Counter('mrs_test_events_total', "Тестовый счетчик.")
+    counter.inc()
+
+    assert counter.render()[1] == '# TYPE mrs_test_events_total counter'
+    assert counter.render()[2] == 'mrs_test_events_total 1'
+
+def test_histogram_header_uses_base_name():
+    histogram = Histogram('mrs_test_duration_seconds', "Тестовая гистограмма.")
+    histogram.observe(0.1)
+
+    lines = histogram.render()
+    assert lines[1] == '# TYPE mrs_test_duration_seconds histogram'
+    assert any(line.startswith('mrs_test_duration_seconds_count ') for line in lines)
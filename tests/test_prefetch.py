@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+import prefetch as prefetch_module
+from prefetch import AudioPrefetcher
+
+
+class FakeYouTubeAgent:
+    def __init__(self):
+        self.downloads = []
+
+    async def search_video(self, track_name, artist_name):
+        return {'id': {'videoId': f'video-{track_name}'}}
+
+    async def download_audio_in_memory(self, video_url):
+        self.downloads.append(('memory', video_url))
+        return b'audio', 'track.m4a'
+
+    async def download_audio(self, video_url, priority=None, wait_for_slot=True):
+        self.downloads.append(('file', video_url))
+        return '/tmp/track.mp3'
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    rows = []
+    async def get_track_audio(track_spotify_id):
+        return None
+    async def save_track_audio(track_spotify_id, telegram_file_id, video_id):
+        rows.append((track_spotify_id, video_id))
+    monkeypatch.setattr(prefetch_module, 'get_track_audio', get_track_audio)
+    monkeypatch.setattr(prefetch_module, 'save_track_audio', save_track_audio)
+    return rows
+
+def test_native_mode_prefetches_only_the_video_id(monkeypatch, saved):
+    monkeypatch.setattr(prefetch_module, 'AUDIO_DELIVERY_MODE', 'native')
+    youtube_agent = FakeYouTubeAgent()
+    prefetcher = AudioPrefetcher(youtube_agent)
+
+    async def scenario():
+        prefetcher.schedule(1, [{'track_id': 't1', 'track_name': 'song', 'artist_names': ['artist']}])
+        return await prefetcher._entries['t1'].task
+
+    result = asyncio.run(scenario())
+    assert result == {'video_id': 'video-song', 'native_audio': None, 'audio_file_path': None}
+    assert saved == [('t1', 'video-song')]
+    assert youtube_agent.downloads == [] # аудио скачается при нажатии, а не держится в памяти
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import rate_limit
+from rate_limit import TokenBucket
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(rate_limit)
+
+
+def test_burst_is_free_then_reservations_queue_up(clock):
+    bucket = TokenBucket('test', rate=2, burst=3)
+
+    delays = [bucket._reserve(1) for _ in range(6)]
+
+    assert delays == [0.0, 0.0, 0.0, 0.5, 1.0, 1.5]
+    assert bucket.acquired == 6 and bucket.throttled == 3
+
+def test_tokens_refill_with_time_up_to_burst(clock):
+    bucket = TokenBucket('test', rate=2, burst=2)
+    bucket._reserve(2)
+    assert bucket._reserve(1) == 0.5
+
+    clock.now += 10 # долг в один токен погашен, остальное - не больше burst
+    assert [bucket._reserve(1) for _ in range(3)] == [0.0, 0.0, 0.5]
+
+def test_cancelled_acquire_refunds_its_tokens(clock):
+    bucket = TokenBucket('test', rate=1, burst=1)
+
+    async def scenario():
+        await bucket.acquire() # токен из запаса
+        waiter = asyncio.ensure_future(bucket.acquire())
+        await asyncio.sleep(0) # ожидание началось, токен списан
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
+    assert bucket._reserve(1) == 1.0 # очередь не выросла из-за отмененного ожидания
+
+def test_async_acquire_waits_for_reservation():
+    bucket = TokenBucket('test', rate=20, burst=1)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(bucket.acquire() for _ in range(3)))
+        return loop.time() - started
+
+    assert asyncio.run(scenario()) >= 0.09
+    assert bucket.throttled == 2
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from collaborative import SparseRatingMatrix
+from ratings_store import RatingsStore
+
+
+def test_upsert_reports_changes_and_keeps_last_value():
+    store = RatingsStore()
+    store.bulk_load([(1, 'a', 3), (2, 'b', 4), (1, 'a', 5)])
+    version = store.version
+
+    assert not store.upsert(1, 'a', 5) # та же оценка - без изменений
+    assert store.version == version
+    assert store.upsert(1, 'a', 2) # изменение существующей
+    assert store.upsert(3, 'c', 1) # новая пара уходит в буфер
+    assert not store.upsert(3, 'c', 1)
+    assert store.upsert(3, 'c', 4)
+
+    assert len(store) == 3
+    assert sorted(store.iter_ratings()) == [(1, 'a', 2), (2, 'b', 4), (3, 'c', 4)]
+    assert store.rated_tracks(3) == {'c'} and store.rated_tracks(42) == set()
+
+def test_to_csr_matches_matrix_built_from_dataframe():
+    rng = np.random.default_rng(5)
+    rows = [(int(u), f"trk{int(t):02d}", int(r)) for u, t, r in zip(
+        rng.integers(1, 30, 300), rng.integers(0, 25, 300), rng.integers(1, 6, 300)
+    )]
+    store = RatingsStore()
+    store.bulk_load(rows[:200])
+    for row in rows[200:]:
+        store.upsert(*row)
+
+    user_ids, track_ids, ratings = store.to_csr()
+    expected = SparseRatingMatrix.from_ratings(pd.DataFrame(rows, columns=['user_id', 'track_id', 'rating']))
+
+    assert user_ids.tolist() == expected.user_ids.tolist()
+    assert track_ids.tolist() == expected.track_ids.tolist()
+    assert (ratings != expected.ratings).nnz == 0
@@ -0,0 +1,87 @@
+import asyncio
+import types
+
+from cache import RecommendationCache
+from conftest import StaticSource, rec
+from recommender import Recommender
+from user_mapping import UserMappingCache
+from write_buffer import WriteBehindBuffer
+
+TELEGRAM_ID = 42
+
+
+class Database:
+    async def get_precomputed_recommendations(self, telegram_user_id, engine, max_age):
+        return None
+
+    async def get_top_rated_tracks(self, telegram_user_id, min_rating=4):
+        return []
+
+    async def get_item_based_recommendations(self, telegram_user_id, min_rating, limit):
+        return []
+
+def make_recommender(sources, latency_budget=5.0):
+    user_mapping = UserMappingCache()
+    user_mapping.update({TELEGRAM_ID: 1})
+    neighbours = types.SimpleNamespace(is_loaded=True, empty=False, rated_tracks=lambda user_num: {'rated'})
+    agent = types.SimpleNamespace(sp=True, lastfm=True)
+    return Recommender(
+        agent, agent, database=Database(), neighbours=neighbours, user_mapping=user_mapping,
+        buffer=WriteBehindBuffer(), cache=RecommendationCache(), sources=sources, latency_budget=latency_budget,
+    )
+
+async def collect(stream):
+    return [item['track_id'] async for item in stream]
+
+
+def test_stream_holds_content_until_collaborative_finishes():
+    collaborative = StaticSource('collaborative', [rec('c1', 'collaborative'), rec('rated', 'collaborative')], 0.1)
+    content = StaticSource('content', [rec('x1', 'content_hybrid'), rec('x2', 'content_hybrid')], 0.0)
+    recommender = make_recommender([collaborative, content])
+
+    shown = asyncio.run(collect(recommender.stream(TELEGRAM_ID, 5, 3)))
+
+    assert shown == ['c1', 'x1', 'x2']
+
+def test_stream_ends_as_soon_as_enough_items_are_sent():
+    collaborative = StaticSource('collaborative', [rec(f'c{i}', 'collaborative') for i in range(4)], 0.0)
+    content = StaticSource('content', [rec('x1', 'content_hybrid')], 10)
+    recommender = make_recommender([collaborative, content])
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        shown = await collect(recommender.stream(TELEGRAM_ID, 5, 2))
+        return shown, loop.time() - started
+
+    shown, elapsed = asyncio.run(scenario())
+    assert shown == ['c0', 'c1']
+    assert elapsed < 1 and content.cancelled
+    assert recommender.cache.next_page(TELEGRAM_ID, 5) == [rec('c2', 'collaborative'), rec('c3', 'collaborative')]
+
+def test_stream_releases_content_when_collaborative_misses_deadline():
+    collaborative = StaticSource('collaborative', [rec('c1', 'collaborative')], 10)
+    content = StaticSource('content', [rec('x1', 'content_hybrid')], 0.0)
+    recommender = make_recommender([collaborative, content], latency_budget=0.1)
+
+    shown = asyncio.run(collect(recommender.stream(TELEGRAM_ID, 5, 3)))
+
+    assert shown == ['x1']
+    assert collaborative.cancelled
+
+def test_generate_and_cached_pages():
+    collaborative = StaticSource('collaborative', [rec(f'c{i}', 'collaborative') for i in range(3)], 0.0)
+    content = StaticSource('content', [rec('x1', 'content_hybrid')], 0.0)
+    recommender = make_recommender([collaborative, content])
+
+    async def scenario():
+        first = await recommender.generate(TELEGRAM_ID, 5, 2)
+        second = await recommender.generate(TELEGRAM_ID, 5, 2)
+        recommender.cache.invalidate(TELEGRAM_ID)
+        third = await recommender.generate(TELEGRAM_ID, 5, 2)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert [r['track_id'] for r in first] == ['c0', 'c1']
+    assert [r['track_id'] for r in second] == ['c2', 'x1']
+    assert [r['track_id'] for r in third] == ['c0', 'c1']
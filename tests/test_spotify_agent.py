@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('tekore')
+pytest.importorskip('pylast')
+pytest.importorskip('yt_dlp')
+
+from app import SpotifyAgent
+
+TRACK = {'id': 'trk1', 'name': 'Song', 'artist_name': 'Artist', 'artist_names': ['Artist'],
+         'artist_id': 'art1', 'spotify_url': 'https://open.spotify.com/track/trk1'}
+
+
+class MemoryTrackCache:
+    def __init__(self, *tracks):
+        self.tracks = {track['id']: track for track in tracks}
+
+    def get(self, track_id):
+        return self.tracks.get(track_id)
+
+    def get_many(self, track_ids):
+        return {track_id: self.tracks[track_id] for track_id in track_ids if track_id in self.tracks}
+
+class MemoryResolveCache:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def get(self, track_title, artist_name):
+        key = (track_title, artist_name)
+        return (key in self.entries), self.entries.get(key)
+
+
+def test_cached_track_is_served_without_spotify_client():
+    agent = SpotifyAgent(None, track_cache=MemoryTrackCache(TRACK), resolve_cache=None)
+
+    assert asyncio.run(agent.get_track_basic_info('trk1')) == TRACK
+    assert asyncio.run(agent.get_track_basic_info('other')) is None
+    assert asyncio.run(agent.get_tracks_basic_info(['trk1', 'other'])) == {'trk1': TRACK}
+
+def test_cached_resolution_is_served_without_spotify_client():
+    agent = SpotifyAgent(None, track_cache=MemoryTrackCache(TRACK),
+                         resolve_cache=MemoryResolveCache({('Song', 'Artist'): 'trk1', ('Gone', 'Artist'): None}))
+
+    assert asyncio.run(agent.resolve_track('Song', 'Artist')) == TRACK
+    assert asyncio.run(agent.resolve_track('Gone', 'Artist')) is None
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import write_buffer as write_buffer_module
+from write_buffer import WriteBehindBuffer
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.fail = False
+        self.batches = []
+
+    async def save_interactions_batch(self, ratings, listens):
+        if self.fail:
+            return False
+        self.batches.append((sorted(ratings), sorted(listens)))
+        return True
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDatabase()
+    monkeypatch.setattr(write_buffer_module, 'save_interactions_batch', fake.save_interactions_batch)
+    return fake
+
+@pytest.fixture
+def notified(monkeypatch):
+    events = []
+    monkeypatch.setattr(write_buffer_module, 'notify_rating_listeners', lambda *event: events.append(event))
+    return events
+
+def run(coro_factory):
+    async def main():
+        buffer = WriteBehindBuffer(max_events=1000, flush_interval=3600, max_pending=4)
+        try:
+            return await coro_factory(buffer)
+        finally:
+            buffer._stopping = True
+            if buffer._task:
+                buffer._task.cancel()
+    return asyncio.run(main())
+
+
+def test_flush_collapses_ratings_and_notifies_after_commit(db, notified):
+    async def scenario(buffer):
+        await buffer.add_rating(1, 'a', 3)
+        await buffer.add_rating(1, 'a', 5)
+        buffer.add_listen(1, 'a')
+        assert notified == [] # до записи подписчики не видят оценку
+        assert buffer.has_pending_ratings(1) and not buffer.has_pending_ratings(2)
+        assert await buffer.flush()
+        return buffer
+
+    buffer = run(scenario)
+    assert db.batches == [([(1, 'a', 5)], [(1, 'a')])]
+    assert notified == [(1, 'a', 5)]
+    assert not buffer.has_pending_ratings(1)
+    assert buffer.collapsed == 1 and len(buffer) == 0
+
+def test_failed_flush_requeues_without_notifying(db, notified):
+    async def scenario(buffer):
+        await buffer.add_rating(1, 'a', 4)
+        db.fail = True
+        assert not await buffer.flush()
+        assert buffer.has_pending_ratings(1)
+        await buffer.add_rating(1, 'a', 2) # более новая оценка не перетирается старой при возврате
+        db.fail = False
+        assert await buffer.flush()
+        return buffer
+
+    buffer = run(scenario)
+    assert notified == [(1, 'a', 2)]
+    assert db.batches == [([(1, 'a', 2)], [])]
+    assert buffer.failed_flushes == 1
+
+def test_buffer_is_bounded_when_database_is_down(db, notified):
+    async def scenario(buffer):
+        db.fail = True
+        for i in range(4):
+            await buffer.add_rating(i, 't', 5)
+        await buffer.add_rating(10, 't', 5) # буфер полон, запись не удалась - оценка отброшена
+        buffer.add_listen(11, 't')
+        assert len(buffer) == 4 and not buffer.has_pending_ratings(10)
+        db.fail = False
+        await buffer.add_rating(12, 't', 5) # запись восстановилась - буфер освобождается и оценка принимается
+        assert len(buffer) == 1 and buffer.has_pending_ratings(12)
+        return buffer
+
+    buffer = run(scenario)
+    assert buffer.dropped == 2
+    assert [user_id for user_id, _, _ in notified] == [0, 1, 2, 3]